@@ -0,0 +1,819 @@
+"""
+This module implements the Go-Back-N and SR Protocol on asyncio.
+
+All the state of a transfer lives in one DatagramProtocol driven by a single-threaded event loop.
+Timers are scheduled with loop.call_later, so acks and timeouts never race and thousands of
+transfers can run in one process. The packets are compatible with the threaded clients and servers.
+
+Usage:
+    await SRSender(('127.0.0.1', 9790)).send(open('data/player1.jpeg', 'rb'))
+    await SRReceiver(('', 9790)).receive(open('output.jpg', 'wb'))
+
+Author:
+    Aaron Li
+"""
+import asyncio
+import logging
+import os
+import socket
+import struct
+
+import channel
+import common_util as util
+import congestion
+import metrics as rdt_metrics
+
+logger = logging.getLogger(__name__)
+
+TIMEOUT = 10
+INITIAL_RTO = 1
+WINDOW_SIZE = 10
+LOSS_RATE = 0
+QUEUE_MAX_SIZE = 32
+DUP_ACK_THRESHOLD = 3
+NEGOTIATE_TIMEOUT = 1
+NEGOTIATE_RETRIES = 10
+# The end packet is sent this number of times to a receiver without the close handshake, in case packet loss
+END_REPEAT = 10
+# The end packet is sent again after each RTO until the receiver acks the close
+CLOSE_RETRIES = 10
+# The receiver acks the repeated end packets until the sender confirms the close or this number of seconds pass
+CLOSE_LINGER = 2
+# With selective acks, a packet is lost once this number of packets sent after it are acked
+REORDER_THRESHOLD = 3
+# With selective acks, one ack covers up to ACK_EVERY packets, or the packets received in ACK_DELAY seconds
+ACK_EVERY = 16
+ACK_DELAY = 0.005
+
+
+class SenderProtocol(asyncio.DatagramProtocol):
+    """
+    The common part of the GBN and SR senders: negotiation, filling the window and closing
+    The subclasses handle the acks and the timers
+    """
+    def __init__(self, server_address, timeout=TIMEOUT, window_size=WINDOW_SIZE, loss_rate=LOSS_RATE,
+                 channel_options=None, checksum_types=util.CHECKSUM_PREFERENCE, version=util.VERSION_2,
+                 initial_rto=INITIAL_RTO, congestion_control=congestion.POLICY_FIXED, congestion_options=None,
+                 metrics=None):
+        self.server_address = server_address
+        self.timeout = timeout
+        self.max_window_size = window_size
+        self.loss_rate = loss_rate
+        self.channel_options = channel_options
+        # Identify the transfer on the server together with the client address
+        self.connection_id = int.from_bytes(os.urandom(4), byteorder='big')
+        self.send_base = 0
+        self.next_seq = 0
+        # The packets from send_next to next_seq are in the window but not sent yet
+        self.send_next = 0
+        # The queue and the frame pool are indexed by seq num % size, they grow with the window in version 2
+        self.packet_queue = util.SlidingWindow(QUEUE_MAX_SIZE)
+        self.frame_pool = util.FramePool(QUEUE_MAX_SIZE)
+        # The congestion window limits the packets in flight below the window size, see congestion.make_controller
+        self.congestion = congestion.make_controller(congestion_control, window_size, congestion_options)
+        # The RTO is measured from RTT, timeout is the upper bound of it
+        self.rto_estimator = util.RTOEstimator(initial_rto=min(initial_rto, timeout), max_rto=timeout)
+        self.resend_count = 0
+        # The events of the transfer are counted and traced by the metrics, see metrics.Metrics
+        self.metrics = metrics if metrics is not None else rdt_metrics.NULL_METRICS
+        # The highest version and the algorithms proposed to the server, the chosen ones are used once negotiated
+        self.version = version
+        self.checksum_types = checksum_types
+        self.set_header(util.PacketHeader())
+        # The receive window advertised by the server, None if it doesn't tell
+        self.receive_window = None
+        self.loop = None
+        self.transport = None
+        self.channel = None
+        self.reader = None
+        self.end_of_stream = False
+        self.sending = False
+        self.negotiated = None
+        self.done = None
+        # The receiver acks the end packet once the close handshake is negotiated
+        self.close_enabled = False
+        self.closed = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def connection_lost(self, exc):
+        if self.done is not None and not self.done.done():
+            self.done.set_exception(exc or ConnectionError('The transport is closed'))
+
+    def error_received(self, exc):
+        # e.g. the server port is not opened yet, the retransmission will deal with it
+        logger.warning('Client socket error: %s', exc)
+
+    def udp_send(self, pkt):
+        if not self.channel.send(pkt, self.server_address):
+            self.metrics.on_loss(channel.get_pkt_length(pkt))
+
+    def make_pkt(self, seq_num, data, checksum, flags=0):
+        return self.header.make_pkt(seq_num, data, checksum, flags)
+
+    def set_header(self, header):
+        self.header = header
+        self.seq_space = header.seq_space
+        self.frame_pool.set_header(header)
+        if header.version == util.VERSION_1:
+            # The sequence numbers are the queue positions, the window is at most half of them
+            self.window_size = min(self.max_window_size, QUEUE_MAX_SIZE // 2)
+        else:
+            self.window_size = self.max_window_size
+        self.congestion.set_max_window(self.window_size)
+
+    def get_window(self):
+        # The congestion window, but never more packets than the server can buffer
+        window = self.congestion.get_window()
+        if self.receive_window is None:
+            return window
+        return min(window, self.receive_window)
+
+    def ensure_capacity(self, window):
+        # Grow the queue and the frame pool when the window doesn't fit
+        if window < self.packet_queue.size:
+            return
+        new_size = util.get_queue_size(window, self.seq_space)
+        self.frame_pool.grow(new_size, self.send_base, len(self.packet_queue))
+        self.packet_queue.grow(new_size, self.send_base)
+
+    def datagram_received(self, data, address):
+        if len(data) < 2:
+            return
+        if data[1] & util.FLAG_NEGOTIATE:
+            if self.negotiated is not None and not self.negotiated.done():
+                self.negotiated.set_result(util.analyse_negotiate_pkt(data))
+            return
+        if data[1] & util.FLAG_FIN:
+            if self.closed is not None and not self.closed.done():
+                self.closed.set_result(None)
+            return
+        if not self.sending:
+            return
+        ack = self.header.analyse_ack(data)
+        if ack is None:
+            return
+
+        ack_seq, window, sack_bitmap = ack
+        if window is not None and self.receive_window is not None:
+            self.receive_window = window
+        if sack_bitmap is None:
+            self.handle_ack(ack_seq)
+        else:
+            self.handle_sack(ack_seq, sack_bitmap)
+        self.fill_window()
+        self.send_new_packets()
+        if self.end_of_stream and self.packet_queue.is_empty() and not self.done.done():
+            self.done.set_result(None)
+
+    def handle_sack(self, cumulative_ack, sack_bitmap):
+        # The cumulative part is a normal ack, the subclasses may use the bitmap
+        self.handle_ack(cumulative_ack)
+
+    def make_negotiate_options(self):
+        return {
+            util.OPTION_CHECKSUM: bytes(self.checksum_types),
+            util.OPTION_CONNECTION_ID: struct.pack('!I', self.connection_id),
+            util.OPTION_VERSION: bytes([self.version]),
+            util.OPTION_CLOSE: b'',
+        }
+
+    def on_negotiated(self, options):
+        pass
+
+    async def negotiate(self):
+        """
+        Open the connection on the server, propose the protocol version and checksum algorithms
+        and use the ones it chooses
+        """
+        negotiate_pkt = util.make_negotiate_pkt(self.make_negotiate_options())
+        for i in range(0, NEGOTIATE_RETRIES):
+            self.negotiated = self.loop.create_future()
+            self.udp_send(negotiate_pkt)
+            try:
+                options = await asyncio.wait_for(self.negotiated, NEGOTIATE_TIMEOUT)
+            except asyncio.TimeoutError:
+                continue
+
+            checksum_type = options.get(util.OPTION_CHECKSUM, bytes([util.CHECKSUM_LEGACY]))[0]
+            version = util.get_option_int(options, util.OPTION_VERSION, util.VERSION_1)
+            window_scale = util.get_option_int(options, util.OPTION_WINDOW_SCALE, 0)
+            self.set_header(util.PacketHeader(version, checksum_type, window_scale))
+            self.receive_window = util.get_option_int(options, util.OPTION_RECEIVE_WINDOW)
+            self.close_enabled = util.OPTION_CLOSE in options
+            self.on_negotiated(options)
+            logger.info('Client negotiated version and checksum: %d %d', version, checksum_type)
+            return
+
+        raise TimeoutError('No negotiation response from the server')
+
+    async def close_connection(self):
+        """
+        Send the end packet until the receiver acks the close, then confirm the ack
+        A receiver without the close handshake gets the end packet END_REPEAT times instead
+        """
+        if not self.close_enabled:
+            for i in range(0, END_REPEAT):
+                self.udp_send(self.make_pkt(0, b'', 0, util.FLAG_END))
+            return
+
+        end_pkt = self.make_pkt(0, b'', 0, util.FLAG_END | util.FLAG_FIN)
+        for i in range(0, CLOSE_RETRIES):
+            self.closed = self.loop.create_future()
+            self.udp_send(end_pkt)
+            try:
+                await asyncio.wait_for(self.closed, self.rto_estimator.get_rto())
+            except asyncio.TimeoutError:
+                continue
+            self.udp_send(util.make_close_pkt(False))
+            return
+        logger.warning('Client close without ack, the server does not answer')
+
+    def fill_window(self):
+        # Read the packets into their frames only when there is room in the window
+        window = self.get_window()
+        self.ensure_capacity(window)
+        while not self.end_of_stream and len(self.packet_queue) < window:
+            length = self.frame_pool.fill(self.next_seq, self.reader)
+            if length == 0:
+                self.end_of_stream = True
+                break
+            self.packet_queue.append(util.WindowEntry(length))
+            self.next_seq = (self.next_seq + 1) % self.seq_space
+
+    def send_new_packets(self):
+        # Only the newly filled tail of the window is walked, the packets before send_next are sent
+        queue = self.packet_queue
+        self.metrics.on_window(len(queue))
+        while self.send_next != self.next_seq:
+            seq_num = self.send_next
+            data_item = queue.items[seq_num % queue.size]
+            self.udp_send(self.frame_pool.frame(seq_num))
+            self.metrics.on_send(seq_num, data_item.length)
+            data_item.sent = True
+            self.on_packet_sent(seq_num, data_item)
+            self.send_next = (seq_num + 1) % self.seq_space
+
+    async def send(self, input_stream):
+        self.loop = asyncio.get_running_loop()
+        await self.loop.create_datagram_endpoint(lambda: self, family=socket.AF_INET)
+        self.channel = channel.make_channel(self.transport, self.loss_rate, self.channel_options, self.loop)
+        self.reader = util.PacketReader(input_stream)
+        self.done = self.loop.create_future()
+        try:
+            await self.negotiate()
+            self.sending = True
+            self.fill_window()
+            if self.packet_queue.is_empty():
+                self.done.set_result(None)
+            else:
+                self.send_new_packets()
+            await self.done
+
+            # All the packets are sent, close the connection
+            await self.close_connection()
+            # Let the delayed packets leave before closing
+            await asyncio.sleep(self.channel.pending_time())
+        finally:
+            self.sending = False
+            self.stop_timers()
+            self.reader.close()
+            input_stream.close()
+            self.channel.close()
+            self.transport.close()
+
+
+class GBNSender(SenderProtocol):
+    def __init__(self, server_address, dup_ack_threshold=DUP_ACK_THRESHOLD, **kwargs):
+        super().__init__(server_address, **kwargs)
+        self.timer = None
+        # Fast retransmit fires once the same cumulative ack is received dup_ack_threshold more times
+        self.dup_ack_threshold = dup_ack_threshold
+        self.dup_ack_count = 0
+        self.in_fast_recovery = False
+        self.total_dup_acks = 0
+        self.fast_retransmit_count = 0
+        self.timeout_count = 0
+        # The timeouts since the last new ack, the RTO doubles for each of them
+        self.timeout_backoff = 0
+
+    def on_packet_sent(self, seq_num, data_item):
+        data_item.send_time = self.loop.time()
+        # One timer for the oldest packet in flight
+        if self.timer is None:
+            self.reset_timer()
+
+    def reset_timer(self):
+        if self.timer is not None:
+            self.timer.cancel()
+        self.timer = self.loop.call_later(self.rto_estimator.get_rto(self.timeout_backoff), self.handle_timeout)
+
+    def stop_timers(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+    def resend_window(self, fast=False):
+        # Resend all the packets in the window, starting from send_base
+        seq_num = self.send_base
+        for pos in range(0, len(self.packet_queue)):
+            self.udp_send(self.frame_pool.frame(seq_num))
+            self.resend_count += 1
+            self.metrics.on_resend(seq_num, fast)
+            # Karn's algorithm: never measure RTT of the retransmitted packet
+            self.packet_queue.get(pos).send_time = None
+            seq_num = (seq_num + 1) % self.seq_space
+
+    def handle_timeout(self):
+        self.timer = None
+        if self.packet_queue.is_empty():
+            return
+
+        self.timeout_count += 1
+        self.timeout_backoff += 1
+        self.metrics.on_timeout(len(self.packet_queue))
+        self.congestion.on_timeout()
+        self.resend_window()
+        self.reset_timer()
+
+    def handle_ack(self, ack_seq):
+        # GBN is a cumulative acknowledgment protocol. we need to focus on the latest ack
+        # The last ack is always the one before send_base
+        ack_pos_change = (ack_seq + 1 - self.send_base) % self.seq_space
+        if ack_pos_change == 0:
+            self.metrics.on_dup_ack(ack_seq)
+            self.handle_dup_ack()
+            return
+        if ack_pos_change > len(self.packet_queue):
+            # An old ack from the previous round of sequence numbers
+            return
+
+        self.metrics.on_ack(ack_seq)
+        # The window slides over the acked items at once
+        data_item = self.packet_queue.get(ack_pos_change - 1)
+        self.packet_queue.slide(ack_pos_change)
+        self.send_base = (ack_seq + 1) % self.seq_space
+        # Measure RTT by the newest acked packet
+        rtt = None
+        if data_item.send_time is not None:
+            rtt = self.loop.time() - data_item.send_time
+            self.rto_estimator.update(rtt)
+            self.metrics.on_rtt(rtt)
+        self.timeout_backoff = 0
+        self.congestion.on_ack(ack_pos_change, rtt)
+        self.dup_ack_count = 0
+        self.in_fast_recovery = False
+
+        if self.packet_queue.is_empty():
+            self.stop_timers()
+        else:
+            self.reset_timer()
+
+    def handle_dup_ack(self):
+        self.dup_ack_count += 1
+        self.total_dup_acks += 1
+        if self.dup_ack_threshold <= 0 or self.in_fast_recovery or self.packet_queue.is_empty():
+            return
+        if self.dup_ack_count < self.dup_ack_threshold:
+            return
+
+        self.fast_retransmit_count += 1
+        self.in_fast_recovery = True
+        self.congestion.on_loss()
+        self.resend_window(True)
+        self.reset_timer()
+
+
+class SRSender(SenderProtocol):
+    def __init__(self, server_address, sack=True, **kwargs):
+        super().__init__(server_address, **kwargs)
+        # Propose selective acks, they are used if the receiver accepts
+        self.sack = sack
+        self.sack_enabled = False
+
+    def make_negotiate_options(self):
+        options = super().make_negotiate_options()
+        # The receiver buffers no more packets than the sender sends
+        options[util.OPTION_RECEIVE_WINDOW] = struct.pack('!I', self.max_window_size)
+        if self.sack:
+            options[util.OPTION_SACK] = bytes([1])
+        return options
+
+    def on_negotiated(self, options):
+        self.sack_enabled = util.OPTION_SACK in options
+
+    def on_packet_sent(self, seq_num, data_item):
+        data_item.send_time = self.loop.time()
+        self.start_timer(seq_num, data_item)
+
+    def start_timer(self, seq_num, data_item):
+        rto = self.rto_estimator.get_rto(data_item.timeout_count)
+        data_item.timer = self.loop.call_later(rto, self.handle_timeout, seq_num, data_item)
+
+    def stop_timers(self):
+        for pos in range(0, len(self.packet_queue)):
+            data_item = self.packet_queue.get(pos)
+            if data_item.timer is not None:
+                data_item.timer.cancel()
+
+    def handle_timeout(self, seq_num, data_item):
+        # Resend the expired packet only. The losses of one window are one loss event
+        self.metrics.on_timeout(1)
+        self.congestion.on_loss()
+        self.udp_send(self.frame_pool.frame(seq_num))
+        self.resend_count += 1
+        self.metrics.on_resend(seq_num)
+        # Karn's algorithm: never measure RTT of the retransmitted packet
+        data_item.timeout_count += 1
+        self.start_timer(seq_num, data_item)
+
+    def handle_ack(self, ack_seq):
+        if (ack_seq - self.send_base) % self.seq_space >= len(self.packet_queue):
+            return
+        data_item = self.packet_queue.items[ack_seq % self.packet_queue.size]
+        if data_item.acked:
+            return
+
+        self.metrics.on_ack(ack_seq)
+        rtt = self.mark_acked(data_item, self.loop.time())
+        if rtt is not None:
+            self.rto_estimator.update(rtt)
+            self.metrics.on_rtt(rtt)
+        self.congestion.on_ack(1, rtt)
+        self.dequeue_acked()
+
+    def handle_sack(self, cumulative_ack, sack_bitmap):
+        """
+        Update the whole window from one selective ack, then resend the packets it shows lost
+        """
+        queue = self.packet_queue
+        queue_length = len(queue)
+        # Positions are counted from send_base, bit i of the bitmap is the position cumulative_pos + i
+        cumulative_pos = (cumulative_ack + 1 - self.send_base) % self.seq_space
+        if cumulative_pos > queue_length:
+            # An old ack delayed by the link
+            return
+
+        self.metrics.on_ack(cumulative_ack)
+        now = self.loop.time()
+        acked_num = 0
+        rtt = None
+        acked_positions = list(range(0, cumulative_pos))
+        while sack_bitmap:
+            lowest_bit = sack_bitmap & -sack_bitmap
+            sack_bitmap ^= lowest_bit
+            pos = cumulative_pos + lowest_bit.bit_length() - 1
+            if pos >= queue_length:
+                break
+            acked_positions.append(pos)
+
+        for pos in acked_positions:
+            data_item = queue.get(pos)
+            if data_item.acked:
+                continue
+            acked_num += 1
+            sample = self.mark_acked(data_item, now)
+            if sample is not None:
+                rtt = sample
+        if acked_num == 0:
+            return
+        if rtt is not None:
+            self.rto_estimator.update(rtt)
+            self.metrics.on_rtt(rtt)
+        self.congestion.on_ack(acked_num, rtt)
+
+        # Like the forward acknowledgment of TCP, resend once the packets after the gap are acked
+        lost = False
+        highest_pos = acked_positions[-1] if acked_positions else -1
+        for pos in range(0, highest_pos - REORDER_THRESHOLD + 1):
+            data_item = queue.get(pos)
+            if data_item.acked or data_item.fast_retransmitted:
+                continue
+            seq_num = (self.send_base + pos) % self.seq_space
+            self.udp_send(self.frame_pool.frame(seq_num))
+            self.resend_count += 1
+            self.metrics.on_resend(seq_num, True)
+            data_item.fast_retransmitted = True
+            data_item.timer.cancel()
+            self.start_timer(seq_num, data_item)
+            lost = True
+        if lost:
+            self.congestion.on_loss()
+        self.dequeue_acked()
+
+    def mark_acked(self, data_item, now):
+        """
+        @return: the RTT sample of the packet, None if it's retransmitted
+        """
+        data_item.acked = True
+        data_item.timer.cancel()
+        # Karn's algorithm: never measure RTT of the retransmitted packet
+        if data_item.timeout_count or data_item.fast_retransmitted:
+            return None
+        return now - data_item.send_time
+
+    def dequeue_acked(self):
+        # The window slides over the acked items at its front at once
+        queue = self.packet_queue
+        acked_num = 0
+        while acked_num < len(queue) and queue.get(acked_num).acked:
+            acked_num += 1
+        queue.slide(acked_num)
+        self.send_base = (self.send_base + acked_num) % self.seq_space
+
+
+class ReceiverProtocol(asyncio.DatagramProtocol):
+    """
+    The common part of the GBN and SR receivers: negotiation and closing
+    The subclasses handle the data packets
+    """
+    def __init__(self, server_address, loss_rate=LOSS_RATE, channel_options=None,
+                 checksum_types=util.CHECKSUM_PREFERENCE, max_version=util.VERSION_2, metrics=None):
+        self.server_address = server_address
+        self.loss_rate = loss_rate
+        self.channel_options = channel_options
+        self.checksum_types = checksum_types
+        self.max_version = max_version
+        # Version 1 with the legacy checksum is used until the client negotiates another one
+        self.set_header(util.PacketHeader())
+        self.negotiated = False
+        self.client_address = None
+        self.loop = None
+        self.transport = None
+        self.channel = None
+        self.output_stream = None
+        self.done = None
+        # The end packet is acked once the close handshake is negotiated, then the sender confirms the ack
+        self.close_enabled = False
+        self.close_acked = False
+        self.confirmed = None
+        # The events of the transfer are counted and traced by the metrics, see metrics.Metrics
+        self.metrics = metrics if metrics is not None else rdt_metrics.NULL_METRICS
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def connection_lost(self, exc):
+        if self.done is not None and not self.done.done():
+            self.done.set_exception(exc or ConnectionError('The transport is closed'))
+
+    def udp_send(self, pkt):
+        if not self.channel.send(pkt, self.client_address):
+            self.metrics.on_loss(channel.get_pkt_length(pkt))
+
+    def make_pkt(self, ackSeq):
+        return self.header.make_ack(ackSeq)
+
+    def set_header(self, header):
+        self.header = header
+
+    def get_window_scale(self):
+        return 0
+
+    def make_negotiate_options(self):
+        options = {
+            util.OPTION_CHECKSUM: bytes([self.header.checksum_type]),
+            util.OPTION_VERSION: bytes([self.header.version]),
+        }
+        if self.close_enabled:
+            options[util.OPTION_CLOSE] = b''
+        return options
+
+    def on_negotiated(self, options):
+        pass
+
+    def stop_timers(self):
+        pass
+
+    def handle_negotiate(self, pkt):
+        """
+        Choose the protocol version and checksum algorithm once, the response is resent for every repeated request
+        """
+        if not self.negotiated:
+            options = util.analyse_negotiate_pkt(pkt)
+            proposed = options.get(util.OPTION_CHECKSUM, bytes([util.CHECKSUM_LEGACY]))
+            version = util.choose_version(options, self.max_version)
+            self.set_header(util.PacketHeader(version, util.choose_checksum(proposed, self.checksum_types),
+                                              self.get_window_scale()))
+            self.close_enabled = util.OPTION_CLOSE in options
+            self.on_negotiated(options)
+            self.negotiated = True
+            logger.info('Server negotiated version and checksum: %d %d', version, self.header.checksum_type)
+        self.udp_send(util.make_negotiate_pkt(self.make_negotiate_options()))
+
+    def handle_close(self, data, address):
+        # After the transfer, the end packet is acked again until the sender confirms the close
+        if address != self.client_address or not data[1] & util.FLAG_FIN:
+            return
+        if data[1] & util.FLAG_END:
+            self.udp_send(util.make_close_pkt(True))
+        elif self.confirmed is not None and not self.confirmed.done():
+            self.confirmed.set_result(None)
+
+    def datagram_received(self, data, address):
+        if len(data) < 2:
+            return
+        if self.done.done():
+            self.handle_close(data, address)
+            return
+        self.client_address = address
+        if data[1] & util.FLAG_NEGOTIATE:
+            self.handle_negotiate(data)
+            return
+
+        analysed = self.header.analyse_pkt(data)
+        if analysed is None:
+            return
+        seq_num, end_flag, checksum, payload = analysed
+        if end_flag:
+            # The transfer is complete
+            if end_flag & util.FLAG_FIN:
+                self.udp_send(util.make_close_pkt(True))
+                self.close_acked = True
+            self.done.set_result(None)
+            return
+        self.handle_data(seq_num, checksum, payload)
+
+    async def receive(self, output_stream):
+        self.loop = asyncio.get_running_loop()
+        await self.loop.create_datagram_endpoint(lambda: self, local_addr=self.server_address)
+        self.channel = channel.make_channel(self.transport, self.loss_rate, self.channel_options, self.loop)
+        self.output_stream = output_stream
+        self.done = self.loop.create_future()
+        try:
+            await self.done
+            if self.close_acked:
+                self.confirmed = self.loop.create_future()
+                try:
+                    await asyncio.wait_for(self.confirmed, CLOSE_LINGER)
+                except asyncio.TimeoutError:
+                    pass
+            await asyncio.sleep(self.channel.pending_time())
+        finally:
+            self.stop_timers()
+            output_stream.close()
+            self.channel.close()
+            self.transport.close()
+
+
+class GBNReceiver(ReceiverProtocol):
+    def __init__(self, server_address, **kwargs):
+        super().__init__(server_address, **kwargs)
+        self.expect_seq = 0
+
+    def handle_data(self, seq_num, checksum, data):
+        self.metrics.on_receive(seq_num, len(data))
+        if seq_num == self.expect_seq and util.get_checksum(data, self.header.checksum_type) == checksum:
+            # Only accept the packet in order.
+            self.udp_send(self.make_pkt(seq_num))
+            self.metrics.on_ack_sent(seq_num)
+            self.expect_seq = (self.expect_seq + 1) % self.header.seq_space
+            self.output_stream.write(data)
+            self.metrics.on_deliver(len(data))
+        else:
+            # When receive packet out of order, abandon it and send the ack num to client
+            seq_space = self.header.seq_space
+            if seq_num == self.expect_seq:
+                self.metrics.on_corrupt(seq_num)
+            elif (seq_num - self.expect_seq) % seq_space < seq_space // 2:
+                self.metrics.on_out_of_order(seq_num)
+            else:
+                # Resent after its ack is lost
+                self.metrics.on_duplicate(seq_num)
+            self.udp_send(self.make_pkt((self.expect_seq - 1) % seq_space))
+            self.metrics.on_ack_sent((self.expect_seq - 1) % seq_space)
+
+
+class SRReceiver(ReceiverProtocol):
+    def __init__(self, server_address, window_size=WINDOW_SIZE, sack=True, ack_every=ACK_EVERY, ack_delay=ACK_DELAY,
+                 **kwargs):
+        self.max_window_size = window_size
+        super().__init__(server_address, **kwargs)
+        # The sequence number of the queue front
+        self.rcv_base = 0
+        # Selective acks are sent once negotiated. Bit i of the bitmap is set if packet rcv_base + i is buffered
+        self.sack = sack
+        self.sack_enabled = False
+        self.sack_bitmap = 0
+        self.ack_every = ack_every
+        self.ack_delay = ack_delay
+        # The packets received since the last ack, and the timer of the delayed ack
+        self.unacked_num = 0
+        self.ack_timer = None
+
+    def set_header(self, header):
+        super().set_header(header)
+        if header.version == util.VERSION_1:
+            # The sequence numbers are the queue positions, the window can't be larger than half of them
+            self.window_size = min(self.max_window_size, QUEUE_MAX_SIZE // 2)
+            queue_size = QUEUE_MAX_SIZE
+        else:
+            self.window_size = self.max_window_size
+            queue_size = util.get_queue_size(self.window_size, header.seq_space)
+        # The reorder buffer, the packet of seq num is in slot seq num % size
+        self.packet_queue = util.SlidingWindow(queue_size)
+        # The receive time of each packet received out of order
+        self.receive_times = [0] * queue_size
+
+    def get_window_scale(self):
+        return util.get_window_scale(self.max_window_size)
+
+    def make_negotiate_options(self):
+        # The receive window is told to the client in version 2
+        options = super().make_negotiate_options()
+        if self.header.version >= util.VERSION_2:
+            options[util.OPTION_RECEIVE_WINDOW] = struct.pack('!I', self.window_size)
+            options[util.OPTION_WINDOW_SCALE] = bytes([self.header.window_scale])
+        if self.sack_enabled:
+            options[util.OPTION_SACK] = bytes([1])
+        return options
+
+    def on_negotiated(self, options):
+        # The selective ack needs the version 2 header
+        self.sack_enabled = self.sack and self.header.version >= util.VERSION_2 and util.OPTION_SACK in options
+        # The sender sends no more than its own window, the reorder buffer isn't larger
+        window_size = util.get_option_int(options, util.OPTION_RECEIVE_WINDOW, self.max_window_size)
+        if window_size < self.max_window_size:
+            self.max_window_size = window_size
+            self.set_header(self.header)
+
+    def stop_timers(self):
+        if self.ack_timer is not None:
+            self.ack_timer.cancel()
+
+    def make_pkt(self, ackSeq):
+        return self.header.make_ack(ackSeq, self.window_size)
+
+    def acknowledge(self, seq_num, immediate=False):
+        """
+        Ack the packet at once, or delay the selective ack so it covers more packets
+        @param immediate: send the selective ack now, the sender should know about the gap at once
+        """
+        if not self.sack_enabled:
+            self.udp_send(self.make_pkt(seq_num))
+            self.metrics.on_ack_sent(seq_num)
+            return
+
+        self.unacked_num += 1
+        if immediate or self.unacked_num >= self.ack_every:
+            self.send_sack()
+        elif self.ack_timer is None:
+            self.ack_timer = self.loop.call_later(self.ack_delay, self.send_sack)
+
+    def send_sack(self):
+        self.unacked_num = 0
+        self.stop_timers()
+        self.ack_timer = None
+        cumulative_ack = (self.rcv_base - 1) % self.header.seq_space
+        self.udp_send(self.header.make_sack(cumulative_ack, self.window_size, self.sack_bitmap))
+        self.metrics.on_ack_sent(cumulative_ack)
+
+    def handle_data(self, seq_num, checksum, data):
+        if util.get_checksum(data, self.header.checksum_type) != checksum:
+            # The packet is corrupted, drop it without ack and wait for the retransmission
+            self.metrics.on_corrupt(seq_num)
+            return
+
+        packet_queue = self.packet_queue
+        seq_space = self.header.seq_space
+        # The position of the packet from the window base
+        seq_pos = (seq_num - self.rcv_base) % seq_space
+        if seq_pos < self.window_size:
+            # Items are in the next window, buffer them. Every datagram is a new bytes object
+            self.metrics.on_receive(seq_num, len(data))
+            if self.sack_bitmap >> seq_pos & 1:
+                # The item is buffered before. The ack may be lost, ack it again at once
+                self.metrics.on_duplicate(seq_num)
+                self.acknowledge(seq_num, True)
+                return
+            if seq_pos > 0:
+                # It waits for the gap before it, the wait is the deliver latency
+                self.metrics.on_out_of_order(seq_num)
+                self.receive_times[seq_num % packet_queue.size] = self.loop.time()
+            packet_queue.put(seq_pos, data)
+            # A packet after a gap starts a new block of the bitmap
+            new_block = seq_pos > 0 and not self.sack_bitmap >> (seq_pos - 1) & 1
+            self.sack_bitmap |= 1 << seq_pos
+        elif (self.rcv_base - seq_num) % seq_space <= self.window_size:
+            # Items are in the previous window size, send ack back immediately
+            self.metrics.on_receive(seq_num, len(data))
+            self.metrics.on_duplicate(seq_num)
+            self.acknowledge(seq_num, True)
+            return
+        else:
+            return
+
+        # Deliver the consecutive packets from the window base at once, the trailing ones of the bitmap
+        deliver_num = (~self.sack_bitmap & (self.sack_bitmap + 1)).bit_length() - 1
+        if deliver_num > 1:
+            now = self.loop.time()
+            for i in range(1, deliver_num):
+                self.metrics.on_deliver_latency(now - self.receive_times[(self.rcv_base + i) % packet_queue.size])
+        for data in packet_queue.take(deliver_num):
+            self.output_stream.write(data)
+            self.metrics.on_deliver(len(data))
+        self.rcv_base = (self.rcv_base + deliver_num) % seq_space
+        self.sack_bitmap >>= deliver_num
+        # Ack after the delivery, so the cumulative ack covers it. Filling a gap is told at once
+        self.acknowledge(seq_num, new_block or deliver_num > 1)
@@ -0,0 +1,279 @@
+"""
+This module benchmarks the throughput of the protocols.
+
+The sender and the receiver run on one asyncio loop over an emulated high-latency link.
+The throughput grows with the window until the window covers the bandwidth-delay product of the link.
+The congestion control policies are compared on a lossy link, their cwnd traces are exported as CSV.
+The log of the protocols is discarded during the run.
+
+The sweep runs the threaded servers and clients, GBNServer/GBNClient and SRServer/SRClient, in one process over
+the loopback. Each run transfers a seeded random payload over a link with the given loss rate and one way
+delay in both directions, the impairments are seeded too, and reports the goodput, the retransmission ratio,
+the time to completion and the CPU time of the process. The results are exported as JSON or CSV.
+
+Usage:
+    python benchmark.py
+    python benchmark.py sweep results.json results.csv
+
+Author:
+    Aaron Li
+"""
+import asyncio
+import contextlib
+import csv
+import io
+import json
+import os
+import platform
+import random
+import sys
+import threading
+import time
+
+import async_rdt
+import common_util as util
+import congestion
+import gbn_client
+import gbn_server
+import sr_client
+import sr_server
+
+WINDOW_SIZES = [16, 64, 256, 1024, 4096]
+# One way delay of the emulated link, the RTT is twice of it
+LINK_DELAY = 0.05
+# Bytes per second, the bandwidth-delay product is about 500 packets
+LINK_BANDWIDTH = 10 * 1024 * 1024
+PAYLOAD_SIZE = 4 * 1024 * 1024
+BENCHMARK_PORT = 9890
+POLICIES = [congestion.POLICY_FIXED, congestion.POLICY_AIMD, congestion.POLICY_CUBIC]
+COMPARISON_LOSS_RATE = 0.01
+COMPARISON_WINDOW_SIZE = 1024
+# The parameters swept by default, every combination is run
+SWEEP_PROTOCOLS = ['gbn', 'sr']
+SWEEP_LOSS_RATES = [0, 0.01, 0.05]
+SWEEP_DELAYS = [0, 0.01]
+SWEEP_WINDOW_SIZES = [16, 64]
+SWEEP_PAYLOAD_SIZES = [256 * 1024]
+SWEEP_SEED = 1
+# A run is given up once it takes this long, e.g. the end packets are all lost
+SWEEP_RUN_TIMEOUT = 120
+SWEEP_FIELDS = ['protocol', 'loss_rate', 'delay', 'window_size', 'payload_size', 'seed', 'completed',
+                'seconds', 'cpu_seconds', 'goodput', 'packets', 'resent', 'retransmission_ratio']
+
+
+class SinkStream(io.BytesIO):
+    # Keep the received data when the receiver closes the stream
+    def close(self):
+        self.received = self.getvalue()
+
+
+async def run_transfer(protocol, payload, window_size, server_address, channel_options=None, sender_options=None):
+    """
+    Send the payload from a sender to a receiver on the running loop
+    @param sender_options: the other keyword arguments of the sender, e.g. {'congestion_control': 'cubic'}
+    @return: seconds of the transfer and the sender
+    """
+    sender_options = dict(sender_options or {})
+    if protocol == 'gbn':
+        receiver = async_rdt.GBNReceiver(server_address, channel_options=channel_options)
+        sender = async_rdt.GBNSender(server_address, window_size=window_size, channel_options=channel_options,
+                                     **sender_options)
+    else:
+        receiver = async_rdt.SRReceiver(server_address, window_size=window_size, channel_options=channel_options)
+        sender = async_rdt.SRSender(server_address, window_size=window_size, channel_options=channel_options,
+                                    **sender_options)
+
+    output_stream = SinkStream()
+    receive_task = asyncio.ensure_future(receiver.receive(output_stream))
+    # Let the receiver bind its port
+    await asyncio.sleep(0.01)
+    start_time = time.monotonic()
+    await sender.send(io.BytesIO(payload))
+    await receive_task
+    elapsed = time.monotonic() - start_time
+    if output_stream.received != payload:
+        raise ValueError('The received data is different from the sent data')
+    return elapsed, sender
+
+
+def window_scaling(protocol='sr', window_sizes=WINDOW_SIZES, link_delay=LINK_DELAY, link_bandwidth=LINK_BANDWIDTH,
+                   payload_size=PAYLOAD_SIZE, version=util.VERSION_2, port=BENCHMARK_PORT):
+    """
+    Measure the throughput of each window size on a link with the given delay and bandwidth
+    @return: list of (window size, seconds, bytes per second)
+    """
+    payload = os.urandom(payload_size)
+    channel_options = {'delay': link_delay, 'bandwidth': link_bandwidth}
+    results = []
+
+    async def run_all():
+        for window_size in window_sizes:
+            elapsed, sender = await run_transfer(protocol, payload, window_size, ('127.0.0.1', port),
+                                                 channel_options, {'version': version})
+            results.append((window_size, elapsed, payload_size / elapsed))
+
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        asyncio.run(run_all())
+    return results
+
+
+def congestion_comparison(protocol='sr', policies=POLICIES, loss_rate=COMPARISON_LOSS_RATE,
+                          window_size=COMPARISON_WINDOW_SIZE, link_delay=LINK_DELAY, link_bandwidth=LINK_BANDWIDTH,
+                          payload_size=PAYLOAD_SIZE, trace_dir=None, port=BENCHMARK_PORT):
+    """
+    Measure the throughput of each congestion control policy on a lossy link
+    @param trace_dir: export the cwnd trace of each policy to <trace_dir>/<protocol>_<policy>.csv
+    @return: list of (policy, seconds, bytes per second, retransmissions)
+    """
+    payload = os.urandom(payload_size)
+    channel_options = {'delay': link_delay, 'bandwidth': link_bandwidth, 'loss_rate': loss_rate, 'seed': 1}
+    results = []
+
+    async def run_all():
+        for policy in policies:
+            sender_options = {'congestion_control': policy, 'congestion_options': {'trace': trace_dir is not None}}
+            elapsed, sender = await run_transfer(protocol, payload, window_size, ('127.0.0.1', port),
+                                                 channel_options, sender_options)
+            if trace_dir is not None:
+                sender.congestion.export_trace(os.path.join(trace_dir, '%s_%s.csv' % (protocol, policy)))
+            results.append((policy, elapsed, payload_size / elapsed, sender.resend_count))
+
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        asyncio.run(run_all())
+    return results
+
+
+def run_threaded_transfer(protocol, payload, window_size, loss_rate=0, delay=0, seed=SWEEP_SEED,
+                          server_ip='127.0.0.1', timeout=SWEEP_RUN_TIMEOUT):
+    """
+    Send the payload from a client to a server thread in this process
+    @param loss_rate: probability that a packet is lost, for the data and the acks
+    @param delay: one way delay in seconds, for the data and the acks
+    @return: dict of the measurements, see SWEEP_FIELDS
+    """
+    # The two directions are impaired independently, both reproducibly
+    server_options = {'delay': delay, 'seed': seed}
+    client_options = {'delay': delay, 'seed': seed + 1}
+    # The server binds a free port, so the runs don't wait for each other's ports
+    if protocol == 'gbn':
+        server = gbn_server.GBNServer((server_ip, 0), loss_rate, server_options)
+    else:
+        server = sr_server.SRServer((server_ip, 0), window_size, loss_rate, server_options)
+    server_address = server.server_socket.getsockname()
+    if protocol == 'gbn':
+        client = gbn_client.GBNClient(server_address, window_size=window_size, loss_rate=loss_rate,
+                                      channel_options=client_options)
+    else:
+        client = sr_client.SRClient(server_address, window_size=window_size, loss_rate=loss_rate,
+                                    channel_options=client_options)
+
+    output_stream = SinkStream()
+    output_stream.received = None
+    server_thread = threading.Thread(target=server.mdt_receive, args=(output_stream,), daemon=True)
+    start_time = time.monotonic()
+    start_cpu_time = time.process_time()
+    server_thread.start()
+    client.rdt_send(io.BytesIO(payload))
+    server_thread.join(timeout)
+    elapsed = time.monotonic() - start_time
+    cpu_time = time.process_time() - start_cpu_time
+    completed = not server_thread.is_alive()
+    if not completed:
+        # The server missed all the end packets, the socket is closed to stop the thread
+        server.close()
+    elif output_stream.received != payload:
+        raise ValueError('The received data is different from the sent data')
+
+    return {
+        'protocol': protocol,
+        'loss_rate': loss_rate,
+        'delay': delay,
+        'window_size': window_size,
+        'payload_size': len(payload),
+        'seed': seed,
+        'completed': completed,
+        'seconds': elapsed,
+        'cpu_seconds': cpu_time,
+        'goodput': len(payload) / elapsed if completed else 0,
+        'packets': client.packet_num,
+        'resent': client.resend_count,
+        'retransmission_ratio': client.resend_count / client.packet_num if client.packet_num else 0,
+    }
+
+
+def sweep(protocols=SWEEP_PROTOCOLS, loss_rates=SWEEP_LOSS_RATES, delays=SWEEP_DELAYS,
+          window_sizes=SWEEP_WINDOW_SIZES, payload_sizes=SWEEP_PAYLOAD_SIZES, seed=SWEEP_SEED, progress=None):
+    """
+    Run the threaded transfer of every combination of the parameters, the same seed gives the same
+    payloads and impairments
+    @param progress: called with the result of each run, e.g. to print it
+    @return: list of dicts, see run_threaded_transfer
+    """
+    results = []
+    for payload_size in payload_sizes:
+        payload = random.Random(seed).randbytes(payload_size)
+        for protocol in protocols:
+            for loss_rate in loss_rates:
+                for delay in delays:
+                    for window_size in window_sizes:
+                        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+                            result = run_threaded_transfer(protocol, payload, window_size, loss_rate, delay, seed)
+                        results.append(result)
+                        if progress is not None:
+                            progress(result)
+    return results
+
+
+def get_environment():
+    # Recorded with the results, the numbers are only comparable on the same machine
+    return {
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'platform': platform.platform(),
+        'machine': platform.machine(),
+        'cpu_count': os.cpu_count(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+    }
+
+
+def export_json(results, path):
+    with open(path, 'w') as output_file:
+        json.dump({'environment': get_environment(), 'results': results}, output_file, indent=2)
+
+
+def export_csv(results, path):
+    with open(path, 'w', newline='') as output_file:
+        writer = csv.DictWriter(output_file, fieldnames=SWEEP_FIELDS)
+        writer.writeheader()
+        writer.writerows(results)
+
+
+def print_result(result):
+    print('%4s %6.2f %8.0f %8d %10d %9.2f %9.2f %12.1f %8.3f' % (
+        result['protocol'], result['loss_rate'], result['delay'] * 1000, result['window_size'],
+        result['payload_size'], result['seconds'], result['cpu_seconds'], result['goodput'] / 1024,
+        result['retransmission_ratio']))
+
+
+if __name__ == '__main__' and len(sys.argv) > 1 and sys.argv[1] == 'sweep':
+    print('%4s %6s %8s %8s %10s %9s %9s %12s %8s' % ('', 'loss', 'delay ms', 'window', 'bytes', 'seconds',
+                                                     'cpu', 'KB/s', 'resent'))
+    sweep_results = sweep(progress=print_result)
+    for path in sys.argv[2:]:
+        if path.endswith('.csv'):
+            export_csv(sweep_results, path)
+        else:
+            export_json(sweep_results, path)
+elif __name__ == '__main__':
+    for protocol in ['sr', 'gbn']:
+        print('%s, payload %d bytes, RTT %.0f ms, link %d KB/s' % (protocol.upper(), PAYLOAD_SIZE, LINK_DELAY * 2000,
+                                                                     LINK_BANDWIDTH / 1024))
+        print('%8s %10s %14s' % ('window', 'seconds', 'KB/s'))
+        for window_size, elapsed, throughput in window_scaling(protocol):
+            print('%8d %10.2f %14.1f' % (window_size, elapsed, throughput / 1024))
+
+    for protocol in ['sr', 'gbn']:
+        print('%s, window %d, loss rate %.2f' % (protocol.upper(), COMPARISON_WINDOW_SIZE, COMPARISON_LOSS_RATE))
+        print('%8s %10s %14s %10s' % ('policy', 'seconds', 'KB/s', 'resent'))
+        for policy, elapsed, throughput, resend_count in congestion_comparison(protocol):
+            print('%8s %10.2f %14.1f %10d' % (policy, elapsed, throughput / 1024, resend_count))
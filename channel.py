@@ -0,0 +1,223 @@
+"""
+This module implements the channels that carry the packets of the protocols.
+
+UDPChannel sends the datagram straight to the socket.
+A packet is one buffer, or a list of buffers sent by scatter-gather I/O without concatenating them.
+EmulatedChannel impairs the link with loss, delay, jitter, reordering and bandwidth.
+The delayed packets are kept in a scheduler queue and sent by a background thread,
+so the sender never blocks. With an asyncio loop, the loop schedules them instead of the thread.
+The impairments are reproducible with a seed.
+
+The receivers drain the pending datagrams with recv_nowait until the socket would block (EAGAIN),
+so the per-wait work is done once for a burst of packets instead of once per packet.
+
+Author:
+    Aaron Li
+"""
+import heapq
+import itertools
+import random
+import select
+import socket
+import threading
+import time
+
+# At most this number of datagrams are drained at once, so the timers and the acks are not starved
+RECV_BATCH = 64
+# Not on every platform, select tells whether a datagram is pending instead
+MSG_DONTWAIT = getattr(socket, 'MSG_DONTWAIT', 0)
+
+
+def join_pkt(pkt):
+    # The packet as one buffer, the parts of a scatter-gather packet are copied
+    if isinstance(pkt, (list, tuple)):
+        return b''.join(pkt)
+    return pkt
+
+
+def get_pkt_length(pkt):
+    if isinstance(pkt, (list, tuple)):
+        return sum(len(part) for part in pkt)
+    return len(pkt)
+
+
+def recv_nowait(sock, buffer):
+    """
+    Read one pending datagram into the buffer without blocking
+    @return: the number of bytes and the address, None if no datagram is pending
+    """
+    try:
+        if MSG_DONTWAIT and sock.gettimeout() is None:
+            # A socket with a timeout waits for it before the flag is even tried
+            return sock.recvfrom_into(buffer, 0, MSG_DONTWAIT)
+        readable, writeable, errors = select.select([sock, ], [], [], 0)
+        if len(readable) == 0:
+            return None
+        return sock.recvfrom_into(buffer)
+    except (BlockingIOError, InterruptedError, socket.timeout):
+        return None
+
+
+def set_buffer_sizes(sock, send_buffer=None, receive_buffer=None):
+    """
+    Size the socket buffers, a burst larger than the receive buffer is dropped by the OS
+    Linux doubles the size for its bookkeeping and caps it by net.core.wmem_max and rmem_max
+    @param send_buffer: SO_SNDBUF in bytes, None keeps the default of the OS
+    @param receive_buffer: SO_RCVBUF in bytes, None keeps the default of the OS
+    @return: the send and receive buffer sizes given by the OS
+    """
+    if send_buffer is not None:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, send_buffer)
+    if receive_buffer is not None:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, receive_buffer)
+    return sock.getsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF), sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)
+
+
+class UDPChannel:
+    def __init__(self, sock):
+        self.sock = sock
+        # The parts of a packet are gathered by the kernel, not every platform has sendmsg
+        self.scatter_gather = hasattr(sock, 'sendmsg')
+
+    def send(self, pkt, address):
+        """
+        @param pkt: a buffer, or a list of buffers sent as one datagram
+        @return: whether the packet is put on the link, False if it is lost
+        """
+        if not isinstance(pkt, (list, tuple)):
+            self.sock.sendto(pkt, address)
+        elif self.scatter_gather:
+            self.sock.sendmsg(pkt, [], 0, address)
+        else:
+            self.sock.sendto(join_pkt(pkt), address)
+        return True
+
+    def pending_time(self):
+        """
+        @return: seconds until the packets in flight are delivered
+        """
+        return 0
+
+    def close(self):
+        pass
+
+
+class EmulatedChannel:
+    def __init__(self, sock, loss_rate=0, delay=0, jitter=0, reorder_rate=0, reorder_delay=None,
+                 bandwidth=0, seed=None, loop=None):
+        """
+        @param loss_rate: probability that a packet is lost
+        @param delay: one way delay in seconds
+        @param jitter: random extra delay in [0, jitter) seconds
+        @param reorder_rate: probability that a packet is held back to arrive after the later ones
+        @param reorder_delay: how long a reordered packet is held back, 2 * (delay + jitter) by default
+        @param bandwidth: link capacity in bytes per second, 0 means unlimited
+        @param seed: seed of the random generator, the same seed reproduces the same impairments
+        @param loop: the asyncio loop of the sender, sock is then its datagram transport
+        """
+        self.sock = sock
+        self.loss_rate = loss_rate
+        self.delay = delay
+        self.jitter = jitter
+        self.reorder_rate = reorder_rate
+        self.reorder_delay = reorder_delay if reorder_delay is not None else 2 * (delay + jitter) or 0.01
+        self.bandwidth = bandwidth
+        self.random = random.Random(seed)
+        # The time when the link finishes sending the previous packet
+        self.link_free_time = 0
+        # Heap of (deliver time, counter, packet, address)
+        self.schedule_queue = []
+        self.counter = itertools.count()
+        self.condition = threading.Condition()
+        self.closed = False
+        self.scheduler = None
+        self.loop = loop
+        self.last_deliver_time = 0
+
+    def send(self, pkt, address):
+        """
+        @return: whether the packet is put on the link, False if it is lost
+        """
+        if self.loss_rate > 0 and self.random.random() < self.loss_rate:
+            return False
+
+        now = time.monotonic()
+        deliver_time = now
+        if self.bandwidth > 0:
+            # The packet waits for the previous ones to be serialized on the link
+            self.link_free_time = max(self.link_free_time, now) + get_pkt_length(pkt) / self.bandwidth
+            deliver_time = self.link_free_time
+        deliver_time += self.delay
+        if self.jitter > 0:
+            deliver_time += self.random.uniform(0, self.jitter)
+        if self.reorder_rate > 0 and self.random.random() < self.reorder_rate:
+            deliver_time += self.reorder_delay
+
+        if deliver_time <= now:
+            # No impairment on time, zero overhead
+            self.sock.sendto(join_pkt(pkt), address)
+            return True
+
+        self.last_deliver_time = max(self.last_deliver_time, deliver_time)
+        if self.loop is not None:
+            # The transport is not thread safe, let the loop send it
+            self.loop.call_later(deliver_time - now, self.sock.sendto, bytes(join_pkt(pkt)), address)
+            return True
+
+        with self.condition:
+            if self.scheduler is None:
+                self.scheduler = threading.Thread(target=self.run_scheduler, daemon=True)
+                self.scheduler.start()
+            # The sender may reuse its buffer, keep a copy of the packet
+            heapq.heappush(self.schedule_queue, (deliver_time, next(self.counter), bytes(join_pkt(pkt)), address))
+            self.condition.notify()
+        return True
+
+    def run_scheduler(self):
+        with self.condition:
+            while True:
+                if not self.schedule_queue:
+                    if self.closed:
+                        return
+                    self.condition.wait()
+                    continue
+
+                deliver_time, _, pkt, address = self.schedule_queue[0]
+                wait_time = deliver_time - time.monotonic()
+                if wait_time > 0:
+                    self.condition.wait(wait_time)
+                    continue
+
+                heapq.heappop(self.schedule_queue)
+                try:
+                    self.sock.sendto(pkt, address)
+                except OSError:
+                    # The socket is closed, the packet is lost
+                    pass
+
+    def pending_time(self):
+        return max(self.last_deliver_time - time.monotonic(), 0)
+
+    def close(self):
+        """
+        Wait for the packets in flight to be delivered, then stop the scheduler
+        An asyncio sender should wait pending_time() before closing its transport instead
+        """
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+        if self.scheduler is not None:
+            self.scheduler.join()
+
+
+def make_channel(sock, loss_rate=0, channel_options=None, loop=None):
+    """
+    Make an emulated channel if any impairment is asked, the real UDP channel otherwise
+    @param channel_options: keyword arguments of EmulatedChannel, e.g. {'delay': 0.05, 'seed': 1}
+    @param loop: the asyncio loop when sock is a datagram transport
+    """
+    options = dict(channel_options or {})
+    options.setdefault('loss_rate', loss_rate)
+    if not any(value for key, value in options.items() if key != 'seed'):
+        return UDPChannel(sock)
+    return EmulatedChannel(sock, loop=loop, **options)
@@ -1,59 +1,671 @@
-def get_checksum(data):
+import hashlib
+import mmap
+import os
+import stat
+import struct
+import zlib
+
+try:
+    import numpy
+except ImportError:
+    # NumPy is optional, the checksum falls back to the big integer method
+    numpy = None
+
+PACKET_SIZE = 2048
+
+# Version 1 is the compatibility mode with 1-byte sequence numbers, reused modulo the queue size
+# Version 2 has 4-byte sequence numbers, the payload length and the receive window in acks
+VERSION_1 = 1
+VERSION_2 = 2
+SEQ_SPACE_V1 = 32
+SEQ_SPACE_V2 = 2 ** 32
+
+# The second byte of every packet is the flags
+FLAG_END = 0x01
+FLAG_ACK = 0x01
+FLAG_NEGOTIATE = 0x02
+# The ack is cumulative and followed by the bitmap of the packets received after the gap
+FLAG_SACK = 0x04
+# The chunk query of the deduplication and its response, see dedup
+FLAG_QUERY = 0x08
+# The path MTU probe and its response, see pmtu
+FLAG_PROBE = 0x10
+# The parity packet of the forward error correction and the loss report of the server, see fec
+FLAG_PARITY = 0x20
+# The close handshake: the end packet with FLAG_FIN asks for an ack, the server answers FLAG_FIN | FLAG_ACK
+# and the client confirms the answer with FLAG_FIN alone, see make_close_pkt
+FLAG_FIN = 0x40
+
+# Options carried by the negotiation packet, encoded as type, length, value
+OPTION_CHECKSUM = 1
+OPTION_CONNECTION_ID = 2
+OPTION_VERSION = 3
+OPTION_RECEIVE_WINDOW = 4
+OPTION_WINDOW_SCALE = 5
+OPTION_SACK = 6
+# Asked by a resumable client, answered with the number of packets the server has from the previous runs
+OPTION_RESUME = 7
+# The client sends the deduplicated stream if the server accepts, see dedup
+OPTION_DEDUP = 8
+# The codec of the compressed stream, see compression
+OPTION_COMPRESSION = 9
+# The payload size of the data packets, proposed by the client and capped by the server
+OPTION_MSS = 10
+# The forward error correction schemes proposed by the client, answered with the chosen one, see fec
+OPTION_FEC = 11
+# The client sends the end packet until the server acks it, instead of repeating it
+OPTION_CLOSE = 12
+
+CHECKSUM_LEGACY = 0
+CHECKSUM_INTERNET = 1
+CHECKSUM_CRC32 = 2
+# The client proposes the algorithms in this order, the server picks the first one it supports
+CHECKSUM_PREFERENCE = [CHECKSUM_CRC32, CHECKSUM_INTERNET, CHECKSUM_LEGACY]
+
+
+def legacy_checksum(data):
+    """
+    The checksum of the first versions, which summed the characters of str(data) and kept the lowest 8 bits
+    str() of bytes is their repr, b'...' with escapes, so the sum is over the ASCII repr and not the bytes.
+    It's kept byte for byte, the clients without negotiation still use it
+    """
+    return sum(repr(bytes(data)).encode('ascii')) & 0xFF
+
+
+def internet_checksum(data):
+    """
+    The Internet checksum (RFC 1071): ones' complement of the ones' complement sum of 16-bit words
+    With NumPy the words are summed in bulk. Without it, since 2^16 = 1 (mod 0xFFFF), the sum of all
+    the big-endian words equals the whole data read as one big integer modulo 0xFFFF
+    """
+    if numpy is not None:
+        total = int(numpy.frombuffer(data, dtype='>u2', count=len(data) // 2).sum(dtype=numpy.uint64))
+        if len(data) % 2 == 1:
+            # Pad the odd byte to a full word
+            total += data[-1] << 8
+    else:
+        total = int.from_bytes(data, byteorder='big')
+        if len(data) % 2 == 1:
+            total <<= 8
+    word_sum = total % 0xFFFF
+    if word_sum == 0 and total != 0:
+        # Ones' complement has two zeros, the sum of non-zero words is the negative one
+        word_sum = 0xFFFF
+    return ~word_sum & 0xFFFF
+
+
+def crc32_checksum(data):
+    return zlib.crc32(data) & 0xFFFFFFFF
+
+
+# Algorithm id: (checksum function, format of the checksum field in the header)
+# The checksum field is widened to fit the algorithm
+CHECKSUM_ALGORITHMS = {
+    CHECKSUM_LEGACY: (legacy_checksum, 'B'),
+    CHECKSUM_INTERNET: (internet_checksum, 'H'),
+    CHECKSUM_CRC32: (crc32_checksum, 'I'),
+}
+# The version 1 header with the legacy checksum, and the largest header of all
+HEADER_SIZE = struct.calcsize('!BBB')
+HEADER_MAX_SIZE = struct.calcsize('!BBIHI')
+
+
+def get_checksum(data, checksum_type=CHECKSUM_LEGACY):
+    """
+    Get the checksum of data with the given algorithm
+    @param data: bytes or any buffer such as memoryview
+    """
+    return CHECKSUM_ALGORITHMS[checksum_type][0](data)
+
+
+def choose_checksum(proposed, supported):
     """
-    Get the checksum by sum all the value of string
-    @param data: input string
+    Choose the first proposed algorithm which is supported, the legacy one if none of them
     """
-    checksum = 0
-    for i in range(0, len(str(data))):
-        checksum += int.from_bytes(bytes(str(data)[i], encoding='utf-8'), byteorder='little', signed=False)
-        checksum &= 0xFF
+    for checksum_type in proposed:
+        if checksum_type in supported and checksum_type in CHECKSUM_ALGORITHMS:
+            return checksum_type
+    return CHECKSUM_LEGACY
 
-    return checksum
 
+def choose_version(options, max_version=VERSION_2):
+    # The clients without the option only know version 1
+    return min(get_option_int(options, OPTION_VERSION, VERSION_1), max_version)
 
-def generate_packets(input_data):
+
+def encode_options(options):
     """
-    Split the input data into packets
+    Encode the {option type: bytes value} dict as type, length, value items
     """
-    data_list = []
-    while True:
-        data = input_data.read(2048)
-        if len(data) <= 0:
-            break
-        data_list.append(data)
-    return data_list
+    return b''.join(struct.pack('BB', option_type, len(value)) + value for option_type, value in options.items())
+
+
+def decode_options(data):
+    options = {}
+    pos = 0
+    while pos + 2 <= len(data):
+        option_type, length = data[pos], data[pos + 1]
+        options[option_type] = bytes(data[pos + 2:pos + 2 + length])
+        pos += 2 + length
+    return options
+
+
+def get_window_scale(window_size):
+    # The smallest shift to fit the window into the 2-byte field of the ack
+    window_scale = 0
+    while window_size >> window_scale > 0xFFFF:
+        window_scale += 1
+    return window_scale
+
+
+def get_option_int(options, option_type, default=None):
+    # Integer options are big-endian with the length of the option
+    if option_type not in options:
+        return default
+    return int.from_bytes(options[option_type], byteorder='big')
+
 
+def get_connection_id(options):
+    # The clients without the option share the connection id 0
+    if OPTION_CONNECTION_ID not in options:
+        return 0
+    return struct.unpack('!I', options[OPTION_CONNECTION_ID])[0]
 
-class CircularQueue:
+
+def get_transfer_id(input_data):
+    """
+    The id of a resumable transfer, the same file gets the same id in every run
+    @return: 32-bit id of the name, size and modification time of the file, None if it's not a file
+    """
+    try:
+        file_stat = os.fstat(input_data.fileno())
+    except (AttributeError, OSError, ValueError):
+        return None
+    if not stat.S_ISREG(file_stat.st_mode):
+        return None
+    name = os.path.basename(str(getattr(input_data, 'name', '')))
+    return zlib.crc32(('%s:%d:%d' % (name, file_stat.st_size, file_stat.st_mtime_ns)).encode())
+
+
+def make_negotiate_pkt(options):
+    return struct.pack('BB', 0, FLAG_NEGOTIATE) + encode_options(options)
+
+
+def analyse_negotiate_pkt(pkt):
+    return decode_options(pkt[2:])
+
+
+def make_close_pkt(ack):
+    """
+    The packet doesn't depend on the header of the transfer, so a closed session is answered too
+    @param ack: True for the ack of the end packet by the server, False for the confirmation of the client
+    """
+    return struct.pack('BB', 0, FLAG_FIN | FLAG_ACK if ack else FLAG_FIN)
+
+
+class PacketHeader:
+    """
+    The packet layout of a protocol version with a checksum algorithm
+    Version 1, the compatibility mode:
+        data: seq num (1 byte), flags, checksum
+        ack: seq num (1 byte), flags
+    Version 2:
+        data: version, flags, seq num (4 bytes), payload length (2 bytes), checksum
+        ack: version, flags, seq num (4 bytes), receive window >> window scale (2 bytes)
+        selective ack: the ack header with FLAG_SACK, then the little-endian bitmap of the received packets
+                       seq num acks all the packets up to it, bit i acks seq num + 1 + i
+    The second byte is always the flags, so the negotiation packet is recognized by any version
+    """
+    def __init__(self, version=VERSION_1, checksum_type=CHECKSUM_LEGACY, window_scale=0):
+        checksum_format = CHECKSUM_ALGORITHMS[checksum_type][1]
+        self.version = version
+        self.checksum_type = checksum_type
+        self.window_scale = window_scale
+        if version == VERSION_1:
+            self.data_struct = struct.Struct('!BB' + checksum_format)
+            self.ack_struct = struct.Struct('!BB')
+            self.seq_space = SEQ_SPACE_V1
+        else:
+            self.data_struct = struct.Struct('!BBIH' + checksum_format)
+            self.ack_struct = struct.Struct('!BBIH')
+            self.seq_space = SEQ_SPACE_V2
+        self.size = self.data_struct.size
+
+    def pack_into(self, buffer, seq_num, flags, checksum, length):
+        if self.version == VERSION_1:
+            self.data_struct.pack_into(buffer, 0, seq_num, flags, checksum)
+        else:
+            self.data_struct.pack_into(buffer, 0, self.version, flags, seq_num, length, checksum)
+
+    def make_pkt(self, seq_num, data, checksum, flags=0):
+        pkt = bytearray(self.size + len(data))
+        self.pack_into(pkt, seq_num, flags, checksum, len(data))
+        pkt[self.size:] = data
+        return pkt
+
+    def analyse_pkt(self, pkt):
+        """
+        @return: seq num, flags, checksum and the payload, None if the packet is truncated
+        """
+        if len(pkt) < self.size:
+            return None
+        if self.version == VERSION_1:
+            seq_num, flags, checksum = self.data_struct.unpack_from(pkt)
+            return seq_num, flags, checksum, pkt[self.size:]
+
+        version, flags, seq_num, length, checksum = self.data_struct.unpack_from(pkt)
+        if len(pkt) < self.size + length:
+            return None
+        return seq_num, flags, checksum, pkt[self.size:self.size + length]
+
+    def make_ack(self, ack_seq, window=0):
+        if self.version == VERSION_1:
+            return self.ack_struct.pack(ack_seq, FLAG_ACK)
+        return self.ack_struct.pack(self.version, FLAG_ACK, ack_seq, min(window >> self.window_scale, 0xFFFF))
+
+    def make_sack(self, cumulative_ack, window, sack_bitmap):
+        """
+        Acknowledge the whole receive window in one packet, only in version 2
+        @param sack_bitmap: int, bit i is set if packet cumulative_ack + 1 + i is received
+        """
+        header = self.ack_struct.pack(self.version, FLAG_ACK | FLAG_SACK, cumulative_ack,
+                                      min(window >> self.window_scale, 0xFFFF))
+        return header + sack_bitmap.to_bytes((sack_bitmap.bit_length() + 7) // 8, byteorder='little')
+
+    def analyse_ack(self, pkt):
+        """
+        @return: ack seq num, the receive window and the sack bitmap, None if the packet is truncated
+        The window is None in version 1, the bitmap is None if it's not a selective ack
+        """
+        if len(pkt) < self.ack_struct.size:
+            return None
+        if self.version == VERSION_1:
+            return pkt[0], None, None
+        version, flags, ack_seq, window = self.ack_struct.unpack_from(pkt)
+        sack_bitmap = None
+        if flags & FLAG_SACK:
+            sack_bitmap = int.from_bytes(pkt[self.ack_struct.size:], byteorder='little')
+        return ack_seq, window << self.window_scale, sack_bitmap
+
+
+# The header of the clients which don't negotiate
+LEGACY_HEADER = PacketHeader()
+
+
+def is_legacy_start(pkt):
+    """
+    Whether the packet may open a transfer without negotiation: only the first data packet of a version 1
+    client does, seq num 0 with its legacy checksum verified. A stray or late packet doesn't take a sink
+    """
+    analysed = LEGACY_HEADER.analyse_pkt(pkt)
+    if analysed is None:
+        return False
+    seq_num, flags, checksum, data = analysed
+    return seq_num == 0 and flags == 0 and legacy_checksum(data) == checksum
+
+
+class PacketReader:
+    """
+    Read the input stream packet by packet, only as far ahead as the sender asks
+    Regular files are mapped into memory, so reading a packet doesn't need a syscall
+    """
+    def __init__(self, input_data, packet_size=PACKET_SIZE):
+        self.input_data = input_data
+        self.packet_size = packet_size
+        self.mapped = None
+        self.mapped_view = None
+        self.offset = 0
+        try:
+            file_stat = os.fstat(input_data.fileno())
+            if stat.S_ISREG(file_stat.st_mode) and file_stat.st_size > 0:
+                self.offset = input_data.tell()
+                self.mapped = mmap.mmap(input_data.fileno(), 0, access=mmap.ACCESS_READ)
+                self.mapped_view = memoryview(self.mapped)
+        except (AttributeError, OSError, ValueError):
+            # Not a regular file, e.g. a pipe, socket or memory stream
+            self.mapped = None
+
+    def read(self):
+        if self.mapped is None:
+            return self.input_data.read(self.packet_size)
+        data = self.mapped[self.offset:self.offset + self.packet_size]
+        self.offset += len(data)
+        return data
+
+    def skip(self, size):
+        # Skip the bytes the receiver already has
+        if self.mapped is not None:
+            self.offset += size
+            return
+        try:
+            self.input_data.seek(size, os.SEEK_CUR)
+        except (AttributeError, OSError, ValueError):
+            # Not seekable, e.g. a pipe
+            while size > 0:
+                data = self.input_data.read(min(size, self.packet_size))
+                if not data:
+                    break
+                size -= len(data)
+
+    def read_view(self):
+        """
+        Take the next packet of a mapped file as a view of the mapping, nothing is copied
+        The view must be released before the reader is closed
+        @return: the memoryview of the packet, empty at the end of stream
+        """
+        view = self.mapped_view[self.offset:self.offset + self.packet_size]
+        self.offset += len(view)
+        return view
+
+    def read_into(self, buffer):
+        """
+        Read at most one packet into the buffer without creating a new bytes object
+        @return: the number of bytes read, 0 at the end of stream
+        """
+        size = min(len(buffer), self.packet_size)
+        if self.mapped is not None:
+            length = min(size, len(self.mapped) - self.offset)
+            buffer[:length] = self.mapped_view[self.offset:self.offset + length]
+            self.offset += length
+            return length
+
+        if not hasattr(self.input_data, 'readinto'):
+            data = self.input_data.read(size)
+            buffer[:len(data)] = data
+            return len(data)
+
+        # readinto may return less than asked for pipes and sockets, fill the packet as much as possible
+        length = 0
+        while length < size:
+            read_size = self.input_data.readinto(buffer[length:size])
+            if not read_size:
+                break
+            length += read_size
+        return length
+
+    def close(self):
+        if self.mapped is not None:
+            self.mapped_view.release()
+            self.mapped.close()
+            self.mapped = None
+            self.mapped_view = None
+
+
+CHUNKER_FIXED = 'fixed'
+CHUNKER_CONTENT = 'content'
+# The average chunk size, content-defined chunks are between a quarter of it and 8 times of it
+CHUNK_SIZE = 8192
+# Gear hash table of the content-defined chunker, the same on every host
+GEAR_TABLE = [int.from_bytes(hashlib.sha256(bytes([i])).digest()[:8], byteorder='big') for i in range(256)]
+
+
+def get_max_chunk_size(chunker=CHUNKER_CONTENT, chunk_size=CHUNK_SIZE):
+    return chunk_size if chunker == CHUNKER_FIXED else chunk_size * 8
+
+
+def get_chunk_length(data, start, chunker=CHUNKER_CONTENT, chunk_size=CHUNK_SIZE):
+    """
+    The chunk at start only depends on the data up to get_max_chunk_size after start,
+    so a stream can be chunked a buffer at a time with the same cuts as the whole data
+    @return: the length of the chunk at start
+    """
+    end = min(start + get_max_chunk_size(chunker, chunk_size), len(data))
+    if chunker == CHUNKER_FIXED:
+        return end - start
+
+    min_size = chunk_size // 4
+    mask = (chunk_size - 1) << (64 - chunk_size.bit_length() + 1)
+    gear_hash = 0
+    for pos in range(start + min_size, end):
+        gear_hash = ((gear_hash << 1) + GEAR_TABLE[data[pos]]) & 0xFFFFFFFFFFFFFFFF
+        if not gear_hash & mask:
+            return pos + 1 - start
+    return end - start
+
+
+def split_chunks(data, chunker=CHUNKER_CONTENT, chunk_size=CHUNK_SIZE):
+    """
+    Split the data into chunks for the deduplication
+    The fixed chunks move when bytes are inserted, the content-defined ones are cut where the gear hash of
+    the last 64 bytes has its top bits zero, so an edit only changes the chunks around it
+    @param chunk_size: the average chunk size, a power of two
+    @return: list of (offset, length)
+    """
+    chunks = []
+    start = 0
+    while start < len(data):
+        length = get_chunk_length(data, start, chunker, chunk_size)
+        chunks.append((start, length))
+        start += length
+    return chunks
+
+
+class FramePool:
+    """
+    Preformatted packet buffers, one for each sequence number, the slot is seq num % size
+    The header is packed in place and the payload is read straight into the buffer,
+    so a retransmission sends the cached frame again without rebuilding or re-checksumming it
+    With scatter-gather I/O, the payload of a mapped file isn't copied at all: the frame only has the header
+    and the packet is the list of the header and the view of the mapping
+    """
+    def __init__(self, size, packet_size=PACKET_SIZE, header=None, preallocate=True, scatter_gather=False):
+        """
+        @param preallocate: False to create the frames only when they are swapped in
+        @param scatter_gather: send the payload of a mapped file from the mapping, call release before closing it
+        """
+        self.size = size
+        self.frame_size = HEADER_MAX_SIZE + packet_size
+        self.frames = [bytearray(self.frame_size) if preallocate else None for _ in range(size)]
+        self.views = [memoryview(frame) if frame is not None else None for frame in self.frames]
+        self.lengths = [0] * size
+        self.scatter_gather = scatter_gather
+        # The payload views of the mapped file, None if the payload is in the frame
+        self.payloads = [None] * size
+        self.set_header(header or PacketHeader())
+
+    def set_header(self, header):
+        # Only change it before any frame is filled, the header size changes with it
+        self.header = header
+        self.header_size = header.size
+
+    def fill(self, seq_num, reader):
+        """
+        Read the next packet of reader into the frame of seq_num
+        @return: the payload length, 0 at the end of stream
+        """
+        slot = seq_num % self.size
+        view = self.views[slot]
+        header_size = self.header_size
+        if self.scatter_gather and reader.mapped is not None:
+            payload = reader.read_view()
+            length = len(payload)
+            self.payloads[slot] = payload
+            self.lengths[slot] = length
+            if length > 0:
+                self.header.pack_into(view, seq_num, 0, get_checksum(payload, self.header.checksum_type), length)
+            return length
+
+        self.payloads[slot] = None
+        length = reader.read_into(view[header_size:])
+        self.lengths[slot] = length
+        if length > 0:
+            checksum = get_checksum(view[header_size:header_size + length], self.header.checksum_type)
+            self.header.pack_into(view, seq_num, 0, checksum, length)
+        return length
+
+    def frame(self, seq_num):
+        slot = seq_num % self.size
+        payload = self.payloads[slot]
+        if payload is not None:
+            return [self.views[slot][:self.header_size], payload]
+        return self.views[slot][:self.header_size + self.lengths[slot]]
+
+    def payload(self, seq_num):
+        # The payload of the frame of seq_num, without the header
+        slot = seq_num % self.size
+        payload = self.payloads[slot]
+        if payload is not None:
+            return payload
+        return self.views[slot][self.header_size:self.header_size + self.lengths[slot]]
+
+    def release(self):
+        # Drop the views of the mapped file, so the reader can close it
+        for payload in self.payloads:
+            if payload is not None:
+                payload.release()
+        self.payloads = [None] * self.size
+
+    def swap(self, seq_num, frame):
+        """
+        Put a received frame into the slot of seq_num and give back the replaced one for the next receive
+        """
+        slot = seq_num % self.size
+        old_frame = self.frames[slot]
+        self.frames[slot] = frame
+        self.views[slot] = memoryview(frame)
+        if old_frame is None:
+            old_frame = bytearray(len(frame))
+        return old_frame
+
+    def grow(self, new_size, front_seq, count):
+        """
+        Enlarge the pool, the count frames from front_seq keep their sequence numbers
+        """
+        frames = [None] * new_size
+        lengths = [0] * new_size
+        payloads = [None] * new_size
+        for i in range(count):
+            frames[(front_seq + i) % new_size] = self.frames[(front_seq + i) % self.size]
+            lengths[(front_seq + i) % new_size] = self.lengths[(front_seq + i) % self.size]
+            payloads[(front_seq + i) % new_size] = self.payloads[(front_seq + i) % self.size]
+        self.size = new_size
+        self.frames = [frame if frame is not None else bytearray(self.frame_size) for frame in frames]
+        self.views = [memoryview(frame) for frame in self.frames]
+        self.lengths = lengths
+        self.payloads = payloads
+
+
+class WindowEntry:
+    """
+    The send state of one packet in the window of a sender
+    """
+    __slots__ = ('length', 'sent', 'acked', 'send_time', 'deadline', 'timer', 'timeout_count', 'fast_retransmitted')
+
+    def __init__(self, length):
+        self.length = length
+        self.sent = False
+        self.acked = False
+        # None once the packet is resent in GBN, Karn's algorithm never measures its RTT
+        self.send_time = None
+        # The retransmission timer of the packet: its deadline in the timer heap, or its event loop handle
+        self.deadline = 0
+        self.timer = None
+        self.timeout_count = 0
+        # Whether the packet is resent by a selective ack
+        self.fast_retransmitted = False
+
+
+class SlidingWindow:
+    """
+    The items of consecutive sequence numbers from the window base, the item of seq num is in slot seq num % size
+    A sender keeps a WindowEntry for each packet in flight, a receiver buffers the out-of-order packets in it
+    The base slides over any number of items at once, and the items are read in place from their slots,
+    so the window is iterated without copying it
+    """
     def __init__(self, size):
         self.size = size
-        self.queue = [None] * size
-        self.front = self.rear = 0
+        self.items = [None] * size
+        # The slot of the base, and the number of items from it
+        self.front = 0
+        self.count = 0
 
-    def is_full(self):
-        return (self.rear + 1) % self.size == self.front
+    def __len__(self):
+        return self.count
 
     def is_empty(self):
-        return self.front == self.rear
+        return self.count == 0
 
-    def enqueue(self, item):
-        if self.is_full():
-            return
-        self.queue[self.rear] = item
-        self.rear = (self.rear + 1) % self.size
+    def append(self, item):
+        self.items[(self.front + self.count) % self.size] = item
+        self.count += 1
 
-    def dequeue(self):
-        if self.is_empty():
-            return None
-        item = self.queue[self.front]
-        self.queue[self.front] = None
-        self.front = (self.front + 1) % self.size
-        return item
+    def get(self, pos):
+        # The item at the position from the base
+        return self.items[(self.front + pos) % self.size]
 
-    def peek(self):
-        if self.is_empty():
-            return None
-        return self.queue[self.front]
+    def put(self, pos, item):
+        # Put the item at the position from the base, the window extends to it
+        self.items[(self.front + pos) % self.size] = item
+        if pos >= self.count:
+            self.count = pos + 1
+
+    def slide(self, num):
+        # Move the base over num items, their slots are reused by the later items
+        self.front = (self.front + num) % self.size
+        self.count -= num
+
+    def take(self, num):
+        """
+        Move the base over num items and give them back, their slots are cleared
+        """
+        items = []
+        for i in range(0, num):
+            slot = (self.front + i) % self.size
+            items.append(self.items[slot])
+            self.items[slot] = None
+        self.slide(num)
+        return items
+
+    def grow(self, new_size, front_seq):
+        """
+        Enlarge the window. The items are indexed by seq num % size, so they are placed again from front_seq
+        """
+        items = [self.get(pos) for pos in range(0, self.count)]
+        self.size = new_size
+        self.items = [None] * new_size
+        self.front = front_seq % new_size
+        for pos, item in enumerate(items):
+            self.items[(self.front + pos) % new_size] = item
+
+
+def get_queue_size(window_size, seq_space):
+    """
+    The smallest power of two queue holding the window, so it divides the sequence space
+    """
+    size = 2
+    while size <= window_size:
+        size *= 2
+    return min(size, seq_space)
+
+
+class RTOEstimator:
+    """
+    Estimate the retransmission timeout from measured RTT (RFC 6298)
+    SRTT and RTTVAR are smoothed by each sample, RTO = SRTT + K * RTTVAR
+    A packet timed out n times waits RTO * 2^n before the next retransmission
+    """
+    def __init__(self, initial_rto=1.0, min_rto=0.2, max_rto=60.0, alpha=0.125, beta=0.25, k=4):
+        self.srtt = None
+        self.rttvar = None
+        self.rto = initial_rto
+        self.min_rto = min_rto
+        self.max_rto = max_rto
+        self.alpha = alpha
+        self.beta = beta
+        self.k = k
+
+    def update(self, rtt):
+        if self.srtt is None:
+            # The first measurement
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = (1 - self.beta) * self.rttvar + self.beta * abs(self.srtt - rtt)
+            self.srtt = (1 - self.alpha) * self.srtt + self.alpha * rtt
+        self.rto = min(max(self.srtt + self.k * self.rttvar, self.min_rto), self.max_rto)
 
-    def queue_length(self):
-        return (self.rear - self.front + self.size) % self.size
\ No newline at end of file
+    def get_rto(self, backoff=0):
+        """
+        @param backoff: the number of timeouts of the packet
+        """
+        return min(self.rto * (2 ** backoff), self.max_rto)
@@ -0,0 +1,185 @@
+"""
+This module implements the compression stage of the transfers.
+
+The client compresses the stream before it's split into packets, with a stdlib codec chosen per transfer,
+and the server decompresses the received stream as it's delivered. The first blocks are compressed as a
+sample first: incompressible data, e.g. JPEG, is sent raw, so it doesn't pay for the compression.
+
+Usage:
+    client = sr_client.SRClient(server_address, codec=compression.CODEC_ZLIB)
+
+Author:
+    Aaron Li
+"""
+import io
+import logging
+import lzma
+import zlib
+
+logger = logging.getLogger(__name__)
+
+CODEC_NONE = 0
+CODEC_ZLIB = 1
+CODEC_LZMA = 2
+CODECS = (CODEC_ZLIB, CODEC_LZMA)
+ZLIB_LEVEL = 6
+# Bytes compressed as the sample to decide whether the stream is compressed
+SAMPLE_SIZE = 64 * 1024
+# The stream is sent raw unless the sample is compressed to this ratio of its size
+BYPASS_RATIO = 0.9
+# Bytes read from the input stream at once
+BLOCK_SIZE = 64 * 1024
+
+
+def make_compressor(codec):
+    if codec == CODEC_ZLIB:
+        return zlib.compressobj(ZLIB_LEVEL)
+    if codec == CODEC_LZMA:
+        return lzma.LZMACompressor()
+    raise ValueError('Unknown codec: %s' % codec)
+
+
+def make_decompressor(codec):
+    if codec == CODEC_ZLIB:
+        return zlib.decompressobj()
+    if codec == CODEC_LZMA:
+        return lzma.LZMADecompressor()
+    raise ValueError('Unknown codec: %s' % codec)
+
+
+class PrefixReader(io.RawIOBase):
+    """
+    Read the bytes already taken from a stream, then the rest of the stream
+    """
+    def __init__(self, prefix, input_stream):
+        self.prefix = memoryview(prefix)
+        self.input_stream = input_stream
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        if len(self.prefix) > 0:
+            size = min(len(buffer), len(self.prefix))
+            buffer[:size] = self.prefix[:size]
+            self.prefix = self.prefix[size:]
+            return size
+        data = self.input_stream.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+    def close(self):
+        if not self.closed:
+            self.input_stream.close()
+        super().close()
+
+
+def sample_stream(input_stream, size=SAMPLE_SIZE):
+    """
+    Read the first blocks of the stream
+    @return: the sample and the stream, which starts from the beginning again
+    """
+    try:
+        if input_stream.seekable():
+            position = input_stream.tell()
+            sample = input_stream.read(size)
+            input_stream.seek(position)
+            return sample, input_stream
+    except AttributeError:
+        pass
+    # Not seekable, e.g. a pipe
+    sample = input_stream.read(size)
+    return sample, io.BufferedReader(PrefixReader(sample, input_stream))
+
+
+def choose_codec(sample, codec):
+    """
+    @return: the codec if it compresses the sample well enough, CODEC_NONE to send the stream raw
+    """
+    if codec == CODEC_NONE or len(sample) == 0:
+        return CODEC_NONE
+    compressor = make_compressor(codec)
+    size = len(compressor.compress(sample)) + len(compressor.flush())
+    logger.info('Client sample compression, bytes and compressed: %d %d', len(sample), size)
+    if size > len(sample) * BYPASS_RATIO:
+        return CODEC_NONE
+    return codec
+
+
+class CompressReader(io.RawIOBase):
+    """
+    The compressed stream of the input stream, read by the client like the file
+    """
+    def __init__(self, input_stream, codec):
+        self.input_stream = input_stream
+        self.compressor = make_compressor(codec)
+        self.pending = memoryview(b'')
+        self.raw_size = 0
+        self.compressed_size = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while len(self.pending) == 0:
+            if self.compressor is None:
+                return 0
+            data = self.input_stream.read(BLOCK_SIZE)
+            if data:
+                self.raw_size += len(data)
+                self.pending = memoryview(self.compressor.compress(data))
+            else:
+                self.pending = memoryview(self.compressor.flush())
+                self.compressor = None
+            self.compressed_size += len(self.pending)
+        size = min(len(buffer), len(self.pending))
+        buffer[:size] = self.pending[:size]
+        self.pending = self.pending[size:]
+        return size
+
+    def close(self):
+        if not self.closed:
+            self.input_stream.close()
+        super().close()
+
+
+class DecompressSink:
+    """
+    Decompress the received stream into the output stream as it's delivered
+    """
+    def __init__(self, output_stream, codec):
+        self.output_stream = output_stream
+        self.decompressor = make_decompressor(codec)
+        # Whether the compressed stream is corrupted or truncated, nothing is written after it
+        self.failed = False
+        self.error = None
+
+    def write(self, data):
+        if self.failed:
+            return
+        try:
+            self.output_stream.write(self.decompressor.decompress(data))
+        except (zlib.error, lzma.LZMAError) as e:
+            logger.warning('Server fail to decompress: %s', e)
+            self.fail('The compressed stream is corrupted: %s' % e)
+
+    def fail(self, error):
+        self.failed = True
+        self.error = error
+
+    def close(self):
+        """
+        The transfer fails if the stream can't be decompressed
+        @raise ValueError: the compressed stream is corrupted or truncated
+        """
+        if not self.failed:
+            try:
+                if hasattr(self.decompressor, 'flush'):
+                    self.output_stream.write(self.decompressor.flush())
+            except (zlib.error, lzma.LZMAError) as e:
+                self.fail('The compressed stream is corrupted: %s' % e)
+            if not self.failed and not self.decompressor.eof:
+                self.fail('The compressed stream is truncated')
+        self.output_stream.close()
+        if self.failed:
+            raise ValueError(self.error)
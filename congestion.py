@@ -0,0 +1,244 @@
+"""
+This module implements the congestion control of the senders.
+
+A controller drives the congestion window (cwnd) in packets from the events of the sender:
+    on_ack: new packets are acked, with the RTT sample if there is one
+    on_loss: a loss is detected by duplicate acks or by the timer of one packet
+    on_timeout: the timer of the whole window expires, the link may be broken
+The sender never has more packets in flight than the window of the controller.
+
+FixedWindow keeps the window constant, as the senders did before.
+AIMDController is TCP Reno: slow start, additive increase, multiplicative decrease.
+CubicController grows the window by a cubic function of the time since the last loss (RFC 8312).
+
+The emulated channel drops packets at random, which is not congestion. Like TCP Veno, a loss only
+decreases the window when the RTT shows a queue building up on the link:
+    backlog = cwnd * (rtt - min_rtt) / rtt
+A loss with a backlog below random_loss_threshold packets is taken as random and ignored.
+
+Author:
+    Aaron Li
+"""
+import csv
+import time
+
+POLICY_FIXED = 'fixed'
+POLICY_AIMD = 'aimd'
+POLICY_CUBIC = 'cubic'
+
+INITIAL_WINDOW = 4
+MIN_WINDOW = 2
+# Packets queued on the link before a loss is taken as congestion, TCP Veno uses 3
+RANDOM_LOSS_THRESHOLD = 3
+# CUBIC constants of RFC 8312
+CUBIC_C = 0.4
+CUBIC_BETA = 0.7
+
+
+class CongestionController:
+    """
+    The common part of the controllers: the window limit, the loss epochs and the trace
+    """
+    def __init__(self, max_window, initial_window=INITIAL_WINDOW, min_window=MIN_WINDOW,
+                 random_loss_threshold=RANDOM_LOSS_THRESHOLD, trace=False):
+        """
+        @param max_window: the window never grows beyond it, the window size of the sender
+        @param random_loss_threshold: the backlog in packets below which a loss is random, None takes every
+                                      loss as congestion like the classic TCP
+        @param trace: record (time, cwnd, ssthresh, event) of every change, see export_trace
+        """
+        self.max_window = max_window
+        self.min_window = min(min_window, max_window)
+        self.cwnd = float(min(max(initial_window, self.min_window), max_window))
+        self.ssthresh = float(max_window)
+        # The smoothed RTT, the losses within one RTT of the last decrease belong to the same loss event
+        self.rtt = None
+        # The RTT of an empty link
+        self.min_rtt = None
+        self.random_loss_threshold = random_loss_threshold
+        self.recovery_end = 0
+        self.trace_enabled = trace
+        self.trace = []
+        self.start_time = time.monotonic()
+        self.record('start')
+
+    def set_max_window(self, max_window):
+        # The window size of the negotiated version, set before sending
+        self.max_window = max_window
+        self.min_window = min(self.min_window, max_window)
+        self.ssthresh = float(max_window)
+        self.cwnd = min(self.cwnd, max_window)
+
+    def get_window(self):
+        return max(int(self.cwnd), 1)
+
+    def record(self, event):
+        if self.trace_enabled:
+            self.trace.append((time.monotonic() - self.start_time, self.cwnd, self.ssthresh, event))
+
+    def update_rtt(self, rtt):
+        if rtt is None:
+            return
+        self.rtt = rtt if self.rtt is None else 0.875 * self.rtt + 0.125 * rtt
+        self.min_rtt = rtt if self.min_rtt is None else min(self.min_rtt, rtt)
+
+    def is_random_loss(self):
+        if self.random_loss_threshold is None or self.rtt is None:
+            return False
+        backlog = self.cwnd * (self.rtt - self.min_rtt) / self.rtt
+        return backlog < self.random_loss_threshold
+
+    def start_recovery(self, event):
+        """
+        @return: whether this is a new congestion event, the window is decreased only once per event
+        """
+        now = time.monotonic()
+        if now < self.recovery_end:
+            return False
+        if self.is_random_loss():
+            self.record('random_' + event)
+            return False
+        self.recovery_end = now + (self.rtt or 0)
+        return True
+
+    def on_ack(self, acked_num, rtt=None):
+        self.update_rtt(rtt)
+        if self.cwnd < self.ssthresh:
+            # Slow start, the window doubles every RTT
+            self.cwnd = min(self.cwnd + acked_num, self.max_window)
+        else:
+            self.increase(acked_num)
+        self.record('ack')
+
+    def on_loss(self):
+        if not self.start_recovery('loss'):
+            return
+        self.decrease()
+        self.record('loss')
+
+    def on_timeout(self):
+        if not self.start_recovery('timeout'):
+            return
+        self.decrease()
+        # Nothing is known about the link any more, probe it again from the minimum window
+        self.cwnd = float(self.min_window)
+        self.record('timeout')
+
+    def increase(self, acked_num):
+        # Congestion avoidance
+        pass
+
+    def decrease(self):
+        pass
+
+    def export_trace(self, path):
+        """
+        Write the trace as CSV with the columns time, cwnd, ssthresh and event
+        """
+        with open(path, 'w', newline='') as trace_file:
+            writer = csv.writer(trace_file)
+            writer.writerow(['time', 'cwnd', 'ssthresh', 'event'])
+            for row in self.trace:
+                writer.writerow(row)
+
+
+class FixedWindow(CongestionController):
+    """
+    The baseline: the window is always max_window
+    """
+    def __init__(self, max_window, trace=False, **kwargs):
+        super().__init__(max_window, initial_window=max_window, min_window=max_window, trace=trace)
+
+    def on_ack(self, acked_num, rtt=None):
+        self.update_rtt(rtt)
+
+    def on_loss(self):
+        pass
+
+    def on_timeout(self):
+        pass
+
+    def set_max_window(self, max_window):
+        super().set_max_window(max_window)
+        self.cwnd = float(max_window)
+
+
+class AIMDController(CongestionController):
+    def increase(self, acked_num):
+        # One more packet every RTT
+        self.cwnd = min(self.cwnd + acked_num / self.cwnd, self.max_window)
+
+    def decrease(self):
+        # Half of the window for every loss event
+        self.ssthresh = max(self.cwnd / 2, self.min_window)
+        self.cwnd = self.ssthresh
+
+
+class CubicController(CongestionController):
+    def __init__(self, max_window, c=CUBIC_C, beta=CUBIC_BETA, **kwargs):
+        super().__init__(max_window, **kwargs)
+        self.c = c
+        self.beta = beta
+        # The window before the last loss, the plateau of the cubic function
+        self.w_max = 0
+        self.last_w_max = 0
+        # The time the current congestion avoidance epoch starts, None before the first ack of it
+        self.epoch_start = None
+        self.k = 0
+        self.origin = 0
+        # The window an AIMD sender would have, CUBIC is never slower than it
+        self.w_est = 0
+
+    def increase(self, acked_num):
+        now = time.monotonic()
+        if self.epoch_start is None:
+            self.epoch_start = now
+            if self.cwnd < self.w_max:
+                self.k = ((self.w_max - self.cwnd) / self.c) ** (1 / 3)
+                self.origin = self.w_max
+            else:
+                self.k = 0
+                self.origin = self.cwnd
+            self.w_est = self.cwnd
+
+        # The target is the window of the cubic function one RTT later
+        t = now - self.epoch_start + (self.rtt or 0)
+        target = self.origin + self.c * (t - self.k) ** 3
+        if target > self.cwnd:
+            self.cwnd += (target - self.cwnd) / self.cwnd * acked_num
+        else:
+            # Around the plateau, grow very slowly
+            self.cwnd += 0.01 / self.cwnd * acked_num
+
+        # TCP friendly region
+        self.w_est += 3 * (1 - self.beta) / (1 + self.beta) * acked_num / self.cwnd
+        self.cwnd = min(max(self.cwnd, self.w_est), self.max_window)
+
+    def decrease(self):
+        # Fast convergence: release the bandwidth for the new flows when the plateau drops
+        if self.cwnd < self.last_w_max:
+            self.w_max = self.cwnd * (1 + self.beta) / 2
+        else:
+            self.w_max = self.cwnd
+        self.last_w_max = self.w_max
+        self.ssthresh = max(self.cwnd * self.beta, self.min_window)
+        self.cwnd = self.ssthresh
+        self.epoch_start = None
+
+
+CONTROLLERS = {
+    POLICY_FIXED: FixedWindow,
+    POLICY_AIMD: AIMDController,
+    POLICY_CUBIC: CubicController,
+}
+
+
+def make_controller(policy, max_window, congestion_options=None):
+    """
+    @param policy: one of POLICY_FIXED, POLICY_AIMD and POLICY_CUBIC
+    @param max_window: the window size of the sender
+    @param congestion_options: keyword arguments of the controller, e.g. {'trace': True}
+    """
+    if policy not in CONTROLLERS:
+        raise ValueError('Unknown congestion control policy: %s' % policy)
+    return CONTROLLERS[policy](max_window, **(congestion_options or {}))
@@ -0,0 +1,259 @@
+"""
+This module implements the deduplication of repeated uploads.
+
+The client splits the file into chunks, see common_util.split_chunks, and asks the server which of them
+it has with query packets, a batch of chunk digests per packet. The server answers from its content
+store, an LRU cache of the chunks of the previous transfers, and pins the chunks it has for the transfer.
+Then the client sends the deduplicated stream over the normal transfer: a record for each chunk,
+the data of the new chunks and only the digest of the ones the server has.
+The stream is chunked and queried one batch at a time while it's sent, so the client holds a read buffer
+and one batch of chunks, never the whole file.
+
+Query packet:
+    0, FLAG_QUERY, connection id (4 bytes), query id (4 bytes), digests (DIGEST_SIZE bytes each)
+Response:
+    0, FLAG_QUERY, connection id (4 bytes), query id (4 bytes), bitmap, bit i is set if digest i is stored
+Record:
+    type (1 byte), chunk length (4 bytes), then the data of RECORD_DATA or the digest of RECORD_REFERENCE
+
+Author:
+    Aaron Li
+"""
+import collections
+import hashlib
+import io
+import logging
+import struct
+
+import common_util as util
+
+logger = logging.getLogger(__name__)
+
+DIGEST_SIZE = 16
+# Digests in one query packet
+QUERY_BATCH = 64
+QUERY_HEADER = struct.Struct('!BBII')
+RECORD_HEADER = struct.Struct('!BI')
+RECORD_DATA = 0
+RECORD_REFERENCE = 1
+# Bytes of the chunks kept by the content store of a server
+STORE_SIZE = 64 * 1024 * 1024
+# Bytes read from the input stream at once by the encoder
+READ_SIZE = 1024 * 1024
+
+
+def get_digest(chunk):
+    return hashlib.sha256(chunk).digest()[:DIGEST_SIZE]
+
+
+def make_query_pkt(connection_id, query_id, digests):
+    return QUERY_HEADER.pack(0, util.FLAG_QUERY, connection_id, query_id) + b''.join(digests)
+
+
+def analyse_query_pkt(pkt):
+    """
+    @return: connection id, query id and the digests, None if the packet is truncated
+    """
+    if len(pkt) < QUERY_HEADER.size:
+        return None
+    version, flags, connection_id, query_id = QUERY_HEADER.unpack_from(pkt)
+    body = bytes(pkt[QUERY_HEADER.size:])
+    return connection_id, query_id, [body[i:i + DIGEST_SIZE] for i in range(0, len(body), DIGEST_SIZE)]
+
+
+def make_response_pkt(connection_id, query_id, stored_bitmap, digest_num):
+    return (QUERY_HEADER.pack(0, util.FLAG_QUERY, connection_id, query_id)
+            + stored_bitmap.to_bytes((digest_num + 7) // 8, byteorder='little'))
+
+
+def analyse_response_pkt(pkt):
+    """
+    @return: connection id, query id and the stored bitmap, None if the packet is truncated
+    """
+    if len(pkt) < QUERY_HEADER.size:
+        return None
+    version, flags, connection_id, query_id = QUERY_HEADER.unpack_from(pkt)
+    return connection_id, query_id, int.from_bytes(pkt[QUERY_HEADER.size:], byteorder='little')
+
+
+class ChunkStore:
+    """
+    The chunks of the previous transfers by digest, the least recently used ones are evicted first
+    """
+    def __init__(self, max_size=STORE_SIZE):
+        self.max_size = max_size
+        self.size = 0
+        self.chunks = collections.OrderedDict()
+
+    def get(self, digest):
+        chunk = self.chunks.get(digest)
+        if chunk is not None:
+            self.chunks.move_to_end(digest)
+        return chunk
+
+    def put(self, digest, chunk):
+        if digest in self.chunks or len(chunk) > self.max_size:
+            return
+        self.chunks[digest] = chunk
+        self.size += len(chunk)
+        while self.size > self.max_size:
+            evicted_digest, evicted_chunk = self.chunks.popitem(last=False)
+            self.size -= len(evicted_chunk)
+
+
+class DedupSink:
+    """
+    Decode the records of the deduplicated stream into the output stream, and keep the new chunks in the store
+    """
+    def __init__(self, output_stream, chunk_store):
+        self.output_stream = output_stream
+        self.chunk_store = chunk_store
+        # The chunks the server told the client it has, they can't be evicted during the transfer
+        self.pinned = {}
+        self.buffer = bytearray()
+        # Whether a record refers to a chunk the server doesn't have, nothing is written after it
+        self.failed = False
+
+    def pin(self, digests):
+        """
+        @return: the bitmap of the stored digests
+        """
+        stored_bitmap = 0
+        for i, digest in enumerate(digests):
+            chunk = self.pinned.get(digest) or self.chunk_store.get(digest)
+            if chunk is not None:
+                self.pinned[digest] = chunk
+                stored_bitmap |= 1 << i
+        return stored_bitmap
+
+    def write(self, data):
+        if self.failed:
+            return
+        self.buffer += data
+        pos = 0
+        while len(self.buffer) - pos >= RECORD_HEADER.size:
+            record_type, length = RECORD_HEADER.unpack_from(self.buffer, pos)
+            body_size = length if record_type == RECORD_DATA else DIGEST_SIZE
+            if len(self.buffer) - pos - RECORD_HEADER.size < body_size:
+                break
+            body = bytes(self.buffer[pos + RECORD_HEADER.size:pos + RECORD_HEADER.size + body_size])
+            pos += RECORD_HEADER.size + body_size
+            if record_type == RECORD_DATA:
+                self.chunk_store.put(get_digest(body), body)
+                self.output_stream.write(body)
+                continue
+
+            chunk = self.pinned.get(body) or self.chunk_store.get(body)
+            if chunk is None or len(chunk) != length:
+                logger.warning('Server miss deduplicated chunk: %s', body.hex())
+                self.failed = True
+                self.buffer = bytearray()
+                return
+            self.output_stream.write(chunk)
+        del self.buffer[:pos]
+
+    def close(self):
+        """
+        The transfer fails if the stream can't be decoded
+        @raise ValueError: a record refers to a missing chunk or is truncated
+        """
+        truncated = len(self.buffer) > 0
+        self.buffer = bytearray()
+        self.pinned = {}
+        self.output_stream.close()
+        if self.failed:
+            raise ValueError('The deduplicated stream refers to a missing chunk')
+        if truncated:
+            raise ValueError('The deduplicated stream ends in a truncated record')
+
+
+class DedupEncoder(io.RawIOBase):
+    """
+    The deduplicated stream of the input stream, read by the client like the file
+    The chunks are cut and queried a batch at a time, when the records before them are read
+    """
+    def __init__(self, input_stream, query, chunker=util.CHUNKER_CONTENT):
+        """
+        @param query: called with a list of at most QUERY_BATCH digests, return the bitmap of the stored ones
+        """
+        self.input_stream = input_stream
+        self.query = query
+        self.chunker = chunker
+        self.max_chunk_size = util.get_max_chunk_size(chunker)
+        # The unchunked data of the stream from offset
+        self.buffer = bytearray()
+        self.offset = 0
+        self.end_of_stream = False
+        # The records of the queried batch
+        self.records = collections.deque()
+        self.pending = memoryview(b'')
+        # Bytes of the chunks sent as data, and as references
+        self.data_size = 0
+        self.reference_size = 0
+
+    def readable(self):
+        return True
+
+    def next_chunk(self):
+        """
+        @return: the next chunk of the stream, None at the end of it
+        """
+        if len(self.buffer) - self.offset < self.max_chunk_size and not self.end_of_stream:
+            # The cut may be anywhere up to the largest chunk, the buffer has all of it
+            del self.buffer[:self.offset]
+            self.offset = 0
+            while len(self.buffer) < READ_SIZE and not self.end_of_stream:
+                data = self.input_stream.read(READ_SIZE - len(self.buffer))
+                if not data:
+                    self.end_of_stream = True
+                self.buffer += data
+        if self.offset >= len(self.buffer):
+            return None
+        length = util.get_chunk_length(self.buffer, self.offset, self.chunker)
+        chunk = bytes(self.buffer[self.offset:self.offset + length])
+        self.offset += length
+        return chunk
+
+    def query_batch(self):
+        chunks = []
+        while len(chunks) < QUERY_BATCH:
+            chunk = self.next_chunk()
+            if chunk is None:
+                break
+            chunks.append(chunk)
+        if len(chunks) == 0:
+            return
+        digests = [get_digest(chunk) for chunk in chunks]
+        stored_bitmap = self.query(digests)
+        for i, chunk in enumerate(chunks):
+            if stored_bitmap >> i & 1:
+                self.reference_size += len(chunk)
+                self.records.append(RECORD_HEADER.pack(RECORD_REFERENCE, len(chunk)) + digests[i])
+            else:
+                self.data_size += len(chunk)
+                self.records.append(RECORD_HEADER.pack(RECORD_DATA, len(chunk)) + chunk)
+
+    def readinto(self, buffer):
+        while len(self.pending) == 0:
+            if len(self.records) == 0:
+                self.query_batch()
+                if len(self.records) == 0:
+                    return 0
+            self.pending = memoryview(self.records.popleft())
+        size = min(len(buffer), len(self.pending))
+        buffer[:size] = self.pending[:size]
+        self.pending = self.pending[size:]
+        return size
+
+    def close(self):
+        self.input_stream.close()
+        super().close()
+
+
+def encode(input_stream, query, chunker=util.CHUNKER_CONTENT):
+    """
+    Make the deduplicated stream of the input stream, the encoder closes the input stream
+    @param query: called with a list of at most QUERY_BATCH digests, return the bitmap of the stored ones
+    @return: the encoder, a readable raw stream
+    """
+    return DedupEncoder(input_stream, query, chunker)
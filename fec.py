@@ -0,0 +1,419 @@
+"""
+This module implements the forward error correction of the transfers.
+
+The client sends parity packets after each block of data packets, and the server rebuilds the lost data
+packets of a block from the parity without waiting for the retransmission. A block of n data packets
+with k parity packets survives the loss of:
+    XOR: one packet of each of the k interleaved groups, packet i is in group i % k, so a burst of k losses
+    Reed-Solomon: any k packets, the parity rows are a Cauchy matrix over GF(2^8). It needs NumPy
+
+The server reports the data packets of each block received before its first parity, and the client
+chooses the parity of the next blocks by the smoothed loss rate, see RedundancyController.
+
+The parity is computed over the symbols of the packets: the payload length (2 bytes), then the payload
+padded with zeros to the payload size of the transfer, so a rebuilt packet knows its length.
+A rebuilt packet has no checksum of its own to verify, so each parity packet carries the CRC32 of its
+header and symbol, and a corrupted one is dropped before it's used to rebuild a wrong packet.
+
+Parity packet:
+    0, FLAG_PARITY, first seq num (4 bytes), data packets of the block, parity index, parity packets
+    of the block, scheme, CRC32 of the packet before it (4 bytes), then the parity symbol
+Report:
+    0, FLAG_PARITY, first seq num (4 bytes), data packets of the block, data packets received
+
+Usage:
+    client = sr_client.SRClient(server_address, fec_scheme=fec.SCHEME_XOR)
+    client = sr_client.SRClient(server_address, fec_scheme=fec.SCHEME_RS, fec_block_size=32, fec_parity=4)
+
+Author:
+    Aaron Li
+"""
+import collections
+import math
+import struct
+
+import common_util as util
+
+try:
+    import numpy
+except ImportError:
+    # NumPy is optional, only the XOR parity is available without it
+    numpy = None
+
+SCHEME_NONE = 0
+SCHEME_XOR = 1
+SCHEME_RS = 2
+# The schemes of this host, the server picks the first one the client proposes
+SUPPORTED_SCHEMES = [SCHEME_RS, SCHEME_XOR] if numpy is not None else [SCHEME_XOR]
+BLOCK_SIZE = 16
+# The rows and the columns of the Cauchy matrix must be different field elements
+MAX_BLOCK_SIZE = 128
+MIN_PARITY = 1
+MAX_PARITY = 8
+# The parity of a block is the least one that loses the block with at most this probability
+TARGET_BLOCK_LOSS = 0.01
+# The weight of a new report in the smoothed loss rate
+LOSS_ALPHA = 0.25
+# The payloads kept by the decoder to rebuild the blocks in flight
+DECODER_CAPACITY = 4096
+# The blocks whose parity is kept by the decoder
+DECODER_BLOCKS = 256
+PARITY_HEADER = struct.Struct('!BBIBBBBI')
+# The fields of the parity header before the checksum
+PARITY_FIELDS = struct.Struct('!BBIBBBB')
+REPORT_PKT = struct.Struct('!BBIBB')
+SYMBOL_HEADER = struct.Struct('!H')
+# A parity packet is larger than a data packet of the same payload size by this, the receive frames of the
+# servers and the packet size of a probed path make room for it
+PARITY_OVERHEAD = PARITY_HEADER.size + SYMBOL_HEADER.size - util.HEADER_MAX_SIZE
+
+
+def make_gf_tables():
+    # GF(2^8) with the polynomial x^8 + x^4 + x^3 + x^2 + 1, the exponents are doubled to skip the modulo
+    exp_table = [0] * 512
+    log_table = [0] * 256
+    x = 1
+    for i in range(0, 255):
+        exp_table[i] = x
+        log_table[x] = i
+        x <<= 1
+        if x & 0x100:
+            x ^= 0x11d
+    for i in range(255, 512):
+        exp_table[i] = exp_table[i - 255]
+    return exp_table, log_table
+
+
+GF_EXP, GF_LOG = make_gf_tables()
+
+
+def gf_mul(a, b):
+    if a == 0 or b == 0:
+        return 0
+    return GF_EXP[GF_LOG[a] + GF_LOG[b]]
+
+
+def gf_inv(a):
+    return GF_EXP[255 - GF_LOG[a]]
+
+
+def get_coefficient(parity_index, data_index):
+    # The Cauchy matrix 1 / (x_j + y_i), x_j = j and y_i = 128 + i, so every square submatrix is invertible
+    return gf_inv(parity_index ^ (MAX_BLOCK_SIZE + data_index))
+
+
+if numpy is not None:
+    # MUL_TABLE[a][b] is a * b, a vector of symbols is multiplied by a in one lookup
+    MUL_TABLE = numpy.array([[gf_mul(a, b) for b in range(256)] for a in range(256)], dtype=numpy.uint8)
+
+
+def gf_invert_matrix(matrix):
+    """
+    Invert a square matrix over GF(2^8) by Gauss-Jordan elimination
+    """
+    size = len(matrix)
+    rows = [list(row) + [1 if i == j else 0 for j in range(size)] for i, row in enumerate(matrix)]
+    for column in range(0, size):
+        pivot = next(i for i in range(column, size) if rows[i][column] != 0)
+        rows[column], rows[pivot] = rows[pivot], rows[column]
+        scale = gf_inv(rows[column][column])
+        rows[column] = [gf_mul(value, scale) for value in rows[column]]
+        for i in range(0, size):
+            factor = rows[i][column]
+            if i != column and factor != 0:
+                rows[i] = [value ^ gf_mul(factor, pivot_value) for value, pivot_value in zip(rows[i], rows[column])]
+    return [row[size:] for row in rows]
+
+
+def make_symbol(payload, symbol_size):
+    symbol = bytearray(symbol_size)
+    SYMBOL_HEADER.pack_into(symbol, 0, len(payload))
+    symbol[SYMBOL_HEADER.size:SYMBOL_HEADER.size + len(payload)] = payload
+    return symbol
+
+
+def analyse_symbol(symbol):
+    """
+    @return: the payload of a rebuilt symbol, None if its length is broken
+    """
+    length = SYMBOL_HEADER.unpack_from(symbol)[0]
+    if SYMBOL_HEADER.size + length > len(symbol):
+        return None
+    return bytes(symbol[SYMBOL_HEADER.size:SYMBOL_HEADER.size + length])
+
+
+def get_parity_checksum(fields, parity):
+    return util.crc32_checksum(fields + parity)
+
+
+def make_parity_pkt(first_seq, count, parity_index, parity_num, scheme, parity):
+    fields = PARITY_FIELDS.pack(0, util.FLAG_PARITY, first_seq, count, parity_index, parity_num, scheme)
+    return fields + struct.pack('!I', get_parity_checksum(fields, parity)) + parity
+
+
+def analyse_parity_pkt(pkt):
+    """
+    @return: first seq num, data packets, parity index, parity packets, scheme and the parity symbol,
+             None if the packet is truncated or corrupted
+    """
+    if len(pkt) <= PARITY_HEADER.size:
+        return None
+    version, flags, first_seq, count, parity_index, parity_num, scheme, checksum = PARITY_HEADER.unpack_from(pkt)
+    parity = bytes(pkt[PARITY_HEADER.size:])
+    if get_parity_checksum(bytes(pkt[:PARITY_FIELDS.size]), parity) != checksum:
+        return None
+    return first_seq, count, parity_index, parity_num, scheme, parity
+
+
+def make_report_pkt(first_seq, count, received_num):
+    return REPORT_PKT.pack(0, util.FLAG_PARITY, first_seq, count, received_num)
+
+
+def analyse_report_pkt(pkt):
+    """
+    @return: first seq num, data packets and the received ones, None if the packet is truncated
+    """
+    if len(pkt) < REPORT_PKT.size:
+        return None
+    version, flags, first_seq, count, received_num = REPORT_PKT.unpack_from(pkt)
+    return first_seq, count, received_num
+
+
+def choose_scheme(proposed, supported=None):
+    # The first proposed scheme this host supports, SCHEME_NONE if there is none
+    supported = SUPPORTED_SCHEMES if supported is None else supported
+    for scheme in proposed:
+        if scheme in supported:
+            return scheme
+    return SCHEME_NONE
+
+
+def get_block_loss_probability(block_size, parity_num, loss_rate):
+    # More than parity_num of the packets of the block are lost, then the block needs the retransmissions
+    n = block_size + parity_num
+    return sum(math.comb(n, i) * loss_rate ** i * (1 - loss_rate) ** (n - i) for i in range(parity_num + 1, n + 1))
+
+
+class RedundancyController:
+    """
+    Choose the parity packets of each block by the loss rate reported by the server
+    """
+    def __init__(self, block_size=BLOCK_SIZE, parity_num=None, max_parity=MAX_PARITY):
+        """
+        @param parity_num: the parity of every block, None to adapt it to the loss rate
+        """
+        self.block_size = block_size
+        self.fixed_parity_num = parity_num
+        self.max_parity = max_parity
+        self.loss_rate = 0
+        self.parity_num = parity_num if parity_num is not None else MIN_PARITY
+
+    def on_report(self, count, received_num):
+        if count == 0 or received_num > count:
+            return
+        self.loss_rate += LOSS_ALPHA * (1 - received_num / count - self.loss_rate)
+        if self.fixed_parity_num is not None:
+            return
+        # A parity packet is always sent, the server reports only the blocks with parity
+        self.parity_num = self.max_parity
+        for parity_num in range(MIN_PARITY, self.max_parity + 1):
+            if get_block_loss_probability(self.block_size, parity_num, self.loss_rate) <= TARGET_BLOCK_LOSS:
+                self.parity_num = parity_num
+                break
+
+
+class FECEncoder:
+    """
+    Accumulate the parity of the block as its data packets are sent, the payloads aren't kept
+    """
+    def __init__(self, scheme, block_size=BLOCK_SIZE, packet_size=util.PACKET_SIZE):
+        if scheme == SCHEME_RS and numpy is None:
+            raise ValueError('Reed-Solomon parity needs NumPy')
+        if block_size > MAX_BLOCK_SIZE:
+            raise ValueError('The block size is at most %d' % MAX_BLOCK_SIZE)
+        self.scheme = scheme
+        self.block_size = block_size
+        self.symbol_size = SYMBOL_HEADER.size + packet_size
+        self.first_seq = 0
+        self.count = 0
+        self.parity_num = 0
+        self.parities = None
+
+    def add(self, seq_num, payload, parity_num):
+        """
+        @param parity_num: the parity of the block, taken at its first packet
+        @return: the parity packets once the block is full
+        """
+        if self.count == 0:
+            self.first_seq = seq_num
+            self.parity_num = max(MIN_PARITY, min(parity_num, MAX_PARITY))
+            if self.scheme == SCHEME_XOR:
+                self.parities = [0] * self.parity_num
+            else:
+                self.parities = [numpy.zeros(self.symbol_size, dtype=numpy.uint8) for _ in range(self.parity_num)]
+
+        symbol = make_symbol(payload, self.symbol_size)
+        if self.scheme == SCHEME_XOR:
+            self.parities[self.count % self.parity_num] ^= int.from_bytes(symbol, byteorder='big')
+        else:
+            symbol = numpy.frombuffer(symbol, dtype=numpy.uint8)
+            for j in range(0, self.parity_num):
+                self.parities[j] ^= MUL_TABLE[get_coefficient(j, self.count)][symbol]
+        self.count += 1
+        if self.count == self.block_size:
+            return self.flush()
+        return []
+
+    def flush(self):
+        """
+        @return: the parity packets of the partial block, e.g. at the end of the stream
+        """
+        pkts = []
+        # A short block may leave the last XOR groups empty
+        parity_num = self.parity_num if self.scheme == SCHEME_RS else min(self.parity_num, self.count)
+        for j in range(0, parity_num if self.count > 0 else 0):
+            if self.scheme == SCHEME_XOR:
+                parity = self.parities[j].to_bytes(self.symbol_size, byteorder='big')
+            else:
+                parity = self.parities[j].tobytes()
+            pkts.append(make_parity_pkt(self.first_seq, self.count, j, self.parity_num, self.scheme, parity))
+        self.count = 0
+        self.parities = None
+        return pkts
+
+
+class FECBlock:
+    def __init__(self, first_seq, count, parity_num, seq_space):
+        self.first_seq = first_seq
+        self.count = count
+        self.parity_num = parity_num
+        self.seq_space = seq_space
+        # Key: parity index, value: the parity symbol
+        self.parities = {}
+        # All the data packets are received or rebuilt
+        self.complete = False
+
+    def get_seq(self, index):
+        return (self.first_seq + index) % self.seq_space
+
+    def covers(self, seq_num):
+        return (seq_num - self.first_seq) % self.seq_space < self.count
+
+
+class FECDecoder:
+    """
+    Keep the recent payloads and the parity of the blocks in flight, and rebuild the lost packets
+    """
+    def __init__(self, scheme, capacity=DECODER_CAPACITY, seq_space=util.SEQ_SPACE_V2):
+        self.scheme = scheme
+        self.capacity = capacity
+        self.seq_space = seq_space
+        # Key: seq num, the payloads of the received and the rebuilt packets, the oldest ones are evicted
+        self.packets = collections.OrderedDict()
+        # Key: first seq num of the block
+        self.blocks = collections.OrderedDict()
+
+    def get(self, seq_num):
+        return self.packets.get(seq_num)
+
+    def add_data(self, seq_num, payload):
+        """
+        @return: list of (seq num, payload) rebuilt with the packet
+        """
+        if seq_num in self.packets:
+            return []
+        self.store(seq_num, bytes(payload))
+        recovered = []
+        for block in list(self.blocks.values()):
+            if not block.complete and block.parities and block.covers(seq_num):
+                recovered += self.recover(block)
+        return recovered
+
+    def add_parity(self, first_seq, count, parity_index, parity_num, parity):
+        """
+        @return: list of (seq num, payload) rebuilt, and the data packets of the block received before
+                 its first parity, None for the later parity packets
+        """
+        if count == 0 or count > MAX_BLOCK_SIZE or parity_index >= parity_num:
+            return [], None
+        block = self.blocks.get(first_seq)
+        received_num = None
+        if block is None:
+            block = FECBlock(first_seq, count, parity_num, self.seq_space)
+            self.blocks[first_seq] = block
+            if len(self.blocks) > DECODER_BLOCKS:
+                self.blocks.popitem(last=False)
+            received_num = sum(1 for i in range(0, count) if block.get_seq(i) in self.packets)
+        if block.complete or parity_index in block.parities:
+            return [], received_num
+        block.parities[parity_index] = parity
+        return self.recover(block), received_num
+
+    def store(self, seq_num, payload):
+        self.packets[seq_num] = payload
+        if len(self.packets) > self.capacity:
+            self.packets.popitem(last=False)
+
+    def recover(self, block):
+        """
+        @return: list of (seq num, payload) of the block rebuilt from its parity
+        """
+        missing = [i for i in range(0, block.count) if block.get_seq(i) not in self.packets]
+        if len(missing) == 0:
+            block.complete = True
+            return []
+        symbol_size = len(next(iter(block.parities.values())))
+        if self.scheme == SCHEME_XOR:
+            symbols = self.recover_xor(block, missing, symbol_size)
+        else:
+            symbols = self.recover_rs(block, missing, symbol_size)
+
+        recovered = []
+        for index, symbol in symbols:
+            payload = analyse_symbol(symbol)
+            if payload is None:
+                continue
+            seq_num = block.get_seq(index)
+            self.store(seq_num, payload)
+            recovered.append((seq_num, payload))
+        if len(recovered) == len(missing):
+            block.complete = True
+        return recovered
+
+    def recover_xor(self, block, missing, symbol_size):
+        # A group with one lost packet is rebuilt from its parity and the other packets of the group
+        symbols = []
+        for j, parity in block.parities.items():
+            group_missing = [i for i in missing if i % block.parity_num == j]
+            if len(group_missing) != 1:
+                continue
+            value = int.from_bytes(parity, byteorder='big')
+            for i in range(j, block.count, block.parity_num):
+                if i != group_missing[0]:
+                    value ^= int.from_bytes(make_symbol(self.packets[block.get_seq(i)], symbol_size), byteorder='big')
+            symbols.append((group_missing[0], value.to_bytes(symbol_size, byteorder='big')))
+        return symbols
+
+    def recover_rs(self, block, missing, symbol_size):
+        # Any len(missing) parity rows give a square system in the lost symbols
+        if numpy is None or len(missing) > len(block.parities):
+            return []
+        rows = sorted(block.parities)[:len(missing)]
+        received = [i for i in range(0, block.count) if i not in missing]
+        known_symbols = [numpy.frombuffer(make_symbol(self.packets[block.get_seq(i)], symbol_size), dtype=numpy.uint8)
+                         for i in received]
+        residuals = []
+        for j in rows:
+            residual = numpy.frombuffer(block.parities[j], dtype=numpy.uint8).copy()
+            for i, symbol in zip(received, known_symbols):
+                residual ^= MUL_TABLE[get_coefficient(j, i)][symbol]
+            residuals.append(residual)
+        inverse = gf_invert_matrix([[get_coefficient(j, i) for i in missing] for j in rows])
+
+        symbols = []
+        for c, index in enumerate(missing):
+            symbol = numpy.zeros(symbol_size, dtype=numpy.uint8)
+            for r in range(0, len(rows)):
+                symbol ^= MUL_TABLE[inverse[c][r]][residuals[r]]
+            symbols.append((index, symbol.tobytes()))
+        return symbols
@@ -4,171 +4,197 @@ This module implements the client of Go-Back-N Protocol.
 Author:
     Aaron Li
 """
+import logging
 import os
-import random
-import socket
-import struct
 import time
-import threading
-import common_util as util
-import select
-import copy
-
-BUFFER_SIZE = 4096
-TIMEOUT = 10
-WINDOW_SIZE = 10
-LOSS_RATE = 0.3
-QUEUE_MAX_SIZE = 32
-
-class GBNClient:
-    def __init__(self, server_address, timeout=TIMEOUT,
-                 window_size=WINDOW_SIZE, loss_rate=LOSS_RATE):
-        self.client_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self.server_address = server_address
-        self.timeout = timeout
-        self.window_size = window_size
-        self.loss_rate = loss_rate
-        self.send_base = 0
-        self.next_seq = 0
-        self.packet_queue = util.CircularQueue(QUEUE_MAX_SIZE)
-        self.timer = None
+import rdt_client
+
+DUP_ACK_THRESHOLD = 3
+
+class GBNClient(rdt_client.RDTClient):
+    def __init__(self, server_address, timeout=rdt_client.TIMEOUT, window_size=rdt_client.WINDOW_SIZE,
+                 loss_rate=rdt_client.LOSS_RATE, dup_ack_threshold=DUP_ACK_THRESHOLD, **kwargs):
+        """
+        @param kwargs: the options of rdt_client.RDTClient
+        """
+        super().__init__(server_address, timeout, window_size, loss_rate, **kwargs)
+        # The deadline of the single timer of the window, None while it's stopped
+        # It's checked by the send loop, like the timers of SRClient, so no other thread touches the window
+        self.timer_deadline = None
+        # The packets from send_base + resend_pos to send_base + resend_end are waiting to be sent again
+        # The positions are counted from send_base, so they move back as the acks slide the window
+        self.resend_pos = 0
+        self.resend_end = 0
+        self.resend_fast = False
+        # The cumulative ack before send_base
+        self.last_ack = 0
+        # The timeouts since the last new ack, the RTO doubles for each of them
+        self.timeout_backoff = 0
+        # Fast retransmit fires once the same cumulative ack is received dup_ack_threshold more times
+        # dup_ack_threshold = 0 disables it
+        self.dup_ack_threshold = dup_ack_threshold
+        self.dup_ack_count = 0
+        self.in_fast_recovery = False
+        self.total_dup_acks = 0
+        self.fast_retransmit_count = 0
+        self.timeout_count = 0
+
+    def get_version1_window(self):
+        # The sequence numbers are the queue positions, the queue can't grow
+        return rdt_client.QUEUE_MAX_SIZE - 1
+
+    def on_negotiated(self, options):
+        self.last_ack = self.seq_space - 1
+        if self.fec_encoder is not None and self.dup_ack_threshold > 0:
+            # A loss the parity repairs is acked by the end of its block, don't resend the window before
+            self.dup_ack_threshold = max(self.dup_ack_threshold, self.fec_block_size)
+
+    def resend_window(self, fast=False):
+        # Resend all the sent packets in the window, starting from send_base
+        # They are queued for send_pending, which paces them before the new packets
+        self.resend_pos = 0
+        self.resend_end = (self.send_next - self.send_base) % self.seq_space
+        self.resend_fast = fast
+
+    def reset_timer(self):
+        self.timer_deadline = time.monotonic() + self.rto_estimator.get_rto(self.timeout_backoff)
+
+    def stop_timer(self):
+        self.timer_deadline = None
 
     def handle_timeout(self):
+        if self.timer_deadline is None or time.monotonic() < self.timer_deadline:
+            return
         # Stop timer
-        if self.packet_queue.is_empty() and self.timer is not None:
-            self.timer.cancel()
+        if self.packet_queue.is_empty():
+            self.stop_timer()
             return
 
         # Timeout, resend the packets
-        print('======= Handling timeout =======')
-        resend_queue = copy.deepcopy(self.packet_queue)
-        while not resend_queue.is_empty():
-            seq_num = resend_queue.front
-            data_item = resend_queue.dequeue()
-            send_packet = self.make_pkt(seq_num, data_item[0], util.get_checksum(data_item[0]))
-            print('Resend packet:', seq_num)
-            self.udp_send(send_packet)
-        print('======= End =======')
-
-        # Reset timer
-        if self.timer is not None:
-            self.timer.cancel()
-        self.timer = threading.Timer(self.timeout, self.handle_timeout)
-        self.timer.start()
-
-    def udp_send(self, pkt):
-        # Simulate packet lose
-        if self.loss_rate == 0 or random.randint(0, int(1 / self.loss_rate)) != 1:
-            self.client_socket.sendto(pkt, self.server_address)
-        else:
-            print('Client packet lost.')
-
-        # Simulate the transfer time from client to server
-        time.sleep(0.3)
-
-    def make_pkt(self, seq_num, data, checksum, end_flag=False):
-        return struct.pack('BBB', seq_num, end_flag, checksum) + data
-
-    def analyse_pkt(self, pkt):
-        ack_seq = pkt[0]
-        return ack_seq
-
-    def rdt_send(self, input_stream):
-        data_list = util.generate_packets(input_stream)
-        print('The total number of data packets: ', len(data_list))
-
-        enqueue_packet_num = 0
-        is_beginning = True
-        last_ack = -1
-        while True:
-            if enqueue_packet_num >= len(data_list) and self.packet_queue.is_empty():
-                # All the packets are sent, send a packet to close the connection
-                for i in range(0, 10):
-                    # Repeat 10 times in case packet loss
-                    send_packet = self.make_pkt(0, bytes('', encoding='utf-8'), 0, True)
-                    self.udp_send(send_packet)
-                break
-
-            """
-            Put the data list into a circular queue to get the repeatable sequence number
-            front == rear : queue is empty
-            (rear + 1) % QUEUE_MAX_SIZE == front : queue is full
-            (rear - front + QUEUE_MAX_SIZE) % QUEUE_MAX_SIZE : size of the queue
-            """
-            while enqueue_packet_num < len(data_list) and self.packet_queue.queue_length() < self.window_size:
-                data = data_list[enqueue_packet_num]
-                # Each item have the data and a flag to indicate whether it's sent
-                self.packet_queue.enqueue([data, False])
-                enqueue_packet_num += 1
-
-            # Don't change the packet_queue during sending. Change the packet queue once an ack is received
-            send_queue = copy.deepcopy(self.packet_queue)
-            while not send_queue.is_empty():
-                seq_num = send_queue.front
-                data_item = send_queue.dequeue()
-
-                # The item is not sent before
-                if not data_item[1]:
-                    send_packet = self.make_pkt(seq_num, data_item[0], util.get_checksum(data_item[0]))
-                    print('*** Client Send packet:', seq_num)
-                    self.udp_send(send_packet)
-                    self.packet_queue.queue[seq_num][1] = True
-
-                    # Start the timer at the beginning
-                    if is_beginning:
-                        self.timer = threading.Timer(self.timeout, self.handle_timeout)
-                        self.timer.start()
-                        is_beginning = False
-
-            # Wait response form server
-            readable, writeable, errors = select.select([self.client_socket, ], [], [], 10)
-            if len(readable) > 0:
-                data, address = self.client_socket.recvfrom(BUFFER_SIZE)
-                ack_seq = self.analyse_pkt(data)
-
-                """
-                GBN is a cumulative acknowledgment protocol. we need to focus on the latest ack
-                The sequence size must twice larger than the window size in order to distinguish the two seq num
-                For example:
-                    sequence size = 8 and window size = 6 (sequence size < 2*window size)
-                    [0, 1, 2, 3, 4, 5, 6, 7]
-                    last_ack = 5, ack_seq = 2
-                    can't determine whether the new ack_seq(2) is old one or new one extend the edge of circular queue 
-                    
-                """
-                ack_pos_change = (ack_seq - last_ack + QUEUE_MAX_SIZE) % QUEUE_MAX_SIZE
-                if ack_pos_change > 0:
-                    # New acks received, dequeue items in the front
-                    print('*** Client receive new ack: ', ack_seq)
-                    # range(0, ack_pos_change) equals to [0, ack_pos_change) in math
-                    for i in range(0, ack_pos_change):
-                        self.packet_queue.dequeue()
-
-                    # All send packet is received
-                    if self.packet_queue.is_empty() and self.timer is not None:
-                        self.timer.cancel()
-                        continue
-
-                    # Reset timer
-                    if self.timer is not None:
-                        self.timer.cancel()
-                    self.timer = threading.Timer(self.timeout, self.handle_timeout)
-                    self.timer.start()
-
-                    last_ack = ack_seq
-                else:
-                    # Duplicate ack received. The real TCP will resend immediately while 3 duplicates received
-                    pass
-
-        if self.timer is not None:
-            self.timer.cancel()
-        input_stream.close()
-        self.client_socket.close()
-
-
-server_ip = '127.0.0.1'
-server_port = 9690
-server_address = (server_ip, server_port)
-client = GBNClient(server_address)
-client_data = open(os.path.dirname(__file__) + '/data/' + 'player2.jpeg', 'rb')
-client.rdt_send(client_data)
+        self.timeout_count += 1
+        self.timeout_backoff += 1
+        self.metrics.on_timeout(len(self.packet_queue))
+        self.congestion.on_timeout()
+        self.resend_window()
+
+        self.reset_timer()
+
+    def handle_dup_ack(self):
+        """
+        Count the duplicate cumulative acks, resend from send_base once the threshold is reached
+        Stay in fast recovery until a new ack moves the window, so the rest duplicates don't resend again
+        """
+        self.dup_ack_count += 1
+        self.total_dup_acks += 1
+        if self.dup_ack_threshold <= 0 or self.in_fast_recovery or self.packet_queue.is_empty():
+            return
+        if self.dup_ack_count < self.dup_ack_threshold:
+            return
+
+        self.fast_retransmit_count += 1
+        self.in_fast_recovery = True
+        self.congestion.on_loss()
+        self.resend_window(True)
+
+        self.reset_timer()
+
+    def next_deadline(self):
+        return self.timer_deadline
+
+    def handle_ack(self, ack_seq):
+        """
+        GBN is a cumulative acknowledgment protocol. we need to focus on the latest ack
+        The sequence size must twice larger than the window size in order to distinguish the two seq num
+        For example:
+            sequence size = 8 and window size = 6 (sequence size < 2*window size)
+            [0, 1, 2, 3, 4, 5, 6, 7]
+            last_ack = 5, ack_seq = 2
+            can't determine whether the new ack_seq(2) is old one or new one extend the edge of circular queue
+        """
+        ack_pos_change = (ack_seq - self.last_ack) % self.seq_space
+        if 0 < ack_pos_change <= len(self.packet_queue):
+            # New acks received, the window slides over the acked items at once
+            self.metrics.on_ack(ack_seq)
+            data_item = self.packet_queue.get(ack_pos_change - 1)
+            self.packet_queue.slide(ack_pos_change)
+            # The acked packets waiting to be resent are skipped
+            self.resend_pos = max(self.resend_pos - ack_pos_change, 0)
+            self.resend_end = max(self.resend_end - ack_pos_change, 0)
+            self.send_base = (ack_seq + 1) % self.seq_space
+            self.last_ack = ack_seq
+
+            # Measure RTT by the newest acked packet
+            rtt = None
+            if data_item.send_time is not None:
+                rtt = time.monotonic() - data_item.send_time
+                self.rto_estimator.update(rtt)
+                self.metrics.on_rtt(rtt)
+            self.timeout_backoff = 0
+            self.congestion.on_ack(ack_pos_change, rtt)
+
+            # The window moves, leave fast recovery
+            self.dup_ack_count = 0
+            self.in_fast_recovery = False
+
+            # All send packet is received
+            if self.packet_queue.is_empty():
+                self.stop_timer()
+                return
+
+            # Reset timer
+            self.reset_timer()
+        elif ack_pos_change == 0:
+            # Duplicate ack received. Like the real TCP, resend immediately while 3 duplicates received
+            self.metrics.on_dup_ack(ack_seq)
+            self.handle_dup_ack()
+
+    def send_pending(self):
+        """
+        Send the retransmissions, then the new packets of the window, as fast as the pacer lets them
+        @return: seconds until the pacer lets the next pending packet go, None if nothing is pending
+        """
+        while self.resend_pos < self.resend_end:
+            delay = self.pacer.get_delay()
+            if delay > 0:
+                return delay
+            seq_num = (self.send_base + self.resend_pos) % self.seq_space
+            self.udp_send(self.frame_pool.frame(seq_num))
+            self.pacer.on_send()
+            self.resend_count += 1
+            self.metrics.on_resend(seq_num, self.resend_fast)
+            # Karn's algorithm: never measure RTT of the retransmitted packet
+            self.packet_queue.get(self.resend_pos).send_time = None
+            self.resend_pos += 1
+
+        while self.send_next != self.next_seq:
+            delay = self.pacer.get_delay()
+            if delay > 0:
+                return delay
+            seq_num = self.send_next
+            data_item = self.packet_queue.items[seq_num % self.packet_queue.size]
+            self.udp_send(self.frame_pool.frame(seq_num))
+            self.pacer.on_send()
+            self.metrics.on_send(seq_num, data_item.length)
+            data_item.sent = True
+            data_item.send_time = time.monotonic()
+            self.send_next = (seq_num + 1) % self.seq_space
+
+            # Start the timer for the oldest packet in flight, it's stopped whenever the window is empty
+            if self.timer_deadline is None:
+                self.reset_timer()
+            if self.fec_encoder is not None:
+                # The parity of a block is sent as soon as its last data packet
+                self.send_parity(self.fec_encoder.add(seq_num, self.frame_pool.payload(seq_num),
+                                                      self.redundancy.parity_num))
+        return None
+
+
+if __name__ == '__main__':
+    # Show the events of the transfer
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    server_ip = '127.0.0.1'
+    server_port = 9690
+    server_address = (server_ip, server_port)
+    client = GBNClient(server_address, resumable=True)
+    client_data = open(os.path.dirname(__file__) + '/data/' + 'player2.jpeg', 'rb')
+    client.rdt_send(client_data)
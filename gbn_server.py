@@ -4,91 +4,91 @@ This module implements the server of Go-Back-N Protocol.
 Author:
     Aaron Li
 """
+import logging
 import os
-import random
-import socket
-import struct
-import time
 
 import common_util as util
+import rdt_server
+import session
+import sink
 
-BUFFER_SIZE = 4096
-LOSS_RATE = 0.3
-QUEUE_MAX_SIZE = 32
 
-class GBNServer:
-    def __init__(self, server_address, loss_rate=LOSS_RATE):
-        self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self.server_socket.bind(server_address)
-        self.loss_rate = loss_rate
+class GBNSession(session.Session):
+    def __init__(self, client_address, connection_id, output_stream):
+        super().__init__(client_address, connection_id, output_stream)
         self.expect_seq = 0
-        self.client_address = None
 
-    def udp_send(self, pkt):
-        # Simulate packet lose
-        if self.loss_rate == 0 or random.randint(0, int(1 / self.loss_rate)) != 1:
-            self.server_socket.sendto(pkt, self.client_address)
-            print('*** Server send ACK:', pkt[0])
-        else:
-            pass
-            print('Server loss ACK:', pkt[0])
-
-        # Simulate the transfer time from server to client.
-        time.sleep(0.3)
-
-    def wait_data(self):
-        while True:
-            data, client_address = self.server_socket.recvfrom(BUFFER_SIZE)
-            self.client_address = client_address
-            seq_num, end_flag, checksum, data = self.analyse_pkt(data)
-
-            if end_flag:
-                # The transfer is complete
-                return bytes('', encoding='utf-8'), end_flag
-
-            if seq_num == self.expect_seq and util.get_checksum(data) == checksum:
-                # Only accept the packet in order.
-                print('*** Server receive packet in order:', seq_num)
-                ack_pkt = self.make_pkt(seq_num)
-                self.udp_send(ack_pkt)
-                self.expect_seq = (self.expect_seq + 1) % QUEUE_MAX_SIZE
-                return data, end_flag
-
-            else:
-                # When receive packet out of order, abandon it and send the ack num to client
-                ack_num = (self.expect_seq - 1) % QUEUE_MAX_SIZE
-                print('Server receive packet out of order:', seq_num)
-                ack_pkt = self.make_pkt(ack_num)
-                self.udp_send(ack_pkt)
-                return bytes('', encoding='utf-8'), end_flag
-
-    def analyse_pkt(self, pkt):
-        seq_num = pkt[0]
-        end_flag = pkt[1]
-        checksum = pkt[2]
-        data = pkt[3:]
-        return seq_num, end_flag, checksum, data
 
-    def make_pkt(self, ackSeq):
-        return struct.pack('BB', ackSeq, 1)
-
-    def mdt_receive(self, output_stream):
-        while True:
-            data, end_flag = self.wait_data()
-            if end_flag:
-                break
-
-            if len(data) != 0:
-                print('*** Server deliver data, length:', len(data))
-                output_stream.write(data)
-
-        output_stream.close()
-        self.server_socket.close()
-
-
-server_ip = ''
-server_port = 9690
-server_address = (server_ip, server_port)
-server = GBNServer(server_address)
-server_stored_data = open(os.path.dirname(__file__) + '/data/' + str(int(time.time())) + '.jpg', 'ab')
-server.mdt_receive(server_stored_data)
+class GBNServer(rdt_server.RDTServer):
+    def make_session(self, client_address, connection_id, output_stream):
+        return GBNSession(client_address, connection_id, output_stream)
+
+    def handle_data(self, client_session, seq_num, checksum, data):
+        """
+        Only the packet in order is accepted, the others are acked by the last packet in order
+        """
+        header = client_session.header
+        self.metrics.on_receive(seq_num, len(data))
+        decoder = client_session.fec_decoder
+        # Without the parity only the packet in order is checked, the others are dropped anyway
+        valid = ((seq_num == client_session.expect_seq or decoder is not None)
+                 and util.get_checksum(data, header.checksum_type) == checksum)
+        if valid and decoder is not None:
+            # The decoder keeps the packets after a gap too, they are delivered from it once the gap is rebuilt
+            self.add_recovered(client_session, decoder.add_data(seq_num, data))
+        if seq_num == client_session.expect_seq and valid:
+            # Only accept the packet in order.
+            ack_pkt = self.make_pkt(client_session, seq_num)
+            self.udp_send(ack_pkt)
+            self.metrics.on_ack_sent(seq_num)
+            client_session.expect_seq = (client_session.expect_seq + 1) % header.seq_space
+            self.deliver_decoded(client_session)
+            return [data]
+
+        # When receive packet out of order, abandon it and send the ack num to client
+        ack_num = (client_session.expect_seq - 1) % header.seq_space
+        if seq_num == client_session.expect_seq:
+            self.metrics.on_corrupt(seq_num)
+        elif (seq_num - client_session.expect_seq) % header.seq_space < header.seq_space // 2:
+            self.metrics.on_out_of_order(seq_num)
+        else:
+            # Resent after its ack is lost
+            self.metrics.on_duplicate(seq_num)
+        ack_pkt = self.make_pkt(client_session, ack_num)
+        self.udp_send(ack_pkt)
+        self.metrics.on_ack_sent(ack_num)
+        # The packet may fill the gap by the parity
+        self.deliver_decoded(client_session)
+        return None
+
+    def handle_parity(self, pkt):
+        super().handle_parity(pkt)
+        client_session = self.session_table.find(self.client_address)
+        if client_session is not None:
+            # The rebuilt packet may be the next in order
+            self.deliver_decoded(client_session)
+
+    def deliver_decoded(self, client_session):
+        # The next packet in order may be in the decoder, received after a gap or rebuilt from the parity
+        # It's framed again and received next, so the packets after it follow one by one
+        payload = client_session.fec_decoder.get(client_session.expect_seq) if client_session.fec_decoder else None
+        if payload is None:
+            return
+        header = client_session.header
+        pkt = header.make_pkt(client_session.expect_seq, payload, util.get_checksum(payload, header.checksum_type))
+        self.recovered_pkts.append((client_session.client_address, pkt))
+
+    def make_pkt(self, client_session, ackSeq):
+        return client_session.header.make_ack(ackSeq)
+
+
+if __name__ == '__main__':
+    # Show the events of the transfer
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    server_ip = ''
+    server_port = 9690
+    server_address = (server_ip, server_port)
+    server = GBNServer(server_address)
+    # The output is named by the transfer id, an interrupted transfer continues its file in the next run
+    server.serve(sink.resumable_sink_factory(os.path.dirname(__file__) + '/data/', '.jpg'), 1)
+    server.close()
@@ -0,0 +1,463 @@
+"""
+This module implements the metrics and the event trace of the clients and the servers.
+
+The protocols report their events to a Metrics object instead of printing a line per packet: the counters
+of the packets, the retransmissions and the acks, and the histograms of the RTT, the window occupancy and
+the deliver latency. The events can also be recorded in a binary ring buffer, the trace keeps the last
+trace_size events and costs one struct.pack_into per event.
+
+Metrics are disabled by default: the protocols get NULL_METRICS, whose methods do nothing.
+
+The snapshots are exported as JSON, and in the Prometheus text format over HTTP on a local port.
+
+Trace record:
+    time since the metrics started (8 bytes float), event (1 byte), sequence number (4 bytes), value (4 bytes)
+
+Usage:
+    client_metrics = metrics.Metrics('client', trace_size=65536)
+    client = sr_client.SRClient(server_address, metrics=client_metrics)
+    exporter = metrics.start_exporter([client_metrics], 9100)
+    ...
+    client_metrics.export_json('metrics.json')
+    client_metrics.trace.dump('trace.bin')
+
+    python metrics.py trace.bin
+
+Author:
+    Aaron Li
+"""
+import bisect
+import http.server
+import json
+import struct
+import sys
+import threading
+import time
+
+EVENT_SEND = 1
+EVENT_RESEND = 2
+EVENT_FAST_RETRANSMIT = 3
+EVENT_TIMEOUT = 4
+EVENT_ACK = 5
+EVENT_DUP_ACK = 6
+EVENT_LOSS = 7
+EVENT_RECEIVE = 8
+EVENT_OUT_OF_ORDER = 9
+EVENT_DUPLICATE = 10
+EVENT_CORRUPT = 11
+EVENT_ACK_SENT = 12
+EVENT_DELIVER = 13
+EVENT_PARITY = 14
+EVENT_RECOVER = 15
+EVENT_NAMES = {
+    EVENT_SEND: 'send',
+    EVENT_RESEND: 'resend',
+    EVENT_FAST_RETRANSMIT: 'fast_retransmit',
+    EVENT_TIMEOUT: 'timeout',
+    EVENT_ACK: 'ack',
+    EVENT_DUP_ACK: 'dup_ack',
+    EVENT_LOSS: 'loss',
+    EVENT_RECEIVE: 'receive',
+    EVENT_OUT_OF_ORDER: 'out_of_order',
+    EVENT_DUPLICATE: 'duplicate',
+    EVENT_CORRUPT: 'corrupt',
+    EVENT_ACK_SENT: 'ack_sent',
+    EVENT_DELIVER: 'deliver',
+    EVENT_PARITY: 'parity',
+    EVENT_RECOVER: 'recover',
+}
+TRACE_RECORD = struct.Struct('!dBII')
+TRACE_SIZE = 65536
+
+# Seconds, for the RTT and the deliver latency
+LATENCY_BUCKETS = [0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+# Packets in flight
+WINDOW_BUCKETS = [1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024, 2048, 4096, 8192, 16384, 32768, 65536]
+METRIC_PREFIX = 'rdt_'
+EXPORTER_PORT = 9100
+
+
+class Counter:
+    __slots__ = ('name', 'description', 'value')
+
+    def __init__(self, name, description):
+        self.name = name
+        self.description = description
+        self.value = 0
+
+
+class Histogram:
+    __slots__ = ('name', 'description', 'buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, name, description, buckets):
+        self.name = name
+        self.description = description
+        self.buckets = buckets
+        # counts[i] is the number of values in (buckets[i - 1], buckets[i]], the last one is above all buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def get_cumulative_counts(self):
+        # The values up to each bucket, as Prometheus counts them
+        cumulative_counts = []
+        total = 0
+        for count in self.counts:
+            total += count
+            cumulative_counts.append(total)
+        return cumulative_counts
+
+    def get_quantile(self, quantile):
+        """
+        @return: the upper bound of the bucket of the quantile, None if nothing is observed
+        """
+        if self.count == 0:
+            return None
+        rank = quantile * self.count
+        for i, total in enumerate(self.get_cumulative_counts()):
+            if total >= rank:
+                return self.buckets[i] if i < len(self.buckets) else float('inf')
+        return float('inf')
+
+
+class TraceBuffer:
+    """
+    The last capacity events in a fixed bytearray, the oldest ones are overwritten
+    """
+    def __init__(self, capacity=TRACE_SIZE):
+        self.capacity = capacity
+        self.buffer = bytearray(capacity * TRACE_RECORD.size)
+        # The number of events recorded, the next one is written at index % capacity
+        self.index = 0
+
+    def record(self, timestamp, event, seq_num, value):
+        TRACE_RECORD.pack_into(self.buffer, (self.index % self.capacity) * TRACE_RECORD.size,
+                               timestamp, event, seq_num, value)
+        self.index += 1
+
+    def get_bytes(self):
+        # The records from the oldest one
+        if self.index <= self.capacity:
+            return bytes(self.buffer[:self.index * TRACE_RECORD.size])
+        split = (self.index % self.capacity) * TRACE_RECORD.size
+        return bytes(self.buffer[split:] + self.buffer[:split])
+
+    def records(self):
+        """
+        @return: list of (time, event, seq num, value) from the oldest one
+        """
+        return list(TRACE_RECORD.iter_unpack(self.get_bytes()))
+
+    def dump(self, path):
+        with open(path, 'wb') as trace_file:
+            trace_file.write(self.get_bytes())
+
+
+def load_trace(path):
+    """
+    @return: list of (time, event, seq num, value) of a dumped trace
+    """
+    with open(path, 'rb') as trace_file:
+        data = trace_file.read()
+    return list(TRACE_RECORD.iter_unpack(data[:len(data) - len(data) % TRACE_RECORD.size]))
+
+
+def format_event(record):
+    timestamp, event, seq_num, value = record
+    return '%12.6f %-16s %10d %10d' % (timestamp, EVENT_NAMES.get(event, event), seq_num, value)
+
+
+class Metrics:
+    """
+    The counters and histograms of one client or server, updated by the events of the protocol
+    """
+    def __init__(self, role, trace_size=0, labels=None):
+        """
+        @param role: the role label of the exported metrics, e.g. 'client'
+        @param trace_size: record the last trace_size events, 0 disables the trace
+        @param labels: the other labels of the exported metrics, e.g. {'protocol': 'sr'}
+        """
+        self.labels = dict(labels or {})
+        self.labels['role'] = role
+        self.start_time = time.monotonic()
+        self.trace = TraceBuffer(trace_size) if trace_size > 0 else None
+
+        # The sender
+        self.packets_sent = Counter('packets_sent_total', 'Data packets sent for the first time')
+        self.bytes_sent = Counter('bytes_sent_total', 'Payload bytes sent for the first time')
+        self.packets_resent = Counter('packets_resent_total', 'Data packets sent again')
+        self.timeouts = Counter('timeouts_total', 'Retransmission timeouts')
+        self.fast_retransmits = Counter('fast_retransmits_total', 'Packets resent before their timeout')
+        self.acks_received = Counter('acks_received_total', 'Acks received')
+        self.dup_acks = Counter('dup_acks_total', 'Duplicate cumulative acks received')
+        self.parity_sent = Counter('parity_sent_total', 'Parity packets of the forward error correction sent')
+        # Both, packets dropped by the emulated channel
+        self.packets_lost = Counter('packets_lost_total', 'Packets dropped by the emulated channel')
+        # The receiver
+        self.packets_received = Counter('packets_received_total', 'Data packets received')
+        self.packets_out_of_order = Counter('packets_out_of_order_total', 'Data packets received out of order')
+        self.packets_duplicate = Counter('packets_duplicate_total', 'Data packets received again')
+        self.packets_corrupted = Counter('packets_corrupted_total', 'Data packets with a wrong checksum')
+        self.acks_sent = Counter('acks_sent_total', 'Acks sent')
+        self.bytes_delivered = Counter('bytes_delivered_total', 'Payload bytes delivered in order')
+        self.packets_recovered = Counter('packets_recovered_total', 'Data packets rebuilt from the parity')
+        self.counters = [self.packets_sent, self.bytes_sent, self.packets_resent, self.timeouts,
+                         self.fast_retransmits, self.acks_received, self.dup_acks, self.parity_sent,
+                         self.packets_lost, self.packets_received, self.packets_out_of_order,
+                         self.packets_duplicate, self.packets_corrupted, self.acks_sent, self.bytes_delivered,
+                         self.packets_recovered]
+
+        self.rtt = Histogram('rtt_seconds', 'Measured round trip time', LATENCY_BUCKETS)
+        self.window = Histogram('window_packets', 'Packets in the send window', WINDOW_BUCKETS)
+        self.deliver_latency = Histogram('deliver_latency_seconds',
+                                         'Time a packet received out of order waits for the gap before it',
+                                         LATENCY_BUCKETS)
+        self.histograms = [self.rtt, self.window, self.deliver_latency]
+
+    def record(self, event, seq_num, value=0):
+        if self.trace is not None:
+            self.trace.record(time.monotonic() - self.start_time, event, seq_num, value)
+
+    def on_send(self, seq_num, length):
+        self.packets_sent.value += 1
+        self.bytes_sent.value += length
+        self.record(EVENT_SEND, seq_num, length)
+
+    def on_resend(self, seq_num, fast=False):
+        self.packets_resent.value += 1
+        if fast:
+            self.fast_retransmits.value += 1
+            self.record(EVENT_FAST_RETRANSMIT, seq_num)
+        else:
+            self.record(EVENT_RESEND, seq_num)
+
+    def on_timeout(self, expired_num):
+        self.timeouts.value += 1
+        self.record(EVENT_TIMEOUT, 0, expired_num)
+
+    def on_ack(self, ack_seq):
+        self.acks_received.value += 1
+        self.record(EVENT_ACK, ack_seq)
+
+    def on_rtt(self, rtt):
+        self.rtt.observe(rtt)
+
+    def on_dup_ack(self, ack_seq):
+        self.acks_received.value += 1
+        self.dup_acks.value += 1
+        self.record(EVENT_DUP_ACK, ack_seq)
+
+    def on_window(self, occupancy):
+        self.window.observe(occupancy)
+
+    def on_loss(self, length):
+        self.packets_lost.value += 1
+        self.record(EVENT_LOSS, 0, length)
+
+    def on_receive(self, seq_num, length):
+        self.packets_received.value += 1
+        self.record(EVENT_RECEIVE, seq_num, length)
+
+    def on_out_of_order(self, seq_num):
+        self.packets_out_of_order.value += 1
+        self.record(EVENT_OUT_OF_ORDER, seq_num)
+
+    def on_duplicate(self, seq_num):
+        self.packets_duplicate.value += 1
+        self.record(EVENT_DUPLICATE, seq_num)
+
+    def on_corrupt(self, seq_num):
+        self.packets_corrupted.value += 1
+        self.record(EVENT_CORRUPT, seq_num)
+
+    def on_ack_sent(self, ack_seq):
+        self.acks_sent.value += 1
+        self.record(EVENT_ACK_SENT, ack_seq)
+
+    def on_deliver(self, length):
+        self.bytes_delivered.value += length
+        self.record(EVENT_DELIVER, 0, length)
+
+    def on_deliver_latency(self, latency):
+        self.deliver_latency.observe(latency)
+
+    def on_parity(self, first_seq, parity_index):
+        self.parity_sent.value += 1
+        self.record(EVENT_PARITY, first_seq, parity_index)
+
+    def on_recover(self, seq_num):
+        self.packets_recovered.value += 1
+        self.record(EVENT_RECOVER, seq_num)
+
+    def snapshot(self):
+        """
+        @return: dict of the counters, the histograms and the byte rates since the metrics started
+        """
+        elapsed = time.monotonic() - self.start_time
+        histograms = {}
+        for histogram in self.histograms:
+            histograms[histogram.name] = {
+                'buckets': histogram.buckets,
+                'counts': histogram.counts,
+                'sum': histogram.sum,
+                'count': histogram.count,
+                'p50': histogram.get_quantile(0.5),
+                'p99': histogram.get_quantile(0.99),
+            }
+        return {
+            'labels': self.labels,
+            'elapsed': elapsed,
+            'counters': {counter.name: counter.value for counter in self.counters},
+            'histograms': histograms,
+            'send_bytes_per_second': self.bytes_sent.value / elapsed if elapsed > 0 else 0,
+            'deliver_bytes_per_second': self.bytes_delivered.value / elapsed if elapsed > 0 else 0,
+        }
+
+    def export_json(self, path):
+        with open(path, 'w') as output_file:
+            json.dump(self.snapshot(), output_file, indent=2)
+
+
+class NullMetrics(Metrics):
+    """
+    The disabled metrics, the events cost only the method call
+    """
+    def __init__(self):
+        super().__init__('none')
+
+    def record(self, event, seq_num, value=0):
+        pass
+
+    def on_send(self, seq_num, length):
+        pass
+
+    def on_resend(self, seq_num, fast=False):
+        pass
+
+    def on_timeout(self, expired_num):
+        pass
+
+    def on_ack(self, ack_seq):
+        pass
+
+    def on_rtt(self, rtt):
+        pass
+
+    def on_dup_ack(self, ack_seq):
+        pass
+
+    def on_window(self, occupancy):
+        pass
+
+    def on_loss(self, length):
+        pass
+
+    def on_receive(self, seq_num, length):
+        pass
+
+    def on_out_of_order(self, seq_num):
+        pass
+
+    def on_duplicate(self, seq_num):
+        pass
+
+    def on_corrupt(self, seq_num):
+        pass
+
+    def on_ack_sent(self, ack_seq):
+        pass
+
+    def on_deliver(self, length):
+        pass
+
+    def on_deliver_latency(self, latency):
+        pass
+
+    def on_parity(self, first_seq, parity_index):
+        pass
+
+    def on_recover(self, seq_num):
+        pass
+
+
+NULL_METRICS = NullMetrics()
+
+
+def format_labels(labels, extra=None):
+    items = sorted(labels.items()) + (extra or [])
+    return '{' + ','.join('%s="%s"' % (key, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                          for key, value in items) + '}'
+
+
+def format_prometheus(metrics_list):
+    """
+    @return: the metrics in the Prometheus text format, each metric once with a sample per Metrics object
+    """
+    lines = []
+    if len(metrics_list) == 0:
+        return ''
+    for i in range(0, len(metrics_list[0].counters)):
+        counter = metrics_list[0].counters[i]
+        name = METRIC_PREFIX + counter.name
+        lines.append('# HELP %s %s' % (name, counter.description))
+        lines.append('# TYPE %s counter' % name)
+        for metrics in metrics_list:
+            lines.append('%s%s %d' % (name, format_labels(metrics.labels), metrics.counters[i].value))
+
+    for i in range(0, len(metrics_list[0].histograms)):
+        histogram = metrics_list[0].histograms[i]
+        name = METRIC_PREFIX + histogram.name
+        lines.append('# HELP %s %s' % (name, histogram.description))
+        lines.append('# TYPE %s histogram' % name)
+        for metrics in metrics_list:
+            histogram = metrics.histograms[i]
+            cumulative_counts = histogram.get_cumulative_counts()
+            for bound, total in zip(histogram.buckets + ['+Inf'], cumulative_counts):
+                lines.append('%s_bucket%s %d' % (name, format_labels(metrics.labels, [('le', bound)]), total))
+            lines.append('%s_sum%s %r' % (name, format_labels(metrics.labels), float(histogram.sum)))
+            lines.append('%s_count%s %d' % (name, format_labels(metrics.labels), histogram.count))
+    return '\n'.join(lines) + '\n'
+
+
+class ExporterHandler(http.server.BaseHTTPRequestHandler):
+    # GET /metrics in the Prometheus text format, GET /metrics.json as the JSON snapshots
+    def do_GET(self):
+        if self.path == '/metrics':
+            body = format_prometheus(self.server.metrics_list).encode()
+            content_type = 'text/plain; version=0.0.4'
+        elif self.path == '/metrics.json':
+            body = json.dumps([metrics.snapshot() for metrics in self.server.metrics_list]).encode()
+            content_type = 'application/json'
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_exporter(metrics_list, port=EXPORTER_PORT, address='127.0.0.1'):
+    """
+    Serve the metrics on a local port in a background thread
+    @return: the HTTP server, call shutdown() to stop it
+    """
+    server = http.server.ThreadingHTTPServer((address, port), ExporterHandler)
+    server.daemon_threads = True
+    server.metrics_list = metrics_list
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == '__main__':
+    for trace_record in load_trace(sys.argv[1]):
+        print(format_event(trace_record))
@@ -0,0 +1,111 @@
+"""
+This module measures the per-iteration cost of the sender window, the old list items with a deepcopy
+of the queue against util.SlidingWindow with util.WindowEntry items read in place.
+
+Usage:
+    python microbench.py
+
+Author:
+    Aaron Li
+"""
+import copy
+import timeit
+
+import common_util as util
+
+WINDOWS = [16, 64, 256]
+REPEAT = 5
+
+
+class ListQueue:
+    # The circular queue of the first versions, the items are lists
+    def __init__(self, size):
+        self.size = size
+        self.queue = [None] * size
+        self.front = self.rear = 0
+
+    def is_empty(self):
+        return self.front == self.rear
+
+    def enqueue(self, item):
+        self.queue[self.rear] = item
+        self.rear = (self.rear + 1) % self.size
+
+    def dequeue(self):
+        item = self.queue[self.front]
+        self.queue[self.front] = None
+        self.front = (self.front + 1) % self.size
+        return item
+
+
+def make_list_queue(window):
+    queue = ListQueue(util.get_queue_size(window, util.SEQ_SPACE_V2))
+    for i in range(0, window):
+        queue.enqueue([util.PACKET_SIZE, True, True, 0, 0, 0, False])
+    return queue
+
+
+def make_window(window):
+    queue = util.SlidingWindow(util.get_queue_size(window, util.SEQ_SPACE_V2))
+    for i in range(0, window):
+        data_item = util.WindowEntry(util.PACKET_SIZE)
+        data_item.sent = True
+        queue.append(data_item)
+    return queue
+
+
+def iterate_list_queue(queue):
+    # One iteration of the old send loop: copy the queue, then look for the unsent items
+    send_queue = copy.deepcopy(queue)
+    while not send_queue.is_empty():
+        data_item = send_queue.dequeue()
+        if not data_item[1]:
+            pass
+
+
+def iterate_window(queue):
+    # The items are read in place
+    for pos in range(0, len(queue)):
+        if not queue.get(pos).sent:
+            pass
+
+
+def ack_list_queue(queue, window):
+    # A cumulative ack of the whole window, dequeued one by one, then the window is filled again
+    for i in range(0, window):
+        queue.dequeue()
+    for i in range(0, window):
+        queue.enqueue([util.PACKET_SIZE, True, True, 0, 0, 0, False])
+
+
+def ack_window(queue, window):
+    queue.slide(window)
+    for i in range(0, window):
+        queue.append(util.WindowEntry(util.PACKET_SIZE))
+
+
+def measure(statement, number):
+    # The best of the repeats, in microseconds per call
+    return min(timeit.repeat(statement, number=number, repeat=REPEAT)) / number * 1e6
+
+
+def run():
+    """
+    @return: list of (window, case, old microseconds, new microseconds)
+    """
+    results = []
+    for window in WINDOWS:
+        number = max(10, 20000 // window)
+        list_queue = make_list_queue(window)
+        sliding_window = make_window(window)
+        results.append((window, 'send loop', measure(lambda: iterate_list_queue(list_queue), number),
+                        measure(lambda: iterate_window(sliding_window), number)))
+        results.append((window, 'cumulative ack', measure(lambda: ack_list_queue(list_queue, window), number),
+                        measure(lambda: ack_window(sliding_window, window), number)))
+    return results
+
+
+if __name__ == '__main__':
+    print('window  case            old (us)   new (us)  speedup')
+    for window, case, old, new in run():
+        print('%6d  %-14s %9.1f  %9.1f  %6.1fx' % (window, case, old, new, old / new))
@@ -0,0 +1,106 @@
+"""
+This module implements the pacing of the senders.
+
+Without pacing, an ack which opens the window lets all the packets it allows leave back to back, and a timeout
+resends the expired packets in one burst. A burst larger than the socket buffer of the receiver is dropped
+there, so the sender loses its own packets. The pacer spreads the packets over the RTT instead:
+    pacing rate = gain * window / SRTT packets per second
+The token bucket holds the packets of one quantum of time, at least burst of them. They leave together,
+the sender can't wait much less than the resolution of select anyway.
+
+TokenBucketPacer paces once the RTT is measured, the negotiation gives the first sample.
+The pacer is only used by the send loop of a client, the retransmissions are queued and paced there too.
+NullPacer lets every packet go at once, as the senders did before.
+
+Usage:
+    client = sr_client.SRClient(server_address, window_size=1024, pacing_policy=pacing.PACING_TOKEN_BUCKET,
+                                receive_buffer=1 << 22)
+
+Author:
+    Aaron Li
+"""
+import time
+
+PACING_NONE = 'none'
+PACING_TOKEN_BUCKET = 'token_bucket'
+
+# Above 1, so the pacing spreads the window without capping the throughput. Linux paces at 2 in slow start
+PACING_GAIN = 1.25
+# The packets which may leave back to back, and the time the bucket holds
+PACING_BURST = 2
+PACING_QUANTUM = 0.001
+
+
+class NullPacer:
+    def set_rate(self, window, srtt):
+        pass
+
+    def get_delay(self):
+        return 0
+
+    def on_send(self):
+        pass
+
+
+class TokenBucketPacer:
+    """
+    One token per packet, the tokens come at the pacing rate
+    The retransmissions take their tokens like the new packets, they are paced before them
+    """
+    def __init__(self, gain=PACING_GAIN, burst=PACING_BURST, quantum=PACING_QUANTUM):
+        self.gain = gain
+        self.burst = burst
+        self.quantum = quantum
+        # Packets per second, None before the first RTT sample
+        self.rate = None
+        self.depth = burst
+        self.tokens = float(burst)
+        self.last_time = time.monotonic()
+
+    def set_rate(self, window, srtt):
+        """
+        @param window: the packets the sender may have in flight
+        @param srtt: the smoothed RTT in seconds, None if it isn't measured yet
+        """
+        if srtt is None or srtt <= 0:
+            self.rate = None
+            return
+        self.rate = self.gain * window / srtt
+        self.depth = max(self.burst, self.rate * self.quantum)
+
+    def refill(self):
+        now = time.monotonic()
+        if self.rate is not None:
+            self.tokens = min(self.tokens + (now - self.last_time) * self.rate, self.depth)
+        self.last_time = now
+
+    def get_delay(self):
+        """
+        @return: seconds until the next packet may leave, 0 if it may leave now
+        """
+        if self.rate is None:
+            return 0
+        self.refill()
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def on_send(self):
+        if self.rate is not None:
+            self.tokens -= 1
+
+
+PACERS = {
+    PACING_NONE: NullPacer,
+    PACING_TOKEN_BUCKET: TokenBucketPacer,
+}
+
+
+def make_pacer(pacing, pacing_options=None):
+    """
+    @param pacing: one of PACING_NONE and PACING_TOKEN_BUCKET
+    @param pacing_options: keyword arguments of the pacer, e.g. {'gain': 2}
+    """
+    if pacing not in PACERS:
+        raise ValueError('Unknown pacing: %s' % pacing)
+    return PACERS[pacing](**(pacing_options or {}))
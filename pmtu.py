@@ -0,0 +1,177 @@
+"""
+This module implements the path MTU discovery of the clients.
+
+A packet larger than the path MTU is fragmented by IP, and it's lost when any of its fragments is lost,
+so the packet loss grows with the fragments of a packet. A smaller packet pays more header and per packet
+overhead instead. The client probes the largest datagram that gets through with the Don't Fragment flag,
+and sizes its packets to fit it, see get_mss.
+
+The common MTU plateaus of RFC 1191 are probed from the largest one down, then the gap above the largest
+one that gets through is bisected. A probe too large for the local interface fails at once with EMSGSIZE,
+the others are lost by the path and time out.
+
+Probe packet:
+    0, FLAG_PROBE, probe id (4 bytes), zero padding to the probed datagram size
+Response:
+    0, FLAG_PROBE, probe id (4 bytes), datagram size of the received probe (4 bytes)
+
+Usage:
+    client = sr_client.SRClient(server_address, probe_mtu=True)
+    client = sr_client.SRClient(('127.0.0.1', 9790), probe_mtu=True, max_mtu=pmtu.LOOPBACK_MTU)
+
+Author:
+    Aaron Li
+"""
+import errno
+import logging
+import select
+import socket
+import struct
+import sys
+import time
+
+import common_util as util
+
+logger = logging.getLogger(__name__)
+
+# IPv4 and UDP headers
+IP_UDP_HEADER_SIZE = 28
+# The largest payload of a UDP datagram
+MAX_DATAGRAM_SIZE = 65507
+MIN_MTU = 576
+ETHERNET_MTU = 1500
+JUMBO_MTU = 9000
+# The loopback interface of Linux
+LOOPBACK_MTU = 65536
+MTU_PLATEAUS = [65536, 32000, 17914, 9000, 8166, 4464, 4352, 2002, 1500, 1492, 1280, 1006, 576]
+# The bisection stops once the gap is this small
+PROBE_RESOLUTION = 32
+PROBE_TIMEOUT = 0.2
+PROBE_RETRIES = 2
+PROBE_HEADER = struct.Struct('!BBI')
+PROBE_RESPONSE = struct.Struct('!BBII')
+
+# The values of Linux, the socket module doesn't export them
+IP_MTU_DISCOVER = getattr(socket, 'IP_MTU_DISCOVER', 10)
+# Set the Don't Fragment flag and ignore the path MTU the kernel learned
+IP_PMTUDISC_PROBE = getattr(socket, 'IP_PMTUDISC_PROBE', 3)
+
+
+def get_datagram_size(mtu):
+    return min(mtu - IP_UDP_HEADER_SIZE, MAX_DATAGRAM_SIZE)
+
+
+def get_mss(mtu, overhead=0):
+    """
+    The largest payload of a data packet with any header version
+    @param overhead: bytes the largest other packet of the transfer adds to a data packet, e.g. fec.PARITY_OVERHEAD
+    """
+    return get_datagram_size(mtu) - util.HEADER_MAX_SIZE - overhead
+
+
+def make_probe_pkt(probe_id, size):
+    return PROBE_HEADER.pack(0, util.FLAG_PROBE, probe_id) + bytes(size - PROBE_HEADER.size)
+
+
+def analyse_probe_pkt(pkt):
+    """
+    @return: the probe id, None if the packet is truncated
+    """
+    if len(pkt) < PROBE_HEADER.size:
+        return None
+    return PROBE_HEADER.unpack_from(pkt)[2]
+
+
+def make_probe_response(probe_id, size):
+    return PROBE_RESPONSE.pack(0, util.FLAG_PROBE, probe_id, size)
+
+
+def analyse_probe_response(pkt):
+    """
+    @return: probe id and the received size, None if the packet is truncated
+    """
+    if len(pkt) < PROBE_RESPONSE.size:
+        return None
+    version, flags, probe_id, size = PROBE_RESPONSE.unpack_from(pkt)
+    return probe_id, size
+
+
+class MTUProber:
+    def __init__(self, sock, server_address, max_mtu=JUMBO_MTU, timeout=PROBE_TIMEOUT, retries=PROBE_RETRIES):
+        """
+        @param max_mtu: the largest MTU probed, e.g. LOOPBACK_MTU for the jumbo packets of the loopback
+        """
+        self.sock = sock
+        self.server_address = server_address
+        self.max_mtu = max_mtu
+        self.timeout = timeout
+        self.retries = retries
+        self.probe_id = 0
+        self.buffer = bytearray(PROBE_RESPONSE.size)
+
+    def probe(self, mtu):
+        """
+        @return: whether the datagram of the MTU gets through to the server
+        """
+        size = get_datagram_size(mtu)
+        self.probe_id += 1
+        probe_pkt = make_probe_pkt(self.probe_id, size)
+        for i in range(0, self.retries):
+            try:
+                self.sock.sendto(probe_pkt, self.server_address)
+            except OSError as e:
+                if e.errno == errno.EMSGSIZE:
+                    # Larger than the local interface
+                    return False
+                raise
+            deadline = time.monotonic() + self.timeout
+            while True:
+                readable, writeable, errors = select.select([self.sock, ], [], [], max(deadline - time.monotonic(), 0))
+                if len(readable) == 0:
+                    break
+                nbytes, address = self.sock.recvfrom_into(self.buffer)
+                pkt = memoryview(self.buffer)[:nbytes]
+                if nbytes < 2 or not pkt[1] & util.FLAG_PROBE:
+                    continue
+                # A probe truncated by the receive buffer of the server got through the path too,
+                # the server caps the packet size when negotiating
+                response = analyse_probe_response(pkt)
+                if response is not None and response[0] == self.probe_id:
+                    return True
+        return False
+
+    def discover(self):
+        """
+        @return: the path MTU, MIN_MTU if no probe gets through
+        """
+        # The kernel must not fragment the probes, the flag is restored for the transfer
+        old_value = None
+        if sys.platform.startswith('linux'):
+            try:
+                old_value = self.sock.getsockopt(socket.IPPROTO_IP, IP_MTU_DISCOVER)
+                self.sock.setsockopt(socket.IPPROTO_IP, IP_MTU_DISCOVER, IP_PMTUDISC_PROBE)
+            except OSError:
+                old_value = None
+        if old_value is None:
+            logger.warning('Client probe MTU without the Don\'t Fragment flag')
+
+        try:
+            low = MIN_MTU
+            high = None
+            candidates = [self.max_mtu] + [mtu for mtu in MTU_PLATEAUS if MIN_MTU < mtu < self.max_mtu]
+            for mtu in candidates:
+                if self.probe(mtu):
+                    low = mtu
+                    break
+                high = mtu
+            # Bisect the gap above the largest plateau that gets through
+            while high is not None and high - low > PROBE_RESOLUTION:
+                middle = (low + high) // 2
+                if self.probe(middle):
+                    low = middle
+                else:
+                    high = middle
+        finally:
+            if old_value is not None:
+                self.sock.setsockopt(socket.IPPROTO_IP, IP_MTU_DISCOVER, old_value)
+        return low
@@ -0,0 +1,111 @@
+"""
+This module implements the progress index of the resumable transfers.
+
+The server keeps a bitmap of the received chunks of a transfer in a sidecar file next to its output,
+bit i is set once chunk i is written. The sidecar is replaced atomically at most every flush_interval
+seconds, after the data is synced, so it never claims a chunk which isn't on the disk.
+
+Sidecar format:
+    magic (4 bytes), chunk size (4 bytes), chunk count (4 bytes), data size (8 bytes),
+    bitmap, bit i is bit i % 8 of byte i / 8
+
+Author:
+    Aaron Li
+"""
+import os
+import struct
+import time
+
+SIDECAR_SUFFIX = '.progress'
+SIDECAR_MAGIC = b'RDTP'
+SIDECAR_HEADER = struct.Struct('!4sIIQ')
+FLUSH_INTERVAL = 1
+
+
+class ProgressIndex:
+    def __init__(self, path, chunk_size, flush_interval=FLUSH_INTERVAL):
+        """
+        @param path: the sidecar file, the progress of the previous runs is loaded from it if it exists
+        """
+        self.path = path
+        self.chunk_size = chunk_size
+        self.flush_interval = flush_interval
+        self.bitmap = bytearray()
+        self.chunk_num = 0
+        # The end of the data written in all the runs
+        self.data_size = 0
+        # The chunks before it are all received
+        self.first_missing = 0
+        self.last_flush = time.monotonic()
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.path, 'rb') as sidecar:
+                data = sidecar.read()
+        except FileNotFoundError:
+            return
+        if len(data) < SIDECAR_HEADER.size:
+            return
+        magic, chunk_size, chunk_num, data_size = SIDECAR_HEADER.unpack_from(data)
+        if magic != SIDECAR_MAGIC or chunk_size != self.chunk_size:
+            # Written with another chunk size, the transfer starts over
+            return
+        self.bitmap = bytearray(data[SIDECAR_HEADER.size:SIDECAR_HEADER.size + (chunk_num + 7) // 8])
+        self.chunk_num = chunk_num
+        self.data_size = data_size
+        self.first_missing = self.find_missing(0)
+
+    def reset(self):
+        self.bitmap = bytearray()
+        self.chunk_num = 0
+        self.data_size = 0
+        self.first_missing = 0
+
+    def is_received(self, index):
+        byte = index >> 3
+        return byte < len(self.bitmap) and self.bitmap[byte] >> (index & 7) & 1 == 1
+
+    def find_missing(self, index):
+        # Skip the full bytes, then the bits
+        byte = index >> 3
+        while byte < len(self.bitmap) and self.bitmap[byte] == 0xFF:
+            byte += 1
+        index = max(index, byte << 3)
+        while self.is_received(index):
+            index += 1
+        return index
+
+    def mark(self, index, end):
+        """
+        @param end: the offset after the data of the chunk
+        """
+        byte = index >> 3
+        if byte >= len(self.bitmap):
+            self.bitmap.extend(bytes(byte + 1 - len(self.bitmap)))
+        self.bitmap[byte] |= 1 << (index & 7)
+        self.chunk_num = max(self.chunk_num, index + 1)
+        self.data_size = max(self.data_size, end)
+        if index == self.first_missing:
+            self.first_missing = self.find_missing(index + 1)
+
+    def is_due(self):
+        return time.monotonic() - self.last_flush >= self.flush_interval
+
+    def save(self):
+        # Write a new sidecar and replace the old one, a crash leaves either of them complete
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'wb') as sidecar:
+            sidecar.write(SIDECAR_HEADER.pack(SIDECAR_MAGIC, self.chunk_size, self.chunk_num, self.data_size))
+            sidecar.write(self.bitmap)
+            sidecar.flush()
+            os.fsync(sidecar.fileno())
+        os.replace(temp_path, self.path)
+        self.last_flush = time.monotonic()
+
+    def remove(self):
+        # The transfer is complete
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,444 @@
+"""
+This module implements the common part of the GBN and SR clients: negotiation, filling the window,
+the optional features of the stream and closing.
+
+The subclasses handle the acks, the timers and the retransmissions, see gbn_client.GBNClient and
+sr_client.SRClient. Like async_rdt.SenderProtocol, the options of a subclass are proposed by
+make_negotiate_options and applied by on_negotiated.
+
+Author:
+    Aaron Li
+"""
+import io
+import logging
+import os
+import select
+import socket
+import struct
+import time
+
+import channel
+import common_util as util
+import compression
+import congestion
+import dedup
+import fec
+import metrics as rdt_metrics
+import pacing
+import pmtu
+
+# The events of a transfer are logged, nothing is shown unless the application configures logging
+logger = logging.getLogger(__name__)
+
+BUFFER_SIZE = 4096
+TIMEOUT = 10
+INITIAL_RTO = 1
+WINDOW_SIZE = 10
+LOSS_RATE = 0.3
+QUEUE_MAX_SIZE = 32
+NEGOTIATE_TIMEOUT = 1
+NEGOTIATE_RETRIES = 10
+# The end packet is sent this number of times to a server without the close handshake, in case packet loss
+END_REPEAT = 10
+# The end packet is sent again after each RTO until the server acks the close
+CLOSE_RETRIES = 10
+
+
+class RDTClient:
+    def __init__(self, server_address, timeout=TIMEOUT,
+                 window_size=WINDOW_SIZE, loss_rate=LOSS_RATE, channel_options=None,
+                 checksum_types=util.CHECKSUM_PREFERENCE, version=util.VERSION_2, initial_rto=INITIAL_RTO,
+                 congestion_control=congestion.POLICY_FIXED, congestion_options=None, batch_io=True,
+                 resumable=False, deduplicate=False,
+                 codec=compression.CODEC_NONE, mss=util.PACKET_SIZE, probe_mtu=False, max_mtu=pmtu.JUMBO_MTU,
+                 metrics=None, fec_scheme=fec.SCHEME_NONE, fec_block_size=fec.BLOCK_SIZE, fec_parity=None,
+                 pacing_policy=pacing.PACING_NONE, pacing_options=None, send_buffer=None, receive_buffer=None):
+        self.client_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        # SO_SNDBUF and SO_RCVBUF, None keeps the defaults of the OS
+        channel.set_buffer_sizes(self.client_socket, send_buffer, receive_buffer)
+        # Loss and the other impairments are emulated by the channel, see channel.make_channel
+        self.channel = channel.make_channel(self.client_socket, loss_rate, channel_options)
+        self.server_address = server_address
+        self.timeout = timeout
+        self.max_window_size = window_size
+        self.loss_rate = loss_rate
+        self.send_base = 0
+        self.next_seq = 0
+        # The packets from send_next to next_seq are in the window but held by the pacer
+        self.send_next = 0
+        # Spread the packets of the window over the RTT, see pacing.make_pacer
+        self.pacer = pacing.make_pacer(pacing_policy, pacing_options)
+        # The queue and the frame pool are indexed by seq num % size, they grow with the window in version 2
+        self.packet_queue = util.SlidingWindow(QUEUE_MAX_SIZE)
+        # Drain all the pending acks at once and send the payload of a mapped file by scatter-gather I/O
+        # False handles one ack per wait and copies the payload into the frame, as the first versions did
+        self.batch_io = batch_io
+        # The frame of each sequence number is built once and sent again on retransmission
+        self.packet_size = util.PACKET_SIZE
+        self.frame_pool = util.FramePool(QUEUE_MAX_SIZE, self.packet_size, scatter_gather=batch_io)
+        self.ack_buffer = bytearray(BUFFER_SIZE)
+        # The congestion window limits the packets in flight below the window size, see congestion.make_controller
+        self.congestion = congestion.make_controller(congestion_control, window_size, congestion_options)
+        # The highest version and the algorithms proposed to the server, the chosen ones are used once negotiated
+        self.version = version
+        self.checksum_types = checksum_types
+        self.set_header(util.PacketHeader())
+        # The receive window advertised by the server, None if it doesn't tell
+        self.receive_window = None
+        # Identify the transfer on the server together with the client address
+        self.connection_id = int.from_bytes(os.urandom(4), byteorder='big')
+        # A resumable transfer of a file is identified by the file, and skips the packets the server has
+        self.resumable = resumable
+        self.resume_index = 0
+        # Send only the chunks the server doesn't have if it accepts, a resumable transfer isn't deduplicated
+        self.deduplicate = deduplicate and not resumable
+        self.dedup_enabled = False
+        self.query_id = 0
+        # Compress the stream with the codec if it's compressible and the server accepts
+        # A resumable transfer isn't compressed, its packets are at the offsets of the file
+        self.codec = codec if not resumable else compression.CODEC_NONE
+        self.proposed_codec = compression.CODEC_NONE
+        self.compression_codec = compression.CODEC_NONE
+        # The payload size proposed to the server. Probing the path MTU sizes the packets to the largest
+        # datagram which isn't fragmented, up to max_mtu
+        self.mss = mss
+        self.probe_mtu = probe_mtu
+        self.max_mtu = max_mtu
+        # The data packets sent once, and the retransmissions of them
+        self.packet_num = 0
+        self.resend_count = 0
+        # The events of the transfer are counted and traced by the metrics, see metrics.Metrics
+        self.metrics = metrics if metrics is not None else rdt_metrics.NULL_METRICS
+        # The server acks the end packet once the close handshake is negotiated
+        self.close_enabled = False
+        # Send parity packets after each block of data packets if the server accepts, only in version 2
+        # The parity of each block follows the loss rate reported by the server unless fec_parity is given
+        self.fec_scheme = fec_scheme
+        self.fec_block_size = fec_block_size
+        self.fec_encoder = None
+        self.redundancy = fec.RedundancyController(fec_block_size, fec_parity)
+        # The RTO is measured from RTT, timeout is the upper bound of it
+        self.rto_estimator = util.RTOEstimator(initial_rto=min(initial_rto, timeout), max_rto=timeout)
+
+    def udp_send(self, pkt):
+        if not self.channel.send(pkt, self.server_address):
+            self.metrics.on_loss(channel.get_pkt_length(pkt))
+
+    def make_pkt(self, seq_num, data, checksum, flags=0):
+        return self.header.make_pkt(seq_num, data, checksum, flags)
+
+    def analyse_pkt(self, pkt):
+        """
+        @return: the ack seq num, the receive window and the sack bitmap, None if it's not an ack
+        """
+        # The negotiation response repeated by the server is not an ack
+        if len(pkt) < 2 or pkt[1] & util.FLAG_NEGOTIATE:
+            return None
+        return self.header.analyse_ack(pkt)
+
+    def get_version1_window(self):
+        # The sequence numbers are the queue positions, the window is at most half of them
+        return QUEUE_MAX_SIZE // 2
+
+    def set_header(self, header):
+        self.header = header
+        self.seq_space = header.seq_space
+        self.frame_pool.set_header(header)
+        if header.version == util.VERSION_1:
+            self.window_size = min(self.max_window_size, self.get_version1_window())
+        else:
+            self.window_size = self.max_window_size
+        self.congestion.set_max_window(self.window_size)
+
+    def get_window(self):
+        # The congestion window, but never more packets than the server can buffer
+        window = self.congestion.get_window()
+        if self.receive_window is None:
+            return window
+        return min(window, self.receive_window)
+
+    def ensure_capacity(self, window):
+        # Grow the queue and the frame pool when the window doesn't fit
+        if window < self.packet_queue.size:
+            return
+        new_size = util.get_queue_size(window, self.seq_space)
+        self.frame_pool.grow(new_size, self.send_base, len(self.packet_queue))
+        self.packet_queue.grow(new_size, self.send_base)
+
+    def make_negotiate_options(self):
+        options = {
+            util.OPTION_CHECKSUM: bytes(self.checksum_types),
+            util.OPTION_CONNECTION_ID: struct.pack('!I', self.connection_id),
+            util.OPTION_VERSION: bytes([self.version]),
+            util.OPTION_CLOSE: b'',
+        }
+        if self.resumable:
+            options[util.OPTION_RESUME] = b''
+        if self.deduplicate:
+            options[util.OPTION_DEDUP] = b''
+        if self.proposed_codec != compression.CODEC_NONE:
+            options[util.OPTION_COMPRESSION] = bytes([self.proposed_codec])
+        if self.mss != util.PACKET_SIZE:
+            options[util.OPTION_MSS] = struct.pack('!H', self.mss)
+        if self.fec_scheme != fec.SCHEME_NONE and self.version >= util.VERSION_2:
+            # XOR is the fallback of a server without NumPy
+            options[util.OPTION_FEC] = bytes(dict.fromkeys([self.fec_scheme, fec.SCHEME_XOR]))
+        return options
+
+    def on_negotiated(self, options):
+        pass
+
+    def negotiate(self):
+        """
+        Open the connection on the server, propose the protocol version and checksum algorithms
+        and use the ones it chooses
+        """
+        negotiate_pkt = util.make_negotiate_pkt(self.make_negotiate_options())
+        for i in range(0, NEGOTIATE_RETRIES):
+            send_time = time.monotonic()
+            self.udp_send(negotiate_pkt)
+            readable, writeable, errors = select.select([self.client_socket, ], [], [], NEGOTIATE_TIMEOUT)
+            if len(readable) == 0:
+                continue
+
+            nbytes, address = self.client_socket.recvfrom_into(self.ack_buffer)
+            pkt = memoryview(self.ack_buffer)[:nbytes]
+            if nbytes < 2 or not pkt[1] & util.FLAG_NEGOTIATE:
+                continue
+            if i == 0:
+                # The first RTT sample, the response of a repeated request may answer any of them
+                self.rto_estimator.update(time.monotonic() - send_time)
+            options = util.analyse_negotiate_pkt(pkt)
+            checksum_type = options.get(util.OPTION_CHECKSUM, bytes([util.CHECKSUM_LEGACY]))[0]
+            version = util.get_option_int(options, util.OPTION_VERSION, util.VERSION_1)
+            window_scale = util.get_option_int(options, util.OPTION_WINDOW_SCALE, 0)
+            self.set_packet_size(util.get_option_int(options, util.OPTION_MSS, util.PACKET_SIZE))
+            self.set_header(util.PacketHeader(version, checksum_type, window_scale))
+            self.receive_window = util.get_option_int(options, util.OPTION_RECEIVE_WINDOW)
+            self.resume_index = util.get_option_int(options, util.OPTION_RESUME, 0)
+            self.dedup_enabled = util.OPTION_DEDUP in options
+            self.compression_codec = util.get_option_int(options, util.OPTION_COMPRESSION, compression.CODEC_NONE)
+            self.close_enabled = util.OPTION_CLOSE in options
+            fec_scheme = util.get_option_int(options, util.OPTION_FEC, fec.SCHEME_NONE)
+            if fec_scheme != fec.SCHEME_NONE and version >= util.VERSION_2:
+                self.fec_encoder = fec.FECEncoder(fec_scheme, self.fec_block_size, self.packet_size)
+            self.on_negotiated(options)
+            logger.info('Client negotiated version and checksum: %d %d', version, checksum_type)
+            return
+
+        raise TimeoutError('No negotiation response from the server')
+
+    def send_parity(self, parity_pkts):
+        for parity_pkt in parity_pkts:
+            self.udp_send(parity_pkt)
+            first_seq, count, parity_index = fec.PARITY_HEADER.unpack_from(parity_pkt)[2:5]
+            self.metrics.on_parity(first_seq, parity_index)
+
+    def handle_report(self, pkt):
+        # The server tells how many data packets of a block it received before the parity
+        report = fec.analyse_report_pkt(pkt)
+        if report is not None:
+            self.redundancy.on_report(report[1], report[2])
+
+    def handle_sack(self, cumulative_ack, sack_bitmap):
+        # The cumulative part is a normal ack, the subclasses may use the bitmap
+        self.handle_ack(cumulative_ack)
+
+    def handle_ack_pkt(self, pkt):
+        if len(pkt) >= 2 and pkt[1] & util.FLAG_PARITY:
+            self.handle_report(pkt)
+            return
+        ack = self.analyse_pkt(pkt)
+        if ack is None:
+            return
+        ack_seq, window, sack_bitmap = ack
+        if window is not None and self.receive_window is not None:
+            self.receive_window = window
+        if sack_bitmap is None:
+            self.handle_ack(ack_seq)
+        else:
+            # One selective ack covers the whole window
+            self.handle_sack(ack_seq, sack_bitmap)
+
+    def receive_acks(self):
+        """
+        Handle the pending acks until the socket would block, the window is filled again once for all of them
+        """
+        received = self.client_socket.recvfrom_into(self.ack_buffer)
+        ack_num = 0
+        while received is not None:
+            nbytes, address = received
+            self.handle_ack_pkt(memoryview(self.ack_buffer)[:nbytes])
+            ack_num += 1
+            if not self.batch_io or ack_num >= channel.RECV_BATCH:
+                return
+            received = channel.recv_nowait(self.client_socket, self.ack_buffer)
+
+    def set_packet_size(self, packet_size):
+        # Only change it before any frame is filled
+        if packet_size != self.packet_size:
+            self.packet_size = packet_size
+            self.frame_pool = util.FramePool(self.frame_pool.size, packet_size, self.header,
+                                             scatter_gather=self.batch_io)
+
+    def close_connection(self):
+        """
+        Send the end packet until the server acks the close, then confirm the ack
+        A server without the close handshake gets the end packet END_REPEAT times instead
+        """
+        if not self.close_enabled:
+            for i in range(0, END_REPEAT):
+                self.udp_send(self.make_pkt(0, b'', 0, util.FLAG_END))
+            return
+
+        end_pkt = self.make_pkt(0, b'', 0, util.FLAG_END | util.FLAG_FIN)
+        for i in range(0, CLOSE_RETRIES):
+            self.udp_send(end_pkt)
+            deadline = time.monotonic() + self.rto_estimator.get_rto()
+            while True:
+                readable, writeable, errors = select.select([self.client_socket, ], [], [],
+                                                            max(deadline - time.monotonic(), 0))
+                if len(readable) == 0:
+                    break
+                nbytes, address = self.client_socket.recvfrom_into(self.ack_buffer)
+                # The late acks are skipped
+                if nbytes >= 2 and self.ack_buffer[1] & util.FLAG_FIN:
+                    self.udp_send(util.make_close_pkt(False))
+                    return
+        logger.warning('Client close without ack, the server does not answer')
+
+    def discover_mss(self):
+        mtu = pmtu.MTUProber(self.client_socket, self.server_address, self.max_mtu).discover()
+        # The parity packets must fit the path too
+        self.mss = pmtu.get_mss(mtu, fec.PARITY_OVERHEAD if self.fec_scheme != fec.SCHEME_NONE else 0)
+        logger.info('Client discover path MTU and packet size: %d %d', mtu, self.mss)
+
+    def query_chunks(self, digests):
+        """
+        Ask the server which chunks it has, the query is repeated like the negotiation
+        The stream is queried while it's sent, the acks received meanwhile are handled as usual
+        @return: the bitmap of the stored chunks, 0 if the server doesn't answer
+        """
+        self.query_id += 1
+        query_pkt = dedup.make_query_pkt(self.connection_id, self.query_id, digests)
+        for i in range(0, NEGOTIATE_RETRIES):
+            self.udp_send(query_pkt)
+            deadline = time.monotonic() + NEGOTIATE_TIMEOUT
+            while True:
+                readable, writeable, errors = select.select([self.client_socket, ], [], [],
+                                                            max(deadline - time.monotonic(), 0))
+                if len(readable) == 0:
+                    break
+                nbytes, address = self.client_socket.recvfrom_into(self.ack_buffer)
+                pkt = memoryview(self.ack_buffer)[:nbytes]
+                if nbytes < 2 or not pkt[1] & util.FLAG_QUERY:
+                    self.handle_ack_pkt(pkt)
+                    continue
+                response = dedup.analyse_response_pkt(pkt)
+                if response is not None and response[1] == self.query_id:
+                    return response[2]
+        return 0
+
+    def handle_ack(self, ack_seq):
+        # Slide the window over the acked packets
+        raise NotImplementedError
+
+    def send_pending(self):
+        """
+        Send the retransmissions, then the new packets of the window, as fast as the pacer lets them
+        @return: seconds until the pacer lets the next pending packet go, None if nothing is pending
+        """
+        raise NotImplementedError
+
+    def next_deadline(self):
+        """
+        @return: the time the retransmission timer expires, None if no timer is running
+        """
+        raise NotImplementedError
+
+    def handle_timeout(self):
+        # Resend the packets whose timer expired, called by the send loop after each wait
+        raise NotImplementedError
+
+    def rdt_send(self, input_stream):
+        if self.resumable and util.get_transfer_id(input_stream) is not None:
+            # The same file gets the same id, so the server finds the progress of the previous runs
+            self.connection_id = util.get_transfer_id(input_stream)
+        if self.probe_mtu:
+            self.discover_mss()
+        if self.codec != compression.CODEC_NONE:
+            # Sample the first blocks, the incompressible data is sent raw
+            sample, input_stream = compression.sample_stream(input_stream)
+            self.proposed_codec = compression.choose_codec(sample, self.codec)
+        self.negotiate()
+        if self.dedup_enabled:
+            # Only the chunks the server doesn't have are sent, the others are referred by digest
+            # The chunks are queried while the stream is sent, a batch at a time
+            encoder = dedup.encode(input_stream, self.query_chunks)
+            input_stream = io.BufferedReader(encoder)
+        if self.compression_codec != compression.CODEC_NONE:
+            compressor = compression.CompressReader(input_stream, self.compression_codec)
+            input_stream = io.BufferedReader(compressor)
+
+        # Packets are read from the stream into their frames only when there is room in the window
+        reader = util.PacketReader(input_stream, self.packet_size)
+        if self.resume_index > 0:
+            logger.info('Client resume from packet: %d', self.resume_index)
+            reader.skip(self.resume_index * reader.packet_size)
+        end_of_stream = False
+
+        while True:
+            if end_of_stream and self.packet_queue.is_empty():
+                # All the packets are sent, close the connection
+                self.close_connection()
+                logger.info('The total number of data packets: %d', self.packet_num)
+                break
+
+            # The packets are put into the sliding window to get the repeatable sequence number
+            window = self.get_window()
+            self.ensure_capacity(window)
+            while not end_of_stream and len(self.packet_queue) < window:
+                length = self.frame_pool.fill(self.next_seq, reader)
+                if length == 0:
+                    end_of_stream = True
+                    break
+                # Each item has the payload length, the sent and acked flags and the timer state, see util.WindowEntry
+                self.packet_queue.append(util.WindowEntry(length))
+                self.next_seq = (self.next_seq + 1) % self.seq_space
+                self.packet_num += 1
+
+            # The items are read in place, the window only changes once an ack is received
+            self.metrics.on_window(len(self.packet_queue))
+            self.pacer.set_rate(window, self.rto_estimator.srtt)
+            pacing_delay = self.send_pending()
+            if end_of_stream and self.send_next == self.next_seq and self.fec_encoder is not None:
+                # The last block is short
+                self.send_parity(self.fec_encoder.flush())
+
+            if end_of_stream and self.packet_queue.is_empty():
+                # The end of the stream is found after the last ack, nothing is left to wait for
+                continue
+
+            # Wait response form server until the retransmission timer expires
+            deadline = self.next_deadline()
+            wait_time = self.timeout if deadline is None else max(deadline - time.monotonic(), 0)
+            if pacing_delay is not None:
+                # Or until the pacer lets the next packet go
+                wait_time = min(wait_time, pacing_delay)
+            readable, writeable, errors = select.select([self.client_socket, ], [], [], wait_time)
+            if len(readable) > 0:
+                self.receive_acks()
+
+            self.handle_timeout()
+
+        if self.dedup_enabled:
+            logger.info('Client deduplicate chunks, bytes sent and referred: %d %d', encoder.data_size,
+                        encoder.reference_size)
+        if self.compression_codec != compression.CODEC_NONE:
+            logger.info('Client compress stream, bytes and compressed: %d %d', compressor.raw_size,
+                        compressor.compressed_size)
+        self.frame_pool.release()
+        reader.close()
+        input_stream.close()
+        self.channel.close()
+        self.client_socket.close()
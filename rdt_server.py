@@ -0,0 +1,403 @@
+"""
+This module implements the common part of the GBN and SR servers: the session table, the negotiation,
+the parity and closing the transfers.
+
+The subclasses handle the data packets and the acks, see gbn_server.GBNServer and sr_server.SRServer.
+The options of a subclass are applied by negotiate_session and told to the client by make_response_options.
+
+Author:
+    Aaron Li
+"""
+import collections
+import logging
+import select
+import socket
+import struct
+import time
+
+import common_util as util
+import channel
+import compression
+import dedup
+import fec
+import metrics as rdt_metrics
+import pmtu
+import session
+import sink
+
+# The sessions are logged, a server used as a library is silent unless logging is configured
+logger = logging.getLogger(__name__)
+
+LOSS_RATE = 0.3
+
+
+class RDTServer:
+    def __init__(self, server_address, loss_rate=LOSS_RATE, channel_options=None,
+                 checksum_types=util.CHECKSUM_PREFERENCE, max_sessions=session.MAX_SESSIONS,
+                 idle_timeout=session.IDLE_TIMEOUT, max_version=util.VERSION_2, batch_io=True, chunk_store=None,
+                 max_mss=pmtu.get_mss(pmtu.JUMBO_MTU), metrics=None, send_buffer=None, receive_buffer=None):
+        self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        # A window of packets arriving back to back is dropped by the OS beyond the receive buffer
+        channel.set_buffer_sizes(self.server_socket, send_buffer, receive_buffer)
+        self.server_socket.bind(server_address)
+        # Loss and the other impairments are emulated by the channel, see channel.make_channel
+        self.channel = channel.make_channel(self.server_socket, loss_rate, channel_options)
+        self.loss_rate = loss_rate
+        self.client_address = None
+        self.checksum_types = checksum_types
+        self.max_version = max_version
+        # The receive state of each transfer
+        self.session_table = session.SessionTable(max_sessions, idle_timeout)
+        self.sink_factory = None
+        # Packets are received into one buffer, the data is written out before the next receive
+        # It fits the data packets and the parity packets, whose header is larger
+        self.recv_frame = bytearray(max(util.HEADER_MAX_SIZE, fec.PARITY_HEADER.size + fec.SYMBOL_HEADER.size)
+                                    + max_mss)
+        # The largest packet size accepted, the packets are received into the frames of this size
+        self.max_mss = max_mss
+        # Drain the pending datagrams before waiting, False waits for every datagram as the first versions did
+        self.batch_io = batch_io
+        self.drained_num = 0
+        # The content store of the deduplicated transfers, see dedup.ChunkStore. None refuses them
+        self.chunk_store = chunk_store
+        # The events of all the sessions are counted and traced by the metrics, see metrics.Metrics
+        self.metrics = metrics if metrics is not None else rdt_metrics.NULL_METRICS
+        # The packets delivered from the decoder of the parity, (client address, packet), received before the socket
+        self.recovered_pkts = collections.deque()
+        # The end packet of a transfer is acked, the client confirms the ack unless it's lost
+        self.close_acked = False
+        # (session key, error) of the transfers whose stream can't be decoded
+        self.transfer_errors = []
+
+    def udp_send(self, pkt, client_address=None):
+        if not self.channel.send(pkt, client_address or self.client_address):
+            self.metrics.on_loss(channel.get_pkt_length(pkt))
+
+    def make_session(self, client_address, connection_id, output_stream):
+        return session.Session(client_address, connection_id, output_stream)
+
+    def open_session(self, client_address, connection_id):
+        if self.session_table.is_full():
+            logger.warning('Server refuse session, too many sessions: %s', client_address)
+            return None
+        output_stream = self.sink_factory(client_address, connection_id)
+        if output_stream is None:
+            return None
+
+        client_session = self.make_session(client_address, connection_id, output_stream)
+        self.session_table.add(client_session)
+        logger.info('Server open session: %s', client_session.key)
+        return client_session
+
+    def forget_session(self, client_session):
+        # Drop the protocol state the server keeps about the session out of the table
+        pass
+
+    def close_session(self, client_session):
+        self.session_table.remove(client_session)
+        self.forget_session(client_session)
+        self.close_output(client_session)
+
+    def close_output(self, client_session):
+        # A stage which can't decode the stream raises when it's closed, the transfer fails
+        try:
+            client_session.output_stream.close()
+        except ValueError as error:
+            logger.warning('Server fail session: %s %s', client_session.key, error)
+            client_session.error = error
+            self.transfer_errors.append((client_session.key, error))
+
+    def evict_idle_sessions(self):
+        for client_session in self.session_table.pop_idle():
+            logger.info('Server evict idle session: %s', client_session.key)
+            self.forget_session(client_session)
+            self.close_output(client_session)
+
+    def get_wait_time(self):
+        # Wake up regularly to evict the idle sessions
+        return session.IDLE_CHECK_INTERVAL
+
+    def receive_datagram(self):
+        """
+        Drain the pending datagrams first, wait for the next one only when the socket would block
+        The sessions are looked after once per wait, not once per packet
+        @return: the number of bytes and the client address, None on timeout
+        """
+        if self.recovered_pkts:
+            # The packets delivered from the decoder are received like the others
+            client_address, pkt = self.recovered_pkts.popleft()
+            self.recv_frame[:len(pkt)] = pkt
+            return len(pkt), client_address
+        if self.batch_io and self.drained_num < channel.RECV_BATCH:
+            received = channel.recv_nowait(self.server_socket, self.recv_frame)
+            if received is not None:
+                self.drained_num += 1
+                return received
+        self.drained_num = 0
+        self.evict_idle_sessions()
+        # The socket itself stays blocking, a socket timeout would make every drain wait for it too
+        readable, writeable, errors = select.select([self.server_socket, ], [], [], self.get_wait_time())
+        if len(readable) == 0:
+            return None
+        return self.server_socket.recvfrom_into(self.recv_frame)
+
+    def handle_data(self, client_session, seq_num, checksum, data):
+        """
+        Ack the data packet and buffer it until it's in order
+        @return: the payloads delivered in order, None if the packet delivers nothing
+        """
+        raise NotImplementedError
+
+    def wait_data(self):
+        """
+        Receive packets until some of them can be delivered in order or a transfer ends
+        @return: the session of the packets, the data list and the end flag
+        """
+        while True:
+            received = self.receive_datagram()
+            if received is None:
+                continue
+            nbytes, client_address = received
+            self.client_address = client_address
+            pkt = memoryview(self.recv_frame)[:nbytes]
+            if nbytes < 2:
+                continue
+            if pkt[1] & util.FLAG_NEGOTIATE:
+                self.handle_negotiate(pkt)
+                continue
+            if pkt[1] & util.FLAG_QUERY:
+                self.handle_query(pkt)
+                continue
+            if pkt[1] & util.FLAG_PROBE:
+                self.handle_probe(pkt)
+                continue
+            if pkt[1] & util.FLAG_PARITY:
+                self.handle_parity(pkt)
+                continue
+
+            client_session = self.session_table.find(client_address)
+            if client_session is None:
+                if pkt[1] & util.FLAG_END and pkt[1] & util.FLAG_FIN and self.session_table.is_closed(client_address):
+                    # The ack of the close is lost, the client sends the end packet again
+                    self.udp_send(util.make_close_pkt(True), client_address)
+                    continue
+                if pkt[1] & (util.FLAG_END | util.FLAG_FIN) or self.session_table.is_closed(client_address):
+                    # The late packets of a finished transfer
+                    continue
+                if not util.is_legacy_start(pkt):
+                    # Not the first packet of a client without negotiation, e.g. the session is evicted
+                    continue
+                # A version 1 client starts sending without negotiation
+                client_session = self.open_session(client_address, 0)
+                if client_session is None:
+                    continue
+            self.session_table.touch(client_session)
+            analysed = client_session.header.analyse_pkt(pkt)
+            if analysed is None:
+                continue
+            seq_num, end_flag, checksum, data = analysed
+
+            if end_flag:
+                # The transfer is complete
+                if end_flag & util.FLAG_FIN:
+                    self.udp_send(util.make_close_pkt(True), client_address)
+                    self.close_acked = True
+                return client_session, [], end_flag
+
+            data_list = self.handle_data(client_session, seq_num, checksum, data)
+            if data_list:
+                return client_session, data_list, end_flag
+
+    def handle_query(self, pkt):
+        # Tell the client of a deduplicated transfer which chunks the content store has
+        analysed = dedup.analyse_query_pkt(pkt)
+        if analysed is None:
+            return
+        connection_id, query_id, digests = analysed
+        client_session = self.session_table.get((self.client_address, connection_id))
+        stored_bitmap = 0
+        if client_session is not None and client_session.dedup_sink is not None:
+            self.session_table.touch(client_session)
+            stored_bitmap = client_session.dedup_sink.pin(digests)
+        self.udp_send(dedup.make_response_pkt(connection_id, query_id, stored_bitmap, len(digests)))
+
+    def handle_parity(self, pkt):
+        # Rebuild the lost packets of the block, the first parity of each block is answered by a loss report
+        client_session = self.session_table.find(self.client_address)
+        # A corrupted parity packet is dropped, it would rebuild a wrong packet
+        analysed = fec.analyse_parity_pkt(pkt)
+        if client_session is None or client_session.fec_decoder is None or analysed is None:
+            return
+        first_seq, count, parity_index, parity_num, scheme, parity = analysed
+        if scheme != client_session.fec_decoder.scheme:
+            return
+        self.session_table.touch(client_session)
+        recovered, received_num = client_session.fec_decoder.add_parity(first_seq, count, parity_index,
+                                                                        parity_num, parity)
+        if received_num is not None:
+            self.udp_send(fec.make_report_pkt(first_seq, count, received_num))
+        self.add_recovered(client_session, recovered)
+
+    def add_recovered(self, client_session, recovered):
+        # The packets rebuilt from the parity
+        for seq_num, payload in recovered:
+            self.metrics.on_recover(seq_num)
+
+    def handle_probe(self, pkt):
+        # Tell the size of the path MTU probe, the response is small so it isn't an amplifier
+        probe_id = pmtu.analyse_probe_pkt(pkt)
+        if probe_id is not None:
+            self.udp_send(pmtu.make_probe_response(probe_id, len(pkt)))
+
+    def start_transfer(self, client_session, resume):
+        """
+        A resumed transfer continues after the packets its sink has from the previous runs
+        """
+        output_stream = client_session.output_stream
+        if isinstance(output_stream, sink.OffsetSink):
+            # The packets are at the offsets of the negotiated packet size
+            output_stream.set_packet_size(client_session.mss)
+            output_stream.start(resume)
+            if resume:
+                client_session.resume_index = output_stream.resume_index
+                logger.info('Server resume session from packet: %s %d', client_session.key,
+                            client_session.resume_index)
+
+    def negotiate_session(self, client_session, options, version, checksum_type):
+        """
+        Apply the chosen version and checksum algorithm, and the options of the protocol
+        """
+        client_session.set_header(util.PacketHeader(version, checksum_type))
+
+    def make_response_options(self, client_session, options):
+        """
+        @param options: the options proposed by the client
+        @return: the options chosen for the session
+        """
+        response_options = {
+            util.OPTION_CHECKSUM: bytes([client_session.header.checksum_type]),
+            util.OPTION_VERSION: bytes([client_session.header.version]),
+        }
+        if util.OPTION_RESUME in options:
+            response_options[util.OPTION_RESUME] = struct.pack('!Q', client_session.resume_index)
+        if client_session.dedup_sink is not None:
+            response_options[util.OPTION_DEDUP] = b''
+        if client_session.codec != compression.CODEC_NONE:
+            response_options[util.OPTION_COMPRESSION] = bytes([client_session.codec])
+        if util.OPTION_MSS in options:
+            response_options[util.OPTION_MSS] = struct.pack('!H', client_session.mss)
+        if client_session.fec_decoder is not None:
+            response_options[util.OPTION_FEC] = bytes([client_session.fec_decoder.scheme])
+        if util.OPTION_CLOSE in options:
+            response_options[util.OPTION_CLOSE] = b''
+        return response_options
+
+    def handle_negotiate(self, pkt):
+        """
+        Open the session of the connection, choose its protocol version and checksum algorithm
+        The response is resent for every repeated request
+        """
+        options = util.analyse_negotiate_pkt(pkt)
+        connection_id = util.get_connection_id(options)
+        client_session = self.session_table.get((self.client_address, connection_id))
+        if client_session is None:
+            if self.session_table.is_closed(self.client_address, connection_id):
+                # A late request of a finished transfer
+                return
+            old_sessions = []
+            if util.OPTION_RESUME in options:
+                # The previous run of the resumed transfer is dead, its progress is saved when it closes
+                old_sessions = self.session_table.find_connection(connection_id)
+            old_session = self.session_table.find(self.client_address)
+            if old_session is not None and old_session not in old_sessions:
+                # The address starts a new transfer, the old one is abandoned
+                old_sessions.append(old_session)
+            for old_session in old_sessions:
+                logger.info('Server abandon session: %s', old_session.key)
+                self.close_session(old_session)
+            client_session = self.open_session(self.client_address, connection_id)
+            if client_session is None:
+                return
+            client_session.mss = min(util.get_option_int(options, util.OPTION_MSS, util.PACKET_SIZE), self.max_mss)
+            self.start_transfer(client_session, util.OPTION_RESUME in options)
+            if self.chunk_store is not None and util.OPTION_DEDUP in options and client_session.resume_index == 0:
+                # The deduplicated stream is decoded before the sink
+                client_session.dedup_sink = dedup.DedupSink(client_session.output_stream, self.chunk_store)
+                client_session.output_stream = client_session.dedup_sink
+            codec = util.get_option_int(options, util.OPTION_COMPRESSION, compression.CODEC_NONE)
+            if codec in compression.CODECS and client_session.resume_index == 0:
+                # The compressed stream is decompressed first, the codec is chosen by the client
+                client_session.codec = codec
+                client_session.output_stream = compression.DecompressSink(client_session.output_stream, codec)
+            proposed = options.get(util.OPTION_CHECKSUM, bytes([util.CHECKSUM_LEGACY]))
+            version = util.choose_version(options, self.max_version)
+            self.negotiate_session(client_session, options, version, util.choose_checksum(proposed, self.checksum_types))
+            fec_scheme = fec.choose_scheme(options.get(util.OPTION_FEC, b''))
+            if fec_scheme != fec.SCHEME_NONE and version >= util.VERSION_2:
+                # The parity needs the 4-byte sequence numbers of version 2
+                client_session.fec_decoder = fec.FECDecoder(fec_scheme, seq_space=client_session.header.seq_space)
+            logger.info('Server negotiated version and checksum: %d %d', version, client_session.header.checksum_type)
+
+        self.session_table.touch(client_session)
+        self.udp_send(util.make_negotiate_pkt(self.make_response_options(client_session, options)))
+
+    def serve(self, sink_factory, max_transfers=None):
+        """
+        Receive the transfers of many clients on one port
+        @param sink_factory: called as sink_factory(client_address, connection_id) for each new transfer,
+                             return the output stream or None to refuse the transfer
+        @param max_transfers: return once this number of transfers are complete, None to serve forever
+                              A failed transfer is complete too, its error is kept in transfer_errors
+        """
+        self.sink_factory = sink_factory
+        transfer_num = 0
+        while max_transfers is None or transfer_num < max_transfers:
+            client_session, data_list, end_flag = self.wait_data()
+            if end_flag:
+                logger.info('Server complete session: %s', client_session.key)
+                if isinstance(client_session.output_stream, sink.OffsetSink):
+                    client_session.output_stream.complete()
+                self.close_session(client_session)
+                transfer_num += 1
+                continue
+
+            for i in range(len(data_list)):
+                self.metrics.on_deliver(len(data_list[i]))
+                client_session.output_stream.write(data_list[i])
+
+    def mdt_receive(self, output_stream):
+        # Receive one transfer, the other clients are refused. The writes of a plain stream are coalesced
+        # A transfer whose stream can't be decoded raises the error of its decoding stage
+        output_streams = [sink.make_sink(output_stream)]
+        self.serve(lambda client_address, connection_id: output_streams.pop() if output_streams else None, 1)
+        if self.close_acked:
+            self.linger()
+        self.close()
+        if self.transfer_errors:
+            raise self.transfer_errors[0][1]
+
+    def linger(self):
+        """
+        Ack the end packets repeated by the client until it confirms the close, at most CLOSE_LINGER seconds
+        """
+        deadline = time.monotonic() + session.CLOSE_LINGER
+        while True:
+            readable, writeable, errors = select.select([self.server_socket, ], [], [],
+                                                        max(deadline - time.monotonic(), 0))
+            if len(readable) == 0:
+                return
+            nbytes, client_address = self.server_socket.recvfrom_into(self.recv_frame)
+            flags = self.recv_frame[1] if nbytes >= 2 else 0
+            if not flags & util.FLAG_FIN or not self.session_table.is_closed(client_address):
+                continue
+            if not flags & util.FLAG_END:
+                # The client has the ack
+                return
+            self.client_address = client_address
+            self.udp_send(util.make_close_pkt(True), client_address)
+
+    def close(self):
+        for client_session in list(self.session_table.sessions.values()):
+            self.close_session(client_session)
+        self.channel.close()
+        self.server_socket.close()
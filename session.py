@@ -0,0 +1,129 @@
+"""
+This module implements the connection table of the servers.
+
+Each transfer has its own receive state, keyed by (client address, connection id),
+so many clients can upload to one bound port at the same time.
+
+Author:
+    Aaron Li
+"""
+import collections
+import time
+
+import common_util as util
+
+MAX_SESSIONS = 256
+IDLE_TIMEOUT = 30
+# The server wakes up at this interval to evict the idle sessions when no packet comes
+IDLE_CHECK_INTERVAL = 1
+# After the last transfer, the server acks the repeated end packets until the client confirms the close
+# or this number of seconds pass, the ack of the close may be lost
+CLOSE_LINGER = 2
+
+
+class Session:
+    """
+    The receive state of one transfer. The servers extend it with their protocol state
+    """
+    def __init__(self, client_address, connection_id, output_stream):
+        self.client_address = client_address
+        self.connection_id = connection_id
+        self.key = (client_address, connection_id)
+        self.output_stream = output_stream
+        self.last_active = time.monotonic()
+        # The packets of the transfer written by the previous runs, the client skips them
+        self.resume_index = 0
+        # The payload size of the data packets, negotiated by the client
+        self.mss = util.PACKET_SIZE
+        # The stages which decode the stream before the output stream, the codec is compression.CODEC_NONE
+        self.dedup_sink = None
+        self.codec = 0
+        # The error of a stage which can't decode the stream, the transfer fails with it
+        self.error = None
+        # Rebuild the lost packets from the parity of the client, see fec.FECDecoder. None without parity
+        self.fec_decoder = None
+        # Version 1 with the legacy checksum is used until the client negotiates another one
+        self.set_header(util.PacketHeader())
+
+    def set_header(self, header):
+        self.header = header
+
+
+class SessionTable:
+    def __init__(self, max_sessions=MAX_SESSIONS, idle_timeout=IDLE_TIMEOUT):
+        self.max_sessions = max_sessions
+        self.idle_timeout = idle_timeout
+        # Key: session, the least recently active one first
+        self.sessions = collections.OrderedDict()
+        # Client address: key of its current session
+        self.address_keys = {}
+        # Client address: (connection id, close time) of its finished session
+        self.closed_sessions = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def is_full(self):
+        return len(self.sessions) >= self.max_sessions
+
+    def get(self, key):
+        return self.sessions.get(key)
+
+    def find(self, client_address):
+        # Data packets don't carry the connection id, use the current session of the address
+        key = self.address_keys.get(client_address)
+        if key is None:
+            return None
+        return self.sessions.get(key)
+
+    def add(self, session):
+        self.sessions[session.key] = session
+        self.address_keys[session.client_address] = session.key
+        self.closed_sessions.pop(session.client_address, None)
+
+    def find_connection(self, connection_id):
+        # The sessions of the connection id from any address, e.g. the previous run of a resumed transfer
+        return [session for session in self.sessions.values() if session.connection_id == connection_id]
+
+    def touch(self, session):
+        session.last_active = time.monotonic()
+        self.sessions.move_to_end(session.key)
+
+    def remove(self, session):
+        if self.sessions.pop(session.key, None) is None:
+            return
+        if self.address_keys.get(session.client_address) == session.key:
+            del self.address_keys[session.client_address]
+        # Remember it for a while to ignore the late packets of the finished transfer
+        self.closed_sessions.pop(session.client_address, None)
+        self.closed_sessions[session.client_address] = (session.connection_id, time.monotonic())
+
+    def is_closed(self, client_address, connection_id=None):
+        """
+        Whether the address (and connection id if given) finished a transfer recently
+        """
+        closed = self.closed_sessions.get(client_address)
+        if closed is None or time.monotonic() - closed[1] > self.idle_timeout:
+            return False
+        return connection_id is None or closed[0] == connection_id
+
+    def pop_idle(self):
+        """
+        Remove the sessions idle longer than idle_timeout
+        @return: the removed sessions
+        """
+        now = time.monotonic()
+        idle_sessions = []
+        while self.sessions:
+            session = next(iter(self.sessions.values()))
+            if now - session.last_active <= self.idle_timeout:
+                break
+            self.remove(session)
+            idle_sessions.append(session)
+
+        while self.closed_sessions:
+            client_address, (connection_id, close_time) = next(iter(self.closed_sessions.items()))
+            if now - close_time <= self.idle_timeout:
+                break
+            del self.closed_sessions[client_address]
+        return idle_sessions
@@ -0,0 +1,197 @@
+"""
+This module implements the sinks where the servers write the received data.
+
+StreamSink coalesces the in-order data into large writes of the output stream.
+OffsetSink writes every packet at its final offset of the file as soon as it arrives, with pwrite or
+into a memory mapping of the file. The SR server doesn't buffer the out-of-order packets for it, the
+reorder buffer only remembers which packets are received, so a large window costs no receiver memory.
+A resumable OffsetSink keeps the progress index of its file, see progress.ProgressIndex, so the next
+run of an interrupted transfer continues from the first missing packet.
+
+Usage:
+    server.mdt_receive(sink.OffsetSink('output.jpg'))
+    server.serve(sink.resumable_sink_factory('data', '.jpg'))
+
+Author:
+    Aaron Li
+"""
+import mmap
+import os
+
+import common_util as util
+import progress
+
+# The in-order data is written out once this number of bytes are collected
+COALESCE_SIZE = 256 * 1024
+MODE_PWRITE = 'pwrite'
+MODE_MMAP = 'mmap'
+# The mapping starts with this size and doubles when a packet is beyond it
+MMAP_MIN_SIZE = 1024 * 1024
+
+
+class StreamSink:
+    def __init__(self, output_stream, coalesce_size=COALESCE_SIZE):
+        self.output_stream = output_stream
+        self.coalesce_size = coalesce_size
+        self.buffer = bytearray()
+
+    def write(self, data):
+        # The data is copied, the server reuses its frames
+        self.buffer += data
+        if len(self.buffer) >= self.coalesce_size:
+            self.flush()
+
+    def flush(self):
+        if len(self.buffer) > 0:
+            self.output_stream.write(self.buffer)
+            self.buffer = bytearray()
+
+    def close(self):
+        self.flush()
+        self.output_stream.close()
+
+
+class OffsetSink:
+    """
+    Packet i of the transfer is written at offset i * packet_size, all the packets but the last one are full
+    """
+    def __init__(self, path, packet_size=util.PACKET_SIZE, size=0, mode=MODE_PWRITE, resumable=False):
+        """
+        @param size: preallocate the file for this number of bytes if the size of the transfer is known
+        @param mode: MODE_PWRITE writes every packet with pwrite, MODE_MMAP copies it into the mapping
+        @param resumable: keep the file and its progress index from the previous runs of the transfer
+        """
+        flags = os.O_RDWR | os.O_CREAT
+        self.progress = None
+        if resumable:
+            self.progress = progress.ProgressIndex(path + progress.SIDECAR_SUFFIX, packet_size)
+            if not os.path.exists(path):
+                # The progress of a deleted file is void
+                self.progress.reset()
+        else:
+            flags |= os.O_TRUNC
+        self.fd = os.open(path, flags, 0o644)
+        self.packet_size = packet_size
+        self.mode = mode
+        self.load_progress()
+        self.capacity = 0
+        self.mapped = None
+        if size > 0:
+            self.allocate(size)
+
+    def load_progress(self):
+        # The packets before the resume index are on the disk from the previous runs
+        self.resume_index = 0
+        # The end of the data written, the file is truncated to it when closed
+        self.size = 0
+        if self.progress is not None:
+            self.resume_index = self.progress.first_missing
+            self.size = self.progress.data_size
+        # The in-order writes start from it
+        self.position = self.resume_index * self.packet_size
+
+    def set_packet_size(self, packet_size):
+        """
+        Use the packet size negotiated by the transfer before it starts
+        The progress of the previous runs is void if they used another packet size
+        """
+        if packet_size == self.packet_size:
+            return
+        self.packet_size = packet_size
+        if self.progress is not None:
+            self.progress = progress.ProgressIndex(self.progress.path, packet_size)
+        self.load_progress()
+
+    def allocate(self, capacity):
+        if hasattr(os, 'posix_fallocate'):
+            os.posix_fallocate(self.fd, 0, capacity)
+        else:
+            os.ftruncate(self.fd, capacity)
+        self.capacity = capacity
+        if self.mode == MODE_MMAP:
+            if self.mapped is not None:
+                self.mapped.close()
+            self.mapped = mmap.mmap(self.fd, capacity)
+
+    def write_at(self, offset, data):
+        length = len(data)
+        if self.mode == MODE_MMAP:
+            if offset + length > self.capacity:
+                capacity = max(self.capacity, MMAP_MIN_SIZE)
+                while capacity < offset + length:
+                    capacity *= 2
+                self.allocate(capacity)
+            self.mapped[offset:offset + length] = data
+        else:
+            view = memoryview(data)
+            written = 0
+            while written < length:
+                written += os.pwrite(self.fd, view[written:], offset + written)
+        self.size = max(self.size, offset + length)
+        if self.progress is not None:
+            self.progress.mark(offset // self.packet_size, offset + length)
+            if self.progress.is_due():
+                self.flush_progress()
+
+    def flush_progress(self):
+        # The data must be on the disk before the index says so
+        if self.mapped is not None:
+            self.mapped.flush()
+        else:
+            os.fsync(self.fd)
+        self.progress.save()
+
+    def start(self, resume):
+        """
+        Called when the transfer opens. A resumed transfer continues after the packets on the disk,
+        the other ones start over
+        """
+        if not resume and self.progress is not None:
+            self.progress.reset()
+            self.resume_index = 0
+            self.size = 0
+        self.position = self.resume_index * self.packet_size
+
+    def complete(self):
+        # The transfer is complete, its progress index isn't needed any more
+        if self.progress is not None:
+            self.progress.remove()
+            self.progress = None
+
+    def write_packet(self, index, data):
+        self.write_at(index * self.packet_size, data)
+
+    def write(self, data):
+        # The in-order data of the protocols without packet index, e.g. GBN
+        self.write_at(self.position, data)
+        self.position += len(data)
+
+    def close(self):
+        if self.fd is None:
+            return
+        if self.progress is not None:
+            self.flush_progress()
+        if self.mapped is not None:
+            self.mapped.close()
+            self.mapped = None
+        # Drop the preallocated space beyond the data
+        os.ftruncate(self.fd, self.size)
+        os.close(self.fd)
+        self.fd = None
+
+
+def resumable_sink_factory(directory, suffix=''):
+    """
+    The sink factory of SRServer.serve and GBNServer.serve. The output of a transfer is named by its
+    connection id, the transfer id of a resumable client, so the next run continues the same file
+    """
+    def make_resumable_sink(client_address, connection_id):
+        return OffsetSink(os.path.join(directory, '%08x%s' % (connection_id, suffix)), resumable=True)
+    return make_resumable_sink
+
+
+def make_sink(output_stream):
+    # The sinks are used as they are, the writes of the other streams are coalesced
+    if isinstance(output_stream, (StreamSink, OffsetSink)):
+        return output_stream
+    return StreamSink(output_stream)
@@ -4,178 +4,236 @@ This module implements the client of SR Protocol.
 Author:
     Aaron Li
 """
+import logging
 import os
-import random
-import socket
 import struct
 import time
-import threading
+import heapq
+import itertools
+import collections
 import common_util as util
-import select
-import copy
-
-BUFFER_SIZE = 4096
-TIMEOUT = 10
-WINDOW_SIZE = 10
-LOSS_RATE = 0.3
-QUEUE_MAX_SIZE = 32
-
-class SRClient:
-    def __init__(self, server_address, timeout=TIMEOUT,
-                 window_size=WINDOW_SIZE, loss_rate=LOSS_RATE):
-        self.client_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self.server_address = server_address
-        self.timeout = timeout
-        self.window_size = window_size
-        self.loss_rate = loss_rate
-        self.send_base = 0
-        self.next_seq = 0
-        self.packet_queue = util.CircularQueue(QUEUE_MAX_SIZE)
-        self.timer = None
+import rdt_client
+
+# With selective acks, a packet is lost once this number of packets sent after it are acked
+REORDER_THRESHOLD = 3
+
+class SRClient(rdt_client.RDTClient):
+    def __init__(self, server_address, timeout=rdt_client.TIMEOUT, window_size=rdt_client.WINDOW_SIZE,
+                 loss_rate=rdt_client.LOSS_RATE, sack=True, **kwargs):
+        """
+        @param kwargs: the options of rdt_client.RDTClient
+        """
+        super().__init__(server_address, timeout, window_size, loss_rate, **kwargs)
+        # The retransmissions held by the pacer, (seq num, item, fast), they go before the new packets
+        self.resend_queue = collections.deque()
+        # Propose selective acks, they are used if the server accepts
+        self.sack = sack
+        self.sack_enabled = False
+        self.reorder_threshold = REORDER_THRESHOLD
+        # Heap of (deadline, counter, seq_num, item), one entry per outstanding transmission
+        self.timer_heap = []
+        self.timer_counter = itertools.count()
+
+    def make_negotiate_options(self):
+        options = super().make_negotiate_options()
+        # The server buffers no more packets than the client sends
+        options[util.OPTION_RECEIVE_WINDOW] = struct.pack('!I', self.max_window_size)
+        if self.sack:
+            options[util.OPTION_SACK] = bytes([1])
+        return options
+
+    def on_negotiated(self, options):
+        self.sack_enabled = util.OPTION_SACK in options
+        if self.fec_encoder is not None:
+            # A loss the parity repairs is acked by the end of its block, don't resend it before
+            self.reorder_threshold = max(REORDER_THRESHOLD, self.fec_block_size)
+
+    def start_timer(self, seq_num, data_item):
+        # Record the deadline in the item, the heap entry is stale once the item deadline changes
+        deadline = time.monotonic() + self.rto_estimator.get_rto(data_item.timeout_count)
+        data_item.deadline = deadline
+        heapq.heappush(self.timer_heap, (deadline, next(self.timer_counter), seq_num, data_item))
+
+    def is_timer_valid(self, entry):
+        deadline, _, seq_num, data_item = entry
+        # The item may be acked, or the queue slot may be reused by a new item
+        queue = self.packet_queue
+        return queue.items[seq_num % queue.size] is data_item and not data_item.acked and data_item.deadline == deadline
+
+    def next_deadline(self):
+        # Drop the stale entries at the top of heap
+        while self.timer_heap and not self.is_timer_valid(self.timer_heap[0]):
+            heapq.heappop(self.timer_heap)
+        if not self.timer_heap:
+            return None
+        return self.timer_heap[0][0]
 
     def handle_timeout(self):
-        # Stop timer
-        if self.packet_queue.is_empty() and self.timer is not None:
-            self.timer.cancel()
+        now = time.monotonic()
+        expired = []
+        while self.timer_heap and self.timer_heap[0][0] <= now:
+            entry = heapq.heappop(self.timer_heap)
+            if self.is_timer_valid(entry):
+                expired.append(entry)
+
+        if len(expired) == 0:
             return
 
-        # Timeout, resend the packets
-        print('======= Handling timeout =======')
-        resend_queue = copy.deepcopy(self.packet_queue)
-        while not resend_queue.is_empty():
-            seq_num = resend_queue.front
-            data_item = resend_queue.dequeue()
-
-            # Resend the not ack item only
-            if not data_item[2]:
-                send_packet = self.make_pkt(seq_num, data_item[0], util.get_checksum(data_item[0]))
-                print('Resend packet:', seq_num)
-                self.udp_send(send_packet)
-        print('======= End =======')
-
-        # Reset timer
-        if self.timer is not None:
-            self.timer.cancel()
-        self.timer = threading.Timer(self.timeout, self.handle_timeout)
-        self.timer.start()
-
-    def udp_send(self, pkt):
-        # Simulate packet lose
-        if self.loss_rate == 0 or random.randint(0, int(1 / self.loss_rate)) != 1:
-            self.client_socket.sendto(pkt, self.server_address)
-        else:
-            print('Client packet lost.')
-
-        # Simulate the transfer time from client to server
-        time.sleep(0.3)
-
-    def make_pkt(self, seq_num, data, checksum, end_flag=False):
-        return struct.pack('BBB', seq_num, end_flag, checksum) + data
-
-    def analyse_pkt(self, pkt):
-        ack_seq = pkt[0]
-        return ack_seq
-
-    def rdt_send(self, input_stream):
-        data_list = util.generate_packets(input_stream)
-        print('The total number of data packets: ', len(data_list))
-
-        enqueue_packet_num = 0
-        is_beginning = True
-        while True:
-            if enqueue_packet_num >= len(data_list) and self.packet_queue.is_empty():
-                # All the packets are sent, send a packet to close the connection
-                for i in range(0, 10):
-                    # Repeat 10 times in case packet loss
-                    send_packet = self.make_pkt(0, bytes('', encoding='utf-8'), 0, True)
-                    self.udp_send(send_packet)
-                break
+        # Timeout, resend the expired packets only. The losses of one window are one loss event
+        self.metrics.on_timeout(len(expired))
+        self.congestion.on_loss()
+        for deadline, _, seq_num, data_item in expired:
+            # Count the timeouts for the exponential backoff of the packet
+            # Karn's algorithm: never measure RTT of the retransmitted packet
+            data_item.timeout_count += 1
+            self.resend_queue.append((seq_num, data_item, False))
+
+    def mark_acked(self, data_item, now):
+        """
+        @return: the RTT sample of the packet, None if it's retransmitted
+        """
+        # Its timer becomes stale
+        data_item.acked = True
+        # Karn's algorithm: never measure RTT of the retransmitted packet
+        if data_item.timeout_count or data_item.fast_retransmitted:
+            return None
+        return now - data_item.send_time
+
+    def dequeue_acked(self):
+        # The window slides over the acked items at its front at once
+        queue = self.packet_queue
+        acked_num = 0
+        while acked_num < len(queue) and queue.get(acked_num).acked:
+            acked_num += 1
+        queue.slide(acked_num)
+        self.send_base = (self.send_base + acked_num) % self.seq_space
+
+    def handle_ack(self, ack_seq):
+        """
+        In SR, we buffer items if they are in the window size
+        The sequence size must twice larger than the window size in order to distinguish the two seq num
+        For example:
+            sequence size = 8 and window size = 6 (sequence size < 2*window size)
+            [0, 1, 2, 3, 4, 5, 6, 7]
+            last_ack = 5, ack_seq = 2
+            can't determine whether the new ack_seq(2) is old one or new one extend the edge of circular queue
+        """
+        if (ack_seq - self.send_base) % self.seq_space >= len(self.packet_queue):
+            return
+        data_item = self.packet_queue.items[ack_seq % self.packet_queue.size]
+        if data_item.acked:
+            return
 
-            """
-            Put the data list into a circular queue to get the repeatable sequence number
-            front == rear : queue is empty
-            (rear + 1) % QUEUE_MAX_SIZE == front : queue is full
-            (rear - front + QUEUE_MAX_SIZE) % QUEUE_MAX_SIZE : size of the queue
-            """
-            while enqueue_packet_num < len(data_list) and self.packet_queue.queue_length() < self.window_size:
-                data = data_list[enqueue_packet_num]
-                # Each item have the data and two flags
-                # Flag one: indicate whether the data is sent before, the send one won't be sent again in send process
-                # Flag two: indicate whether the data is acked. acked one won't be sent again in resend process
-                self.packet_queue.enqueue([data, False, False])
-                enqueue_packet_num += 1
-
-            # Don't change the packet_queue during sending. Change the packet queue once an ack is received
-            send_queue = copy.deepcopy(self.packet_queue)
-            while not send_queue.is_empty():
-                seq_num = send_queue.front
-                data_item = send_queue.dequeue()
-
-                # The item is not sent before
-                if not data_item[1]:
-                    send_packet = self.make_pkt(seq_num, data_item[0], util.get_checksum(data_item[0]))
-                    print('*** Client Send packet:', seq_num)
-                    self.udp_send(send_packet)
-                    self.packet_queue.queue[seq_num][1] = True
-
-                    # Start the timer at the beginning
-                    if is_beginning:
-                        self.timer = threading.Timer(self.timeout, self.handle_timeout)
-                        self.timer.start()
-                        is_beginning = False
-
-            # Wait response form server
-            readable, writeable, errors = select.select([self.client_socket, ], [], [], 10)
-            if len(readable) > 0:
-                data, address = self.client_socket.recvfrom(BUFFER_SIZE)
-                ack_seq = self.analyse_pkt(data)
-
-                """
-                In SR, we buffer items if they are in the window size 
-                The sequence size must twice larger than the window size in order to distinguish the two seq num
-                For example:
-                    sequence size = 8 and window size = 6 (sequence size < 2*window size)
-                    [0, 1, 2, 3, 4, 5, 6, 7]
-                    last_ack = 5, ack_seq = 2
-                    can't determine whether the new ack_seq(2) is old one or new one extend the edge of circular queue 
-                    
-                """
-                ack_in_window_size = (ack_seq - self.packet_queue.front + QUEUE_MAX_SIZE)%QUEUE_MAX_SIZE < self.window_size
-                if ack_in_window_size:
-                    print('*** Client receive ack: ', ack_seq)
-                    # Receive ack, modify the item flag in queue
-                    self.packet_queue.queue[ack_seq][2] = True
-
-                    item_dequeued = False
-                    while not self.packet_queue.is_empty():
-                        # Only when the first item is acked, could they be dequeued one by one
-                        if not self.packet_queue.peek()[2]:
-                            break
-
-                        self.packet_queue.dequeue()
-                        item_dequeued = True
-
-                    # All send packet is received
-                    if self.packet_queue.is_empty() and self.timer is not None:
-                        self.timer.cancel()
-                        continue
-
-                    if item_dequeued:
-                        # Reset timer
-                        if self.timer is not None:
-                            self.timer.cancel()
-                        self.timer = threading.Timer(self.timeout, self.handle_timeout)
-                        self.timer.start()
-
-        if self.timer is not None:
-            self.timer.cancel()
-        input_stream.close()
-        self.client_socket.close()
-
-
-server_ip = '127.0.0.1'
-server_port = 9790
-server_address = (server_ip, server_port)
-client = SRClient(server_address)
-client_data = open(os.path.dirname(__file__) + '/data/' + 'player1.jpeg', 'rb')
-client.rdt_send(client_data)
+        self.metrics.on_ack(ack_seq)
+        rtt = self.mark_acked(data_item, time.monotonic())
+        if rtt is not None:
+            self.rto_estimator.update(rtt)
+            self.metrics.on_rtt(rtt)
+        self.congestion.on_ack(1, rtt)
+        self.dequeue_acked()
+
+    def handle_sack(self, cumulative_ack, sack_bitmap):
+        """
+        Update the whole window from one selective ack, then resend the packets it shows lost
+        """
+        queue = self.packet_queue
+        queue_length = len(queue)
+        # Positions are counted from send_base, bit i of the bitmap is the position cumulative_pos + i
+        cumulative_pos = (cumulative_ack + 1 - self.send_base) % self.seq_space
+        if cumulative_pos > queue_length:
+            # An old ack delayed by the link
+            return
+
+        self.metrics.on_ack(cumulative_ack)
+        now = time.monotonic()
+        acked_num = 0
+        rtt = None
+        acked_positions = list(range(0, cumulative_pos))
+        while sack_bitmap:
+            lowest_bit = sack_bitmap & -sack_bitmap
+            sack_bitmap ^= lowest_bit
+            pos = cumulative_pos + lowest_bit.bit_length() - 1
+            if pos >= queue_length:
+                break
+            acked_positions.append(pos)
+
+        for pos in acked_positions:
+            data_item = queue.get(pos)
+            if data_item.acked:
+                continue
+            acked_num += 1
+            sample = self.mark_acked(data_item, now)
+            if sample is not None:
+                rtt = sample
+        if acked_num == 0:
+            return
+        if rtt is not None:
+            self.rto_estimator.update(rtt)
+            self.metrics.on_rtt(rtt)
+        self.congestion.on_ack(acked_num, rtt)
+
+        # Like the forward acknowledgment of TCP, resend once the packets after the gap are acked
+        lost = False
+        highest_pos = acked_positions[-1] if acked_positions else -1
+        for pos in range(0, highest_pos - self.reorder_threshold + 1):
+            data_item = queue.get(pos)
+            if data_item.acked or data_item.fast_retransmitted:
+                continue
+            seq_num = (self.send_base + pos) % self.seq_space
+            data_item.fast_retransmitted = True
+            self.resend_queue.append((seq_num, data_item, True))
+            lost = True
+        if lost:
+            self.congestion.on_loss()
+        self.dequeue_acked()
+
+    def send_pending(self):
+        """
+        Send the retransmissions, then the new packets of the window, as fast as the pacer lets them
+        @return: seconds until the pacer lets the next pending packet go, None if nothing is pending
+        """
+        queue = self.packet_queue
+        while self.resend_queue:
+            delay = self.pacer.get_delay()
+            if delay > 0:
+                return delay
+            seq_num, data_item, fast = self.resend_queue.popleft()
+            if queue.items[seq_num % queue.size] is not data_item or data_item.acked:
+                # Acked while it waits
+                continue
+            self.udp_send(self.frame_pool.frame(seq_num))
+            self.pacer.on_send()
+            self.resend_count += 1
+            self.metrics.on_resend(seq_num, fast)
+            self.start_timer(seq_num, data_item)
+
+        while self.send_next != self.next_seq:
+            delay = self.pacer.get_delay()
+            if delay > 0:
+                return delay
+            seq_num = self.send_next
+            data_item = queue.items[seq_num % queue.size]
+            self.udp_send(self.frame_pool.frame(seq_num))
+            self.pacer.on_send()
+            self.metrics.on_send(seq_num, data_item.length)
+            data_item.sent = True
+            data_item.send_time = time.monotonic()
+            # Each packet has its own timer
+            self.start_timer(seq_num, data_item)
+            if self.fec_encoder is not None:
+                # The parity of a block is sent as soon as its last data packet
+                self.send_parity(self.fec_encoder.add(seq_num, self.frame_pool.payload(seq_num),
+                                                      self.redundancy.parity_num))
+            self.send_next = (seq_num + 1) % self.seq_space
+        return None
+
+
+if __name__ == '__main__':
+    # Show the events of the transfer
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    server_ip = '127.0.0.1'
+    server_port = 9790
+    server_address = (server_ip, server_port)
+    client = SRClient(server_address, resumable=True)
+    client_data = open(os.path.dirname(__file__) + '/data/' + 'player1.jpeg', 'rb')
+    client.rdt_send(client_data)
@@ -4,126 +4,243 @@ This module implements the server of SR Protocol.
 Author:
     Aaron Li
 """
+import logging
 import os
-import random
-import socket
 import struct
 import time
 
 import common_util as util
+import rdt_server
+import session
+import sink
 
-BUFFER_SIZE = 4096
-LOSS_RATE = 0.3
 QUEUE_MAX_SIZE = 32
 WINDOW_SIZE = 10
-
-class SRServer:
-    def __init__(self, server_address, window_size=WINDOW_SIZE, loss_rate=LOSS_RATE):
-        self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self.server_socket.bind(server_address)
-        self.loss_rate = loss_rate
-        self.expect_seq = 0
-        self.client_address = None
-        self.packet_queue = util.CircularQueue(QUEUE_MAX_SIZE)
+# With selective acks, one ack covers up to ACK_EVERY packets, or the packets received in ACK_DELAY seconds
+ACK_EVERY = 16
+ACK_DELAY = 0.005
+
+
+class SRSession(session.Session):
+    def __init__(self, client_address, connection_id, output_stream, window_size):
+        self.max_window_size = window_size
+        # The packets are written at their offsets as soon as they arrive, the queue only marks them received
+        self.direct = isinstance(output_stream, sink.OffsetSink)
+        super().__init__(client_address, connection_id, output_stream)
+        # The sequence number of the queue front, and the number of packets before it
+        self.rcv_base = 0
+        self.delivered_num = 0
+        # Selective acks are sent once negotiated. Bit i of the bitmap is set if packet rcv_base + i is buffered
+        self.sack_enabled = False
+        self.sack_bitmap = 0
+        # The packets received since the last ack, and the time the delayed ack is due
+        self.unacked_num = 0
+        self.ack_deadline = None
+
+    def set_header(self, header):
+        super().set_header(header)
+        if header.version == util.VERSION_1:
+            # The sequence numbers are the queue positions, the window can't be larger than half of them
+            self.window_size = min(self.max_window_size, QUEUE_MAX_SIZE // 2)
+            queue_size = QUEUE_MAX_SIZE
+        else:
+            self.window_size = self.max_window_size
+            queue_size = util.get_queue_size(self.window_size, header.seq_space)
+        # The reorder buffer, the packet of seq num is in slot seq num % size
+        self.packet_queue = util.SlidingWindow(queue_size)
+        # The receive time of each packet received out of order
+        self.receive_times = [0] * queue_size
+        # A buffered packet keeps its frame in the pool of the session, the frames are created on demand
+        self.frame_pool = None
+        if not self.direct:
+            self.frame_pool = util.FramePool(queue_size, self.mss, preallocate=False)
+
+
+class SRServer(rdt_server.RDTServer):
+    def __init__(self, server_address, window_size=WINDOW_SIZE, loss_rate=rdt_server.LOSS_RATE, channel_options=None,
+                 sack=True, ack_every=ACK_EVERY, ack_delay=ACK_DELAY, **kwargs):
+        """
+        @param kwargs: the options of rdt_server.RDTServer
+        """
+        super().__init__(server_address, loss_rate, channel_options, **kwargs)
         self.window_size = window_size
+        self.sack = sack
+        self.ack_every = ack_every
+        self.ack_delay = ack_delay
+        # Key: session with a delayed ack
+        self.delayed_ack_sessions = {}
+
+    def make_session(self, client_address, connection_id, output_stream):
+        return SRSession(client_address, connection_id, output_stream, self.window_size)
+
+    def forget_session(self, client_session):
+        self.delayed_ack_sessions.pop(client_session.key, None)
+
+    def acknowledge(self, client_session, seq_num, immediate=False):
+        """
+        Ack the packet at once, or delay the selective ack so it covers more packets
+        @param immediate: send the selective ack now, the sender should know about the gap at once
+        """
+        if not client_session.sack_enabled:
+            self.udp_send(self.make_pkt(client_session, seq_num), client_session.client_address)
+            self.metrics.on_ack_sent(seq_num)
+            return
+
+        client_session.unacked_num += 1
+        if immediate or client_session.unacked_num >= self.ack_every:
+            self.send_sack(client_session)
+        elif client_session.ack_deadline is None:
+            client_session.ack_deadline = time.monotonic() + self.ack_delay
+            self.delayed_ack_sessions[client_session.key] = client_session
+
+    def send_sack(self, client_session):
+        client_session.unacked_num = 0
+        client_session.ack_deadline = None
+        self.delayed_ack_sessions.pop(client_session.key, None)
+        self.udp_send(self.make_sack_pkt(client_session), client_session.client_address)
+        self.metrics.on_ack_sent((client_session.rcv_base - 1) % client_session.header.seq_space)
+
+    def send_delayed_acks(self):
+        """
+        Send the delayed acks which are due
+        @return: seconds until the next one is due, at most IDLE_CHECK_INTERVAL
+        """
+        now = time.monotonic()
+        wait_time = session.IDLE_CHECK_INTERVAL
+        for client_session in list(self.delayed_ack_sessions.values()):
+            if client_session.ack_deadline <= now:
+                self.send_sack(client_session)
+            else:
+                wait_time = min(wait_time, client_session.ack_deadline - now)
+        return wait_time
+
+    def get_wait_time(self):
+        # Wake up for the next delayed ack, and regularly to evict the idle sessions
+        return self.send_delayed_acks()
+
+    def handle_data(self, client_session, seq_num, checksum, data):
+        """
+        Buffer the packets of the window, the consecutive ones from the window base are delivered at once
+        """
+        packet_queue = client_session.packet_queue
+        header = client_session.header
+        if util.get_checksum(data, header.checksum_type) != checksum:
+            # The packet is corrupted, drop it without ack and wait for the retransmission
+            self.metrics.on_corrupt(seq_num)
+            return None
+        if client_session.fec_decoder is not None:
+            self.add_recovered(client_session, client_session.fec_decoder.add_data(seq_num, data))
+
+        # The position of the packet from the window base
+        seq_pos = (seq_num - client_session.rcv_base) % header.seq_space
+        if seq_pos < client_session.window_size:
+            # Items are in the next window, buffer them. These jump the queue
+            self.metrics.on_receive(seq_num, len(data))
+            if client_session.sack_bitmap >> seq_pos & 1:
+                # The item is buffered before, skip it. The ack may be lost, ack it again at once
+                self.metrics.on_duplicate(seq_num)
+                self.acknowledge(client_session, seq_num, True)
+                return None
+            if seq_pos > 0:
+                # It waits for the gap before it, the wait is the deliver latency
+                self.metrics.on_out_of_order(seq_num)
+                client_session.receive_times[seq_num % packet_queue.size] = time.monotonic()
+
+            if client_session.direct:
+                # Write the packet at its offset now, the received frame is reused at once
+                # The bitmap is the whole reorder buffer, the packets are never kept
+                client_session.output_stream.write_packet(client_session.delivered_num + seq_pos, data)
+                self.metrics.on_deliver(len(data))
+            else:
+                # The packet keeps the received frame in the pool, the replaced frame becomes the spare one
+                # the next packets are received into, so the payload is never copied
+                self.recv_frame = client_session.frame_pool.swap(seq_num, self.recv_frame)
+                packet_queue.put(seq_pos, data)
+            # A packet after a gap starts a new block of the bitmap
+            new_block = seq_pos > 0 and not client_session.sack_bitmap >> (seq_pos - 1) & 1
+            client_session.sack_bitmap |= 1 << seq_pos
+
+        elif (client_session.rcv_base - seq_num) % header.seq_space <= client_session.window_size:
+            # Items are in the previous window size, send ack back immediately
+            # Since they were handled in the previous if
+            self.metrics.on_receive(seq_num, len(data))
+            self.metrics.on_duplicate(seq_num)
+            self.acknowledge(client_session, seq_num, True)
+            return None
 
-    def udp_send(self, pkt):
-        # Simulate packet lose
-        if self.loss_rate == 0 or random.randint(0, int(1 / self.loss_rate)) != 1:
-            self.server_socket.sendto(pkt, self.client_address)
-            print('*** Server send ACK:', pkt[0])
         else:
-            pass
-            print('Server loss ACK:', pkt[0])
-
-        # Simulate the transfer time from server to client.
-        time.sleep(0.3)
-
-    def wait_data(self):
-        while True:
-            data, client_address = self.server_socket.recvfrom(BUFFER_SIZE)
-            self.client_address = client_address
-            seq_num, end_flag, checksum, data = self.analyse_pkt(data)
-
-            if end_flag:
-                # The transfer is complete
-                return [], end_flag
-
-            if (seq_num - self.packet_queue.front + QUEUE_MAX_SIZE) % QUEUE_MAX_SIZE < self.window_size:
-                # Items are in the next window, buffer them. These jump the queue
-                print('*** Server receive packet:', seq_num)
-                if not self.packet_queue.queue[seq_num] is None:
-                    # The item is buffered before, skip it
-                    ack_pkt = self.make_pkt(seq_num)
-                    self.udp_send(ack_pkt)
-                    continue
-
-                """
-                When adding new item to queue not using enqueue(), change the rear to the largest one
-                The items in the next window size is not full affirmatively since the rear is changed manually
-                In order to compare positions in a circular queue, must use the same base index
-                For example:
-                    there is a circular queue with max size 10
-                    if front = 0, 9 > 1 since (9−0+10) % 10 = 9 > (1−0+10) % 10 = 1
-                    if front = 8, 1 > 9 since (1−8+10) % 10 = 3 > (9−8+10) % 10 = 1
-                
-                """
-                self.packet_queue.queue[seq_num] = data
-                new_rear_pos = (seq_num + 1 - self.packet_queue.front + QUEUE_MAX_SIZE) % QUEUE_MAX_SIZE
-                rear_pos = (self.packet_queue.rear - self.packet_queue.front + QUEUE_MAX_SIZE) % QUEUE_MAX_SIZE
-                if new_rear_pos > rear_pos:
-                    self.packet_queue.rear = (seq_num + 1) % QUEUE_MAX_SIZE
-
-                ack_pkt = self.make_pkt(seq_num)
-                self.udp_send(ack_pkt)
-
-            elif (self.packet_queue.front - seq_num + QUEUE_MAX_SIZE) % QUEUE_MAX_SIZE <= self.window_size:
-                # Items are in the previous window size, send ack back immediately
-                # Since they were handled in the previous if
-                print('*** Server receive acked packet:', seq_num)
-                ack_pkt = self.make_pkt(seq_num)
-                self.udp_send(ack_pkt)
-
-            deliver_list = []
-            while not self.packet_queue.is_empty():
-                # Deliver the items in the queue when the front is not None
-                if self.packet_queue.peek() is None:
-                    break
-                data = self.packet_queue.dequeue()
-                deliver_list.append(data)
-
-            if len(deliver_list) == 0:
-                continue
-
-            return deliver_list, end_flag
-
-    def analyse_pkt(self, pkt):
-        seq_num = pkt[0]
-        end_flag = pkt[1]
-        checksum = pkt[2]
-        data = pkt[3:]
-        return seq_num, end_flag, checksum, data
-
-    def make_pkt(self, ackSeq):
-        return struct.pack('BB', ackSeq, 1)
-
-    def mdt_receive(self, output_stream):
-        while True:
-            data_list, end_flag = self.wait_data()
-            if end_flag:
-                break
-
-            for i in range(len(data_list)):
-                print('*** Server deliver data, length:', len(data_list[i]))
-                output_stream.write(data_list[i])
-
-        output_stream.close()
-        self.server_socket.close()
-
-
-server_ip = ''
-server_port = 9790
-server_address = (server_ip, server_port)
-server = SRServer(server_address)
-server_stored_data = open(os.path.dirname(__file__) + '/data/' + str(int(time.time())) + '.jpg', 'ab')
-server.mdt_receive(server_stored_data)
+            return None
+
+        # Deliver the consecutive packets from the window base at once, the trailing ones of the bitmap
+        bitmap = client_session.sack_bitmap
+        deliver_num = (~bitmap & (bitmap + 1)).bit_length() - 1
+        deliver_list = []
+        if not client_session.direct:
+            deliver_list = packet_queue.take(deliver_num)
+        if deliver_num > 1:
+            now = time.monotonic()
+            for i in range(1, deliver_num):
+                receive_time = client_session.receive_times[(client_session.rcv_base + i) % packet_queue.size]
+                self.metrics.on_deliver_latency(now - receive_time)
+        client_session.rcv_base = (client_session.rcv_base + deliver_num) % header.seq_space
+        client_session.delivered_num += deliver_num
+        client_session.sack_bitmap >>= deliver_num
+
+        # Ack after the delivery, so the cumulative ack covers it. Filling a gap is told at once
+        self.acknowledge(client_session, seq_num, new_block or deliver_num > 1)
+        return deliver_list
+
+    def add_recovered(self, client_session, recovered):
+        # The rebuilt packets are framed again, with their checksum
+        header = client_session.header
+        for seq_num, payload in recovered:
+            self.metrics.on_recover(seq_num)
+            pkt = header.make_pkt(seq_num, payload, util.get_checksum(payload, header.checksum_type))
+            self.recovered_pkts.append((client_session.client_address, pkt))
+
+    def start_transfer(self, client_session, resume):
+        super().start_transfer(client_session, resume)
+        # The packets are written at their indexes from the resume index
+        client_session.delivered_num = client_session.resume_index
+
+    def negotiate_session(self, client_session, options, version, checksum_type):
+        """
+        The receive window is told to the client in version 2
+        """
+        # A stage which decodes the stream takes the packets in order, they aren't written at their offsets
+        client_session.direct = isinstance(client_session.output_stream, sink.OffsetSink)
+        # The client sends no more than its own window, the reorder buffer isn't larger
+        client_session.max_window_size = min(util.get_option_int(options, util.OPTION_RECEIVE_WINDOW,
+                                                                 self.window_size), self.window_size)
+        client_session.set_header(util.PacketHeader(version, checksum_type, util.get_window_scale(self.window_size)))
+        # The selective ack needs the version 2 header
+        client_session.sack_enabled = self.sack and version >= util.VERSION_2 and util.OPTION_SACK in options
+
+    def make_response_options(self, client_session, options):
+        response_options = super().make_response_options(client_session, options)
+        header = client_session.header
+        if header.version >= util.VERSION_2:
+            response_options[util.OPTION_RECEIVE_WINDOW] = struct.pack('!I', client_session.window_size)
+            response_options[util.OPTION_WINDOW_SCALE] = bytes([header.window_scale])
+        if client_session.sack_enabled:
+            response_options[util.OPTION_SACK] = bytes([1])
+        return response_options
+
+    def make_pkt(self, client_session, ackSeq):
+        return client_session.header.make_ack(ackSeq, client_session.window_size)
+
+    def make_sack_pkt(self, client_session):
+        cumulative_ack = (client_session.rcv_base - 1) % client_session.header.seq_space
+        return client_session.header.make_sack(cumulative_ack, client_session.window_size, client_session.sack_bitmap)
+
+
+if __name__ == '__main__':
+    # Show the events of the transfer
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    server_ip = ''
+    server_port = 9790
+    server_address = (server_ip, server_port)
+    server = SRServer(server_address)
+    # The output is named by the transfer id, an interrupted transfer continues its file in the next run
+    server.serve(sink.resumable_sink_factory(os.path.dirname(__file__) + '/data/', '.jpg'), 1)
+    server.close()
@@ -0,0 +1,219 @@
+"""
+This module implements the striped transfer of one file over parallel SR sessions.
+
+The file is split into byte ranges, one for each stream. Every stream is sent by its own process with its
+own socket to its own port of the receiver, stream i uses the port of the server address + i, and every
+port is served by its own process, so the transfer scales with the cores on both sides.
+
+A stream starts with the range header: offset, length and the SHA-256 of the range. The receiver writes
+the range with os.pwrite at its offset and checks the digest, so the whole file is verified end to end.
+
+The clients and the servers are made by transfer.make_client and transfer.make_server, so the loss rate
+of the emulated channel is 0 unless the options ask for it, as in the other transfers.
+
+Usage:
+    striped.receive_file(('', 9800), 'output.jpg', streams=4)
+    striped.send_file(('127.0.0.1', 9800), 'data/player1.jpeg', streams=4)
+
+Author:
+    Aaron Li
+"""
+import concurrent.futures
+import hashlib
+import io
+import os
+import struct
+import time
+
+import transfer
+
+STREAMS = 4
+# offset, length, SHA-256 of the range
+RANGE_HEADER = struct.Struct('!QQ32s')
+# Bytes read from the file at once to compute the digest
+DIGEST_BLOCK_SIZE = 1024 * 1024
+
+
+def split_ranges(size, streams):
+    """
+    Split the file into contiguous byte ranges of nearly equal length
+    @return: list of (offset, length), one for each stream
+    """
+    ranges = []
+    offset = 0
+    for i in range(0, streams):
+        length = size // streams + (1 if i < size % streams else 0)
+        ranges.append((offset, length))
+        offset += length
+    return ranges
+
+
+def get_range_digest(fd, offset, length):
+    digest = hashlib.sha256()
+    end = offset + length
+    while offset < end:
+        data = os.pread(fd, min(DIGEST_BLOCK_SIZE, end - offset), offset)
+        if not data:
+            raise ValueError('The file is shorter than the range')
+        digest.update(data)
+        offset += len(data)
+    return digest.digest()
+
+
+class RangeReader(io.RawIOBase):
+    """
+    Read the range header, then the byte range of the file with os.pread
+    """
+    def __init__(self, path, offset, length):
+        self.fd = os.open(path, os.O_RDONLY)
+        self.offset = offset
+        self.end = offset + length
+        self.header = RANGE_HEADER.pack(offset, length, get_range_digest(self.fd, offset, length))
+        self.header_pos = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        if self.header_pos < len(self.header):
+            size = min(len(buffer), len(self.header) - self.header_pos)
+            buffer[:size] = self.header[self.header_pos:self.header_pos + size]
+            self.header_pos += size
+            return size
+
+        size = min(len(buffer), self.end - self.offset)
+        if size <= 0:
+            return 0
+        data = os.pread(self.fd, size, self.offset)
+        buffer[:len(data)] = data
+        self.offset += len(data)
+        return len(data)
+
+    def close(self):
+        if not self.closed:
+            os.close(self.fd)
+        super().close()
+
+
+class RangeWriter:
+    """
+    The output stream of one session: parse the range header, then write the range at its offset
+    """
+    def __init__(self, path):
+        self.fd = os.open(path, os.O_WRONLY)
+        self.header = bytearray()
+        self.offset = None
+        self.length = None
+        self.expected_digest = None
+        self.digest = hashlib.sha256()
+        self.written = 0
+        # None until the stream is closed, then whether the range is complete and its digest matches
+        self.verified = None
+
+    def write(self, data):
+        if self.offset is None:
+            # The header may be split among packets
+            need = RANGE_HEADER.size - len(self.header)
+            self.header += data[:need]
+            data = data[need:]
+            if len(self.header) < RANGE_HEADER.size:
+                return
+            self.offset, self.length, self.expected_digest = RANGE_HEADER.unpack(self.header)
+
+        view = memoryview(data)
+        while len(view) > 0:
+            size = os.pwrite(self.fd, view, self.offset + self.written)
+            self.digest.update(view[:size])
+            self.written += size
+            view = view[size:]
+
+    def close(self):
+        if self.verified is not None:
+            return
+        os.close(self.fd)
+        self.verified = (self.offset is not None and self.written == self.length
+                         and self.digest.digest() == self.expected_digest)
+
+
+def send_range(server_address, path, offset, length, client_options=None):
+    """
+    Send one range with its own SR client, run in a worker process
+    @return: the length of the range
+    """
+    client = transfer.make_client(transfer.PROTOCOL_SR, server_address, client_options)
+    client.rdt_send(io.BufferedReader(RangeReader(path, offset, length)))
+    return length
+
+
+def receive_range(server_address, path, server_options=None):
+    """
+    Receive one range with its own SR server, run in a worker process
+    @return: offset, length and whether the range is verified
+    """
+    writers = []
+
+    def sink_factory(client_address, connection_id):
+        # One transfer per port, the other clients are refused
+        if writers:
+            return None
+        writers.append(RangeWriter(path))
+        return writers[0]
+
+    server = transfer.make_server(transfer.PROTOCOL_SR, server_address, server_options)
+    server.serve(sink_factory, 1)
+    server.close()
+    writer = writers[0]
+    return writer.offset, writer.length, writer.verified
+
+
+def send_file(server_address, path, streams=STREAMS, client_options=None):
+    """
+    Send the file over parallel streams, stream i goes to the port of server_address + i
+    @param client_options: keyword arguments of every SRClient, e.g. {'window_size': 256, 'loss_rate': 0.1}
+    @return: the file size and the seconds of the transfer
+    """
+    host, port = server_address
+    ranges = split_ranges(os.path.getsize(path), streams)
+    start_time = time.monotonic()
+    with concurrent.futures.ProcessPoolExecutor(max_workers=streams) as executor:
+        futures = [executor.submit(send_range, (host, port + i), path, offset, length, client_options)
+                   for i, (offset, length) in enumerate(ranges)]
+        size = sum(future.result() for future in futures)
+    return size, time.monotonic() - start_time
+
+
+def receive_file(server_address, path, streams=STREAMS, server_options=None):
+    """
+    Receive a striped file on the ports from server_address, one stream on each port
+    @param server_options: keyword arguments of every SRServer, e.g. {'window_size': 256, 'loss_rate': 0.1}
+    @return: the file size
+    """
+    host, port = server_address
+    # The ranges are written in place, the file only has to exist
+    open(path, 'wb').close()
+    with concurrent.futures.ProcessPoolExecutor(max_workers=streams) as executor:
+        futures = [executor.submit(receive_range, (host, port + i), path, server_options) for i in range(streams)]
+        ranges = [future.result() for future in futures]
+
+    # The ranges must be verified and cover the file without a gap
+    for offset, length, verified in ranges:
+        if not verified:
+            raise ValueError('The range at offset %s is corrupted or incomplete' % offset)
+    size = 0
+    for offset, length, verified in sorted(ranges):
+        if offset != size:
+            raise ValueError('The range at offset %d is lost' % size)
+        size += length
+    os.truncate(path, size)
+    return size
+
+
+if __name__ == '__main__':
+    # Run the receiver first, then the sender in another terminal: python striped.py send
+    import sys
+    if len(sys.argv) > 1 and sys.argv[1] == 'send':
+        size, elapsed = send_file(('127.0.0.1', 9800), os.path.dirname(__file__) + '/data/' + 'player1.jpeg')
+        print('*** Client send striped file, bytes and seconds:', size, elapsed)
+    else:
+        size = receive_file(('', 9800), os.path.dirname(__file__) + '/data/' + str(int(time.time())) + '.jpg')
+        print('*** Server receive striped file, bytes:', size)
@@ -0,0 +1,32 @@
+"""
+The checksum algorithms of the packet header.
+
+Author:
+    Aaron Li
+"""
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import common_util as util
+
+
+class LegacyChecksumTest(unittest.TestCase):
+    """
+    The clients without negotiation summed the characters of str(data), the values are theirs
+    """
+    def test_baseline_values(self):
+        self.assertEqual(util.legacy_checksum(b''), 176)
+        self.assertEqual(util.legacy_checksum(bytes(range(50))), 151)
+        self.assertEqual(util.legacy_checksum(b'\xff\x00abc'), sum(b"b'\\xff\\x00abc'") & 0xFF)
+
+    def test_buffer_types(self):
+        data = os.urandom(2048)
+        self.assertEqual(util.legacy_checksum(memoryview(data)), util.legacy_checksum(data))
+        self.assertEqual(util.legacy_checksum(bytearray(data)), util.legacy_checksum(data))
+
+
+if __name__ == '__main__':
+    unittest.main()
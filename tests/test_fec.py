@@ -0,0 +1,68 @@
+"""
+Rebuilding the lost packets of a block from its parity.
+
+Author:
+    Aaron Li
+"""
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import fec
+import pmtu
+
+PACKET_SIZE = 64
+BLOCK_SIZE = 4
+
+
+def encode_block(payloads, parity_num=1):
+    encoder = fec.FECEncoder(fec.SCHEME_XOR, block_size=len(payloads), packet_size=PACKET_SIZE)
+    parity_pkts = []
+    for seq_num, payload in enumerate(payloads):
+        parity_pkts += encoder.add(seq_num, payload, parity_num)
+    return parity_pkts
+
+
+class ParityTest(unittest.TestCase):
+    def setUp(self):
+        self.payloads = [bytes([i]) * (PACKET_SIZE - i) for i in range(BLOCK_SIZE)]
+        self.parity_pkt = encode_block(self.payloads)[0]
+
+    def receive(self, parity_pkt, lost=2):
+        # All the data packets but one are received, then the parity
+        decoder = fec.FECDecoder(fec.SCHEME_XOR)
+        for seq_num, payload in enumerate(self.payloads):
+            if seq_num != lost:
+                decoder.add_data(seq_num, payload)
+        analysed = fec.analyse_parity_pkt(parity_pkt)
+        if analysed is None:
+            return None
+        first_seq, count, parity_index, parity_num, scheme, parity = analysed
+        return decoder.add_parity(first_seq, count, parity_index, parity_num, parity)[0]
+
+    def test_rebuild(self):
+        self.assertEqual(self.receive(self.parity_pkt), [(2, self.payloads[2])])
+
+    def test_corrupted_symbol(self):
+        pkt = bytearray(self.parity_pkt)
+        pkt[fec.PARITY_HEADER.size + 10] ^= 0x40
+        self.assertIsNone(self.receive(pkt))
+
+    def test_corrupted_header(self):
+        pkt = bytearray(self.parity_pkt)
+        # The first seq num points the parity at another block
+        pkt[5] ^= 1
+        self.assertIsNone(self.receive(pkt))
+
+    def test_fits_path_mtu(self):
+        # The packets are sized by the probed path MTU, the parity packets are the largest ones
+        mss = pmtu.get_mss(pmtu.ETHERNET_MTU, fec.PARITY_OVERHEAD)
+        encoder = fec.FECEncoder(fec.SCHEME_XOR, block_size=1, packet_size=mss)
+        parity_pkt = encoder.add(0, bytes(mss), 1)[0]
+        self.assertEqual(len(parity_pkt), pmtu.get_datagram_size(pmtu.ETHERNET_MTU))
+
+
+if __name__ == '__main__':
+    unittest.main()
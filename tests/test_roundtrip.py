@@ -0,0 +1,372 @@
+"""
+Loopback round trips of the threaded GBN and SR clients and servers, over the emulated channel when
+a test asks for loss.
+
+Author:
+    Aaron Li
+"""
+import contextlib
+import io
+import os
+import random
+import socket
+import struct
+import sys
+import tempfile
+import threading
+import time
+import unittest
+import zlib
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import common_util as util
+import compression
+import dedup
+import fec
+import gbn_client
+import gbn_server
+import metrics
+import rdt_client
+import sink
+import sr_client
+import sr_server
+
+WINDOW_SIZE = 10
+# A transfer is given up after this long, e.g. all the end packets are lost
+JOIN_TIMEOUT = 60
+LOSS_RATE = 0.1
+# The seconds the stop-and-wait sender of a version 1 client waits for each ack
+LEGACY_ACK_TIMEOUT = 0.2
+# The first run of a resumed transfer is interrupted after this number of waits for the acks
+INTERRUPT_ACKS = 20
+
+
+class RecordingSink(io.BytesIO):
+    def close(self):
+        self.received = self.getvalue()
+
+
+def make_payload(size, seed=1):
+    return random.Random(seed).randbytes(size)
+
+
+def send_legacy(server_address, input_stream):
+    """
+    Send the stream as the first versions did: version 1 packets without negotiation, one at a time
+    """
+    client_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    client_socket.settimeout(LEGACY_ACK_TIMEOUT)
+    seq_num = 0
+    for data in iter(lambda: input_stream.read(util.PACKET_SIZE), b''):
+        pkt = struct.pack('BBB', seq_num, 0, util.legacy_checksum(data)) + data
+        while True:
+            client_socket.sendto(pkt, server_address)
+            try:
+                ack = client_socket.recv(rdt_client.BUFFER_SIZE)
+            except socket.timeout:
+                continue
+            if ack[0] == seq_num:
+                break
+        seq_num = (seq_num + 1) % util.SEQ_SPACE_V1
+    for i in range(0, rdt_client.END_REPEAT):
+        client_socket.sendto(struct.pack('BBB', 0, util.FLAG_END, 0), server_address)
+    client_socket.close()
+
+
+def run_transfer(protocol, payload, loss_rate=0, channel_options=None, client_options=None, server_options=None,
+                 sender=None):
+    """
+    Send the payload from a client to a server thread over the loopback
+    @param sender: called as sender(server_address, input_stream) instead of the client of the protocol
+    @return: the received data and the seconds of the transfer
+    @raise ValueError: the server fails the transfer
+    """
+    server_options = dict(server_options or {})
+    if protocol == 'sr':
+        server_options.setdefault('window_size', WINDOW_SIZE)
+        server = sr_server.SRServer(('127.0.0.1', 0), loss_rate=loss_rate, channel_options=channel_options,
+                                    **server_options)
+        client_class = sr_client.SRClient
+    else:
+        server = gbn_server.GBNServer(('127.0.0.1', 0), loss_rate=loss_rate, channel_options=channel_options,
+                                      **server_options)
+        client_class = gbn_client.GBNClient
+    output_stream = RecordingSink()
+    output_stream.received = None
+    errors = []
+
+    def receive():
+        try:
+            server.mdt_receive(output_stream)
+        except ValueError as e:
+            errors.append(e)
+
+    server_thread = threading.Thread(target=receive, daemon=True)
+    server_thread.start()
+    server_address = server.server_socket.getsockname()
+    start_time = time.monotonic()
+    if sender is not None:
+        sender(server_address, io.BytesIO(payload))
+    else:
+        client_options = dict(client_options or {})
+        client_options.setdefault('window_size', WINDOW_SIZE)
+        client = client_class(server_address, loss_rate=loss_rate, channel_options=channel_options, **client_options)
+        client.rdt_send(io.BytesIO(payload))
+    server_thread.join(JOIN_TIMEOUT)
+    if server_thread.is_alive():
+        server.close()
+        raise AssertionError('The server did not finish the transfer')
+    if errors:
+        raise errors[0]
+    return output_stream.received, time.monotonic() - start_time
+
+
+class FullWindowTest(unittest.TestCase):
+    """
+    The end of a payload of exactly one window of full packets is found only after the last ack
+    """
+    def check(self, protocol):
+        payload = make_payload(WINDOW_SIZE * util.PACKET_SIZE)
+        received, elapsed = run_transfer(protocol, payload)
+        self.assertEqual(received, payload)
+        # The client used to wait its whole select timeout before the end packets
+        self.assertLess(elapsed, 2)
+
+    def test_gbn(self):
+        self.check('gbn')
+
+    def test_sr(self):
+        self.check('sr')
+
+
+class LossTest(unittest.TestCase):
+    """
+    The lost packets are resent, the seed fixes which packets the emulated channel drops
+    """
+    def check(self, protocol):
+        payload = make_payload(64 * 1024)
+        received, elapsed = run_transfer(protocol, payload, LOSS_RATE, {'seed': 7})
+        self.assertEqual(received, payload)
+
+    def test_gbn(self):
+        self.check('gbn')
+
+    def test_sr(self):
+        self.check('sr')
+
+
+class FECTest(unittest.TestCase):
+    """
+    The lost packets are rebuilt from the parity before their retransmission
+    """
+    def check(self, protocol, client_options=None, server_options=None):
+        payload = make_payload(64 * 1024)
+        server_metrics = metrics.Metrics('server')
+        received, elapsed = run_transfer(protocol, payload, LOSS_RATE, {'seed': 3},
+                                         client_options=dict({'fec_scheme': fec.SCHEME_XOR}, **(client_options or {})),
+                                         server_options=dict(server_options or {}, metrics=server_metrics))
+        self.assertEqual(received, payload)
+        self.assertGreater(server_metrics.packets_recovered.value, 0)
+
+    def test_gbn(self):
+        self.check('gbn')
+
+    def test_sr(self):
+        self.check('sr')
+
+    def test_largest_mss(self):
+        # The parity packets are larger than the data packets, they must still fit the receive frame
+        for protocol in ['gbn', 'sr']:
+            with self.subTest(protocol=protocol):
+                self.check(protocol, {'mss': 1400}, {'max_mss': 1400})
+
+    @unittest.skipIf(fec.numpy is None, 'Reed-Solomon parity needs NumPy')
+    def test_reed_solomon(self):
+        for protocol in ['gbn', 'sr']:
+            with self.subTest(protocol=protocol):
+                self.check(protocol, {'fec_scheme': fec.SCHEME_RS, 'fec_parity': 2})
+
+
+class DedupTest(unittest.TestCase):
+    def check(self, protocol, stored_all=False):
+        payload = make_payload(256 * 1024)
+        server_options = {'chunk_store': dedup.ChunkStore()}
+        client_class = sr_client.SRClient if protocol == 'sr' else gbn_client.GBNClient
+        query = contextlib.nullcontext()
+        if stored_all:
+            # The client is told the server has every chunk, so it sends only the references
+            query = mock.patch.object(client_class, 'query_chunks', lambda self, digests: (1 << len(digests)) - 1)
+        with query:
+            return run_transfer(protocol, payload, client_options={'deduplicate': True},
+                                server_options=server_options)[0], payload
+
+    def test_gbn(self):
+        received, payload = self.check('gbn')
+        self.assertEqual(received, payload)
+
+    def test_sr(self):
+        received, payload = self.check('sr')
+        self.assertEqual(received, payload)
+
+    def test_missing_chunk_gbn(self):
+        with self.assertRaisesRegex(ValueError, 'missing chunk'):
+            self.check('gbn', True)
+
+    def test_missing_chunk_sr(self):
+        with self.assertRaisesRegex(ValueError, 'missing chunk'):
+            self.check('sr', True)
+
+
+class TruncatingCompressor:
+    # The end of the stream is never written, the stream stops at a sync point
+    def __init__(self, codec):
+        self.compressor = zlib.compressobj()
+
+    def compress(self, data):
+        return self.compressor.compress(data)
+
+    def flush(self):
+        return self.compressor.flush(zlib.Z_SYNC_FLUSH)
+
+
+class CorruptingCompressor(TruncatingCompressor):
+    # The first byte of the stream is flipped, it breaks the zlib header
+    def __init__(self, codec):
+        super().__init__(codec)
+        self.corrupted = False
+
+    def compress(self, data):
+        output = bytearray(self.compressor.compress(data))
+        if output and not self.corrupted:
+            output[0] ^= 0xFF
+            self.corrupted = True
+        return bytes(output)
+
+    def flush(self):
+        return self.compressor.flush()
+
+
+class CompressionTest(unittest.TestCase):
+    def check(self, protocol, compressor_class=None):
+        payload = b'The compressible payload of a text file.\n' * 8192
+        client_options = {'codec': compression.CODEC_ZLIB}
+        if compressor_class is None:
+            return run_transfer(protocol, payload, client_options=client_options)[0], payload
+        with mock.patch.object(compression, 'make_compressor', compressor_class):
+            return run_transfer(protocol, payload, client_options=client_options)[0], payload
+
+    def test_gbn(self):
+        received, payload = self.check('gbn')
+        self.assertEqual(received, payload)
+
+    def test_sr(self):
+        received, payload = self.check('sr')
+        self.assertEqual(received, payload)
+
+    def test_truncated(self):
+        for protocol in ['gbn', 'sr']:
+            with self.subTest(protocol=protocol), self.assertRaisesRegex(ValueError, 'truncated'):
+                self.check(protocol, TruncatingCompressor)
+
+    def test_corrupted(self):
+        for protocol in ['gbn', 'sr']:
+            with self.subTest(protocol=protocol), self.assertRaisesRegex(ValueError, 'corrupted'):
+                self.check(protocol, CorruptingCompressor)
+
+
+class TransferInterrupted(Exception):
+    pass
+
+
+class ResumeTest(unittest.TestCase):
+    """
+    An interrupted transfer of a file continues from the progress index of its output in the next run
+    """
+    def check(self, protocol):
+        payload = make_payload(200 * util.PACKET_SIZE + 100)
+        packet_num = (len(payload) + util.PACKET_SIZE - 1) // util.PACKET_SIZE
+        with tempfile.TemporaryDirectory() as directory:
+            input_path = os.path.join(directory, 'input.bin')
+            with open(input_path, 'wb') as input_file:
+                input_file.write(payload)
+            output_directory = os.path.join(directory, 'output')
+            os.mkdir(output_directory)
+            if protocol == 'sr':
+                server = sr_server.SRServer(('127.0.0.1', 0), window_size=WINDOW_SIZE, loss_rate=0)
+                client_class = sr_client.SRClient
+            else:
+                server = gbn_server.GBNServer(('127.0.0.1', 0), loss_rate=0)
+                client_class = gbn_client.GBNClient
+
+            def receive():
+                server.serve(sink.resumable_sink_factory(output_directory, '.bin'), 1)
+                server.close()
+
+            server_thread = threading.Thread(target=receive, daemon=True)
+            server_thread.start()
+            server_address = server.server_socket.getsockname()
+
+            # The first run stops in the middle of the transfer, the server abandons it once the next run starts
+            first_client = client_class(server_address, window_size=WINDOW_SIZE, loss_rate=0, resumable=True)
+            receive_acks = first_client.receive_acks
+            waits = []
+
+            def interrupt_acks():
+                receive_acks()
+                waits.append(None)
+                if len(waits) >= INTERRUPT_ACKS:
+                    raise TransferInterrupted()
+
+            first_client.receive_acks = interrupt_acks
+            with open(input_path, 'rb') as input_file, self.assertRaises(TransferInterrupted):
+                first_client.rdt_send(input_file)
+            first_client.channel.close()
+            first_client.client_socket.close()
+
+            client = client_class(server_address, window_size=WINDOW_SIZE, loss_rate=0, resumable=True)
+            with open(input_path, 'rb') as input_file:
+                client.rdt_send(input_file)
+            server_thread.join(JOIN_TIMEOUT)
+            self.assertFalse(server_thread.is_alive())
+
+            # Only the packets after the progress of the first run are sent again
+            self.assertGreater(client.resume_index, 0)
+            self.assertEqual(client.resume_index + client.packet_num, packet_num)
+            output_names = os.listdir(output_directory)
+            # The progress index is removed once the transfer is complete
+            self.assertEqual(output_names, ['%08x.bin' % client.connection_id])
+            with open(os.path.join(output_directory, output_names[0]), 'rb') as output_file:
+                self.assertEqual(output_file.read(), payload)
+
+    def test_gbn(self):
+        self.check('gbn')
+
+    def test_sr(self):
+        self.check('sr')
+
+
+class Version1Test(unittest.TestCase):
+    """
+    The clients of the first versions don't negotiate, the servers still receive from them
+    """
+    def test_legacy_gbn(self):
+        payload = make_payload(4 * util.PACKET_SIZE + 100)
+        self.assertEqual(run_transfer('gbn', payload, sender=send_legacy)[0], payload)
+
+    def test_legacy_sr(self):
+        payload = make_payload(4 * util.PACKET_SIZE + 100)
+        self.assertEqual(run_transfer('sr', payload, sender=send_legacy)[0], payload)
+
+    def test_negotiated_version_1(self):
+        # The sequence numbers of version 1 wrap around
+        payload = make_payload(3 * util.SEQ_SPACE_V1 * util.PACKET_SIZE)
+        for protocol in ['gbn', 'sr']:
+            with self.subTest(protocol=protocol):
+                received, elapsed = run_transfer(protocol, payload, client_options={'version': util.VERSION_1})
+                self.assertEqual(received, payload)
+
+
+if __name__ == '__main__':
+    unittest.main()
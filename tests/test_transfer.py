@@ -0,0 +1,158 @@
+"""
+Batch transfers of transfer.py and striped transfers of striped.py over the loopback.
+
+Author:
+    Aaron Li
+"""
+import contextlib
+import io
+import os
+import random
+import socket
+import sys
+import tempfile
+import threading
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import striped
+import transfer
+
+# A transfer is given up after this long
+JOIN_TIMEOUT = 60
+# The receiver reads the batch in pieces of this size, so the headers are split among them
+WRITE_SIZE = 7
+
+
+def make_payload(size, seed=1):
+    return random.Random(seed).randbytes(size)
+
+
+def find_free_ports(count=1):
+    """
+    @return: the first of count consecutive UDP ports of the loopback which are free
+    """
+    while True:
+        probe = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        probe.bind(('127.0.0.1', 0))
+        base_port = probe.getsockname()[1]
+        sockets = [probe]
+        try:
+            for i in range(1, count):
+                sockets.append(socket.socket(socket.AF_INET, socket.SOCK_DGRAM))
+                sockets[-1].bind(('127.0.0.1', base_port + i))
+            return base_port
+        except OSError:
+            continue
+        finally:
+            for bound in sockets:
+                bound.close()
+
+
+def make_files(directory):
+    # Nested directories, an empty file and a file of several packets
+    files = {
+        'a.bin': make_payload(100, 1),
+        'empty': b'',
+        'sub/deep/b.bin': make_payload(50000, 2),
+    }
+    for name, data in files.items():
+        path = os.path.join(directory, *name.split('/'))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as output_file:
+            output_file.write(data)
+    return files
+
+
+def read_files(directory):
+    return {name: open(path, 'rb').read() for name, path in transfer.list_files(directory)}
+
+
+def run_thread(target, *args):
+    # Keep the result or the error of the target
+    result = {}
+
+    def run():
+        try:
+            result['value'] = target(*args)
+        except Exception as e:
+            result['error'] = e
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    return thread, result
+
+
+class BatchTest(unittest.TestCase):
+    def test_reader_writer(self):
+        with tempfile.TemporaryDirectory() as source, tempfile.TemporaryDirectory() as destination:
+            files = make_files(source)
+            reader = io.BufferedReader(transfer.BatchReader(transfer.list_files(source)))
+            writer = transfer.BatchWriter(destination)
+            for data in iter(lambda: reader.read(WRITE_SIZE), b''):
+                writer.write(data)
+            writer.close()
+            self.assertTrue(writer.verified)
+            self.assertEqual(sorted(writer.files), sorted(files))
+            self.assertEqual(read_files(destination), files)
+
+    def test_incomplete(self):
+        with tempfile.TemporaryDirectory() as source, tempfile.TemporaryDirectory() as destination:
+            make_files(source)
+            batch = io.BufferedReader(transfer.BatchReader(transfer.list_files(source))).read()
+            writer = transfer.BatchWriter(destination)
+            writer.write(batch[:-1])
+            writer.close()
+            self.assertFalse(writer.verified)
+
+    def test_name_leaves_directory(self):
+        with tempfile.TemporaryDirectory() as destination:
+            name = b'../outside'
+            writer = transfer.BatchWriter(destination)
+            writer.write(transfer.BATCH_MAGIC + transfer.FILE_HEADER.pack(len(name), 3) + name + b'abc')
+            writer.close()
+            self.assertEqual(writer.rejected, ['../outside'])
+            self.assertEqual(os.listdir(destination), [])
+
+    def test_main(self):
+        # The command line of both sides, the statistics are printed to stdout
+        for protocol in [transfer.PROTOCOL_GBN, transfer.PROTOCOL_SR]:
+            with self.subTest(protocol=protocol), tempfile.TemporaryDirectory() as source, \
+                    tempfile.TemporaryDirectory() as destination:
+                files = make_files(source)
+                port = find_free_ports()
+                with contextlib.redirect_stdout(io.StringIO()) as output:
+                    receiver, result = run_thread(transfer.main, ['receive', str(port), destination, '--batch',
+                                                                  '--protocol', protocol])
+                    status = transfer.main(['send', '127.0.0.1:%d' % port, source, '--batch', '--protocol', protocol])
+                    receiver.join(JOIN_TIMEOUT)
+                self.assertFalse(receiver.is_alive())
+                self.assertNotIn('error', result)
+                self.assertEqual((status, result['value']), (0, 0))
+                self.assertEqual(read_files(destination), files)
+                self.assertIn('%d files' % len(files), output.getvalue())
+
+
+class StripedTest(unittest.TestCase):
+    def test_round_trip(self):
+        streams = 3
+        payload = make_payload(1024 * 1024 + 5)
+        with tempfile.TemporaryDirectory() as directory:
+            input_path = os.path.join(directory, 'input.bin')
+            output_path = os.path.join(directory, 'output.bin')
+            with open(input_path, 'wb') as input_file:
+                input_file.write(payload)
+            port = find_free_ports(streams)
+            receiver, result = run_thread(striped.receive_file, ('127.0.0.1', port), output_path, streams)
+            size, elapsed = striped.send_file(('127.0.0.1', port), input_path, streams)
+            receiver.join(JOIN_TIMEOUT)
+            self.assertFalse(receiver.is_alive())
+            self.assertNotIn('error', result)
+            self.assertEqual((size, result['value']), (len(payload), len(payload)))
+            with open(output_path, 'rb') as output_file:
+                self.assertEqual(output_file.read(), payload)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,431 @@
+"""
+This module implements the library API and the command line of the transfers.
+
+send_file and receive_file move one file over one session, send_directory and receive_directory move all
+the files of a directory over one session too: the files are sent as one stream of records after the batch
+header, each record is the file header, then the name and the content of the file. The connection is
+negotiated and closed once for the batch, and the window stays open from one file to the next, so a small
+file costs its header and nothing else.
+    batch header: BATCH_MAGIC
+    file header: length of the name, size of the file
+The receiver is told whether to expect a batch, the batch header makes it fail when the sender disagrees:
+a batch received as a file, or a file received as a batch.
+
+The protocol modules and the sinks are imported when a transfer is started, importing this module opens no
+socket and doesn't load NumPy.
+Every function returns the statistics of the transfer, a dict of TRANSFER_FIELDS.
+The loss rate of the emulated channel is 0 unless the options ask for it.
+
+Usage:
+    transfer.receive_file(('', 9790), 'output.jpg')
+    transfer.send_file(('127.0.0.1', 9790), 'data/player1.jpeg', client_options={'window_size': 256})
+    python -m transfer receive 9790 output_directory --batch --protocol gbn
+    python -m transfer send 127.0.0.1:9790 input_directory --batch --protocol gbn --window 64 --pacing token_bucket
+
+Author:
+    Aaron Li
+"""
+import argparse
+import importlib
+import io
+import json
+import os
+import struct
+import sys
+import time
+
+PROTOCOL_SR = 'sr'
+PROTOCOL_GBN = 'gbn'
+# The client class and the server class of each protocol, imported on demand
+PROTOCOLS = {
+    PROTOCOL_SR: ('sr_client', 'SRClient', 'sr_server', 'SRServer'),
+    PROTOCOL_GBN: ('gbn_client', 'GBNClient', 'gbn_server', 'GBNServer'),
+}
+# The start of a batch stream, the version of the batch format is its last byte
+BATCH_MAGIC = b'\x00RDT-BATCH\x01'
+# length of the name, size of the file
+FILE_HEADER = struct.Struct('!HQ')
+TRANSFER_FIELDS = ['protocol', 'path', 'files', 'bytes', 'seconds', 'goodput', 'packets', 'resent']
+# The names of fec.SCHEME_NONE, fec.SCHEME_XOR and fec.SCHEME_RS on the command line
+FEC_SCHEMES = ['none', 'xor', 'rs']
+
+
+def get_protocol(protocol):
+    """
+    @return: the client class and the server class of the protocol
+    """
+    if protocol not in PROTOCOLS:
+        raise ValueError('Unknown protocol: %s' % protocol)
+    client_module, client_class, server_module, server_class = PROTOCOLS[protocol]
+    return (getattr(importlib.import_module(client_module), client_class),
+            getattr(importlib.import_module(server_module), server_class))
+
+
+def make_client(protocol, server_address, client_options=None):
+    options = dict(client_options or {})
+    options.setdefault('loss_rate', 0)
+    return get_protocol(protocol)[0](server_address, **options)
+
+
+def make_server(protocol, server_address, server_options=None):
+    options = dict(server_options or {})
+    options.setdefault('loss_rate', 0)
+    return get_protocol(protocol)[1](server_address, **options)
+
+
+def make_stats(protocol, path, files, size, seconds, client=None):
+    return {
+        'protocol': protocol,
+        'path': path,
+        'files': files,
+        'bytes': size,
+        'seconds': seconds,
+        'goodput': size / seconds if seconds > 0 else 0,
+        # Only the sender counts the packets
+        'packets': client.packet_num if client is not None else None,
+        'resent': client.resend_count if client is not None else None,
+    }
+
+
+def list_files(directory):
+    """
+    @return: list of (name, path) of the regular files under the directory, the name is relative with '/'
+    """
+    files = []
+    for root, dirs, names in os.walk(directory):
+        dirs.sort()
+        for name in sorted(names):
+            path = os.path.join(root, name)
+            if os.path.isfile(path):
+                files.append((os.path.relpath(path, directory).replace(os.sep, '/'), path))
+    return files
+
+
+def get_output_path(directory, name):
+    # The name comes from the network, it must stay in the directory
+    parts = name.split('/')
+    if name.startswith('/') or any(part in ('', '.', '..') for part in parts):
+        return None
+    return os.path.join(directory, *parts)
+
+
+class BatchReader(io.RawIOBase):
+    """
+    Read the files one after another, each of them after its file header and its name
+    """
+    def __init__(self, files):
+        self.files = list(files)
+        self.file_index = 0
+        self.input_file = None
+        # The batch header is read first
+        self.header = BATCH_MAGIC
+        self.header_pos = 0
+        self.remaining = 0
+        self.size = 0
+
+    def readable(self):
+        return True
+
+    def open_next(self):
+        # Return False once all the files are read
+        if self.file_index >= len(self.files):
+            return False
+        name, path = self.files[self.file_index]
+        self.file_index += 1
+        self.input_file = open(path, 'rb')
+        self.remaining = os.fstat(self.input_file.fileno()).st_size
+        encoded_name = name.encode('utf-8', 'surrogateescape')
+        self.header = FILE_HEADER.pack(len(encoded_name), self.remaining) + encoded_name
+        self.header_pos = 0
+        self.size += self.remaining
+        return True
+
+    def readinto(self, buffer):
+        while self.header_pos >= len(self.header) and self.remaining == 0:
+            if self.input_file is not None:
+                self.input_file.close()
+                self.input_file = None
+            if not self.open_next():
+                return 0
+
+        if self.header_pos < len(self.header):
+            size = min(len(buffer), len(self.header) - self.header_pos)
+            buffer[:size] = self.header[self.header_pos:self.header_pos + size]
+            self.header_pos += size
+            return size
+
+        view = memoryview(buffer)[:min(len(buffer), self.remaining)]
+        size = self.input_file.readinto(view)
+        if size == 0:
+            raise ValueError('The file is shorter than its header: %s' % self.files[self.file_index - 1][1])
+        self.remaining -= size
+        return size
+
+    def close(self):
+        if self.input_file is not None:
+            self.input_file.close()
+            self.input_file = None
+        super().close()
+
+
+class BatchWriter:
+    """
+    The output stream of a batch: parse each file header, then write the file into the directory
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        # The batch header, the stream isn't a batch if it doesn't start with BATCH_MAGIC
+        self.magic = bytearray()
+        self.is_batch = None
+        self.header = bytearray()
+        self.name_length = None
+        self.remaining = 0
+        self.output_file = None
+        self.files = []
+        self.size = 0
+        # The names which would leave the directory, their content is skipped
+        self.rejected = []
+        # None until the stream is closed, then whether the last file is complete
+        self.verified = None
+
+    def write(self, data):
+        view = memoryview(data)
+        if self.is_batch is None:
+            need = len(BATCH_MAGIC) - len(self.magic)
+            self.magic += view[:need]
+            view = view[need:]
+            if len(self.magic) == len(BATCH_MAGIC):
+                self.is_batch = self.magic == BATCH_MAGIC
+        if not self.is_batch:
+            # Nothing is written into the directory
+            return
+        while len(view) > 0:
+            if self.name_length is None or len(self.header) < FILE_HEADER.size + self.name_length:
+                view = self.read_header(view)
+                continue
+            size = min(len(view), self.remaining)
+            if self.output_file is not None:
+                self.output_file.write(view[:size])
+            self.remaining -= size
+            view = view[size:]
+            if self.remaining == 0:
+                self.finish_file()
+
+    def read_header(self, view):
+        # The header and the name may be split among packets
+        need = FILE_HEADER.size + (self.name_length or 0) - len(self.header)
+        self.header += view[:need]
+        view = view[need:]
+        if self.name_length is None and len(self.header) == FILE_HEADER.size:
+            self.name_length, self.remaining = FILE_HEADER.unpack(self.header)
+        if self.name_length is not None and len(self.header) == FILE_HEADER.size + self.name_length:
+            self.open_file(bytes(self.header[FILE_HEADER.size:]).decode('utf-8', 'surrogateescape'))
+        return view
+
+    def open_file(self, name):
+        path = get_output_path(self.directory, name)
+        if path is None:
+            self.rejected.append(name)
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            self.output_file = open(path, 'wb')
+            self.files.append(name)
+            self.size += self.remaining
+        if self.remaining == 0:
+            self.finish_file()
+
+    def finish_file(self):
+        if self.output_file is not None:
+            self.output_file.close()
+            self.output_file = None
+        self.header = bytearray()
+        self.name_length = None
+
+    def close(self):
+        if self.verified is not None:
+            return
+        self.verified = self.is_batch is True and self.name_length is None and len(self.header) == 0
+        if self.output_file is not None:
+            self.output_file.close()
+            self.output_file = None
+
+
+def send_stream(protocol, server_address, input_stream, client_options=None):
+    """
+    @return: the client after the transfer and the seconds of it
+    """
+    client = make_client(protocol, server_address, client_options)
+    start_time = time.monotonic()
+    client.rdt_send(input_stream)
+    return client, time.monotonic() - start_time
+
+
+def receive_stream(protocol, server_address, output_stream, server_options=None):
+    """
+    Receive one transfer into the output stream, the other clients are refused
+    @return: the seconds from the start of the transfer to its end
+    @raise ValueError: the stream can't be decoded, e.g. a deduplicated chunk is missing
+    """
+    server = make_server(protocol, server_address, server_options)
+    sink = importlib.import_module('sink')
+    start_times = []
+
+    def sink_factory(client_address, connection_id):
+        if start_times:
+            return None
+        start_times.append(time.monotonic())
+        return sink.make_sink(output_stream)
+
+    server.serve(sink_factory, 1)
+    elapsed = time.monotonic() - start_times[0]
+    if server.close_acked:
+        server.linger()
+    server.close()
+    if server.transfer_errors:
+        raise server.transfer_errors[0][1]
+    return elapsed
+
+
+def send_file(server_address, path, protocol=PROTOCOL_SR, client_options=None):
+    """
+    @param client_options: keyword arguments of the client, e.g. {'window_size': 256, 'pacing_policy': 'token_bucket'}
+    @return: dict of TRANSFER_FIELDS
+    """
+    size = os.path.getsize(path)
+    client, elapsed = send_stream(protocol, server_address, open(path, 'rb'), client_options)
+    return make_stats(protocol, path, 1, size, elapsed, client)
+
+
+def receive_file(server_address, path, protocol=PROTOCOL_SR, server_options=None):
+    """
+    Every packet is written at its offset of the file as soon as it arrives, see sink.OffsetSink
+    @param server_options: keyword arguments of the server, e.g. {'window_size': 256}
+    @return: dict of TRANSFER_FIELDS
+    @raise ValueError: the sender sent a batch, see receive_directory
+    """
+    if os.path.isdir(path):
+        raise ValueError('A file is received into a directory: %s' % path)
+    output_stream = importlib.import_module('sink').OffsetSink(path)
+    elapsed = receive_stream(protocol, server_address, output_stream, server_options)
+    with open(path, 'rb') as output_file:
+        if output_file.read(len(BATCH_MAGIC)) == BATCH_MAGIC:
+            raise ValueError('The sender sent a batch of files, receive it into a directory: %s' % path)
+    return make_stats(protocol, path, 1, os.path.getsize(path), elapsed)
+
+
+def send_directory(server_address, directory, protocol=PROTOCOL_SR, client_options=None):
+    """
+    Send all the files under the directory in one session
+    @return: dict of TRANSFER_FIELDS
+    """
+    reader = BatchReader(list_files(directory))
+    client, elapsed = send_stream(protocol, server_address, io.BufferedReader(reader), client_options)
+    return make_stats(protocol, directory, len(reader.files), reader.size, elapsed, client)
+
+
+def receive_directory(server_address, directory, protocol=PROTOCOL_SR, server_options=None):
+    """
+    Receive the files of one batch into the directory, the relative names of the sender are kept
+    @return: dict of TRANSFER_FIELDS
+    @raise ValueError: the sender sent a single file, or the batch is incomplete
+    """
+    os.makedirs(directory, exist_ok=True)
+    writer = BatchWriter(directory)
+    elapsed = receive_stream(protocol, server_address, writer, server_options)
+    if not writer.is_batch:
+        raise ValueError('The sender sent a single file, not a batch: %s' % directory)
+    if writer.rejected:
+        raise ValueError('The names leave the directory: %s' % ', '.join(writer.rejected))
+    if not writer.verified:
+        raise ValueError('The batch is incomplete after the file: %s' % (writer.files[-1] if writer.files else None))
+    return make_stats(protocol, directory, len(writer.files), writer.size, elapsed)
+
+
+def parse_address(address, default_host):
+    """
+    @param address: host:port, or only the port
+    """
+    host, separator, port = address.rpartition(':')
+    return (host if separator else default_host), int(port)
+
+
+def make_options(args, role):
+    """
+    @return: the keyword arguments of the client or the server from the command line
+    """
+    options = {'loss_rate': args.loss}
+    if args.send_buffer is not None:
+        options['send_buffer'] = args.send_buffer
+    if args.receive_buffer is not None:
+        options['receive_buffer'] = args.receive_buffer
+    if role == 'server':
+        # The GBN server has no reorder buffer to size
+        if args.protocol == PROTOCOL_SR and args.window is not None:
+            options['window_size'] = args.window
+        return options
+
+    if args.window is not None:
+        options['window_size'] = args.window
+    if args.mss is not None:
+        options['mss'] = args.mss
+    options['congestion_control'] = args.congestion
+    options['pacing_policy'] = args.pacing
+    options['fec_scheme'] = FEC_SCHEMES.index(args.fec)
+    return options
+
+
+def make_parser():
+    parser = argparse.ArgumentParser(prog='python -m transfer', description='Send or receive files over GBN or SR')
+    parser.add_argument('command', choices=['send', 'receive'])
+    parser.add_argument('address', help='host:port of the server, or the port to receive on')
+    parser.add_argument('path', help='the file, or the directory of a batch')
+    parser.add_argument('--batch', action='store_true',
+                        help='send or receive all the files of the directory in one session, both sides must use it')
+    parser.add_argument('--protocol', choices=sorted(PROTOCOLS), default=PROTOCOL_SR)
+    parser.add_argument('--window', type=int, help='the window size in packets')
+    parser.add_argument('--loss', type=float, default=0, help='the loss rate of the emulated channel')
+    parser.add_argument('--mss', type=int, help='the payload size proposed by the client')
+    parser.add_argument('--congestion', choices=['fixed', 'aimd', 'cubic'], default='fixed')
+    parser.add_argument('--pacing', choices=['none', 'token_bucket'], default='none')
+    parser.add_argument('--fec', choices=FEC_SCHEMES, default='none')
+    parser.add_argument('--send-buffer', type=int, help='SO_SNDBUF in bytes')
+    parser.add_argument('--receive-buffer', type=int, help='SO_RCVBUF in bytes')
+    parser.add_argument('--json', action='store_true', help='print the statistics as JSON')
+    return parser
+
+
+def main(argv=None):
+    parser = make_parser()
+    args = parser.parse_args(argv)
+    # The mode is told explicitly, a receiver can't know it from a path which doesn't exist yet
+    if args.batch and os.path.exists(args.path) and not os.path.isdir(args.path):
+        parser.error('--batch needs a directory: %s' % args.path)
+    if not args.batch and os.path.isdir(args.path):
+        parser.error('%s is a directory, send or receive it with --batch' % args.path)
+
+    if args.command == 'send':
+        server_address = parse_address(args.address, '127.0.0.1')
+        options = make_options(args, 'client')
+        if args.batch:
+            stats = send_directory(server_address, args.path, args.protocol, options)
+        else:
+            stats = send_file(server_address, args.path, args.protocol, options)
+    else:
+        server_address = parse_address(args.address, '')
+        options = make_options(args, 'server')
+        if args.batch:
+            stats = receive_directory(server_address, args.path, args.protocol, options)
+        else:
+            stats = receive_file(server_address, args.path, args.protocol, options)
+
+    if args.json:
+        print(json.dumps(stats))
+    else:
+        print('%s %s: %d files, %d bytes, %.2f s, %.1f KB/s' % (stats['protocol'], stats['path'], stats['files'],
+                                                               stats['bytes'], stats['seconds'],
+                                                               stats['goodput'] / 1024))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())